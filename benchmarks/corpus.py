@@ -0,0 +1,142 @@
+import os
+
+import numpy as np
+
+WORDS = (
+    "user account session token request response handler client server cache index query result error config "
+    "value item list map key path file buffer stream reader writer parser node tree graph edge score rank "
+    "match filter batch chunk queue worker task job event message payload header status retry timeout limit "
+    "offset count total size length name type kind mode state context manager factory builder store record"
+).split()
+LANGUAGES = ("py", "js", "go", "java", "md")
+
+
+class _Generator:
+    """Writes source files of a language, drawing identifiers from a Zipf distribution like real code does."""
+
+    def __init__(self, rng: np.random.Generator):
+        self.rng = rng
+
+    def words(self, n: int) -> list[str]:
+        ranks = np.minimum(self.rng.zipf(1.3, n), len(WORDS)) - 1
+        return [WORDS[r] for r in ranks]
+
+    def snake(self, n: int = 2) -> str:
+        return "_".join(self.words(n))
+
+    def camel(self, n: int = 2, upper: bool = False) -> str:
+        name = "".join(word.capitalize() for word in self.words(n))
+        return name if upper else name[0].lower() + name[1:]
+
+    def number(self) -> int:
+        return int(self.rng.integers(0, 1000))
+
+    def py(self, num_funcs: int) -> str:
+        lines = [f"import {self.snake(1)}", f"from {self.snake(1)}.{self.snake(1)} import {self.camel(2, True)}", ""]
+        for _ in range(num_funcs):
+            name, arg, var = self.snake(), self.snake(1), self.snake()
+            lines += [
+                "",
+                f"def {name}({arg}, {self.snake(1)}=None):",
+                f'    """Returns the {" ".join(self.words(4))}."""',
+                f"    {var} = {arg}.get({self.snake(1)!r}, {self.number()})",
+                f"    if {var} is None:",
+                f'        raise ValueError(f"Invalid {self.snake(1)}: {{{arg}}}")',
+                f"    return [{self.snake(1)} for {self.snake(1)} in {var} if {self.snake(1)}]",
+            ]
+        return "\n".join(lines) + "\n"
+
+    def js(self, num_funcs: int) -> str:
+        lines = [f"const {self.camel(1)} = require('{self.snake(1)}');", ""]
+        for _ in range(num_funcs):
+            name, arg, var = self.camel(), self.camel(1), self.camel()
+            lines += [
+                f"export async function {name}({arg}) {{",
+                f"  // {' '.join(self.words(5))}",
+                f"  const {var} = await {arg}.{self.camel()}({self.number()});",
+                f"  if (!{var}) throw new Error('missing {self.camel(1)}');",
+                f"  return {var}.map(({self.camel(1)}) => {self.camel(1)}.{self.camel(1)});",
+                "}",
+                "",
+            ]
+        return "\n".join(lines)
+
+    def go(self, num_funcs: int) -> str:
+        lines = [f"package {self.snake(1)}", "", 'import "fmt"', ""]
+        for _ in range(num_funcs):
+            name, arg = self.camel(2, True), self.camel(1)
+            lines += [
+                f"// {name} handles the {' '.join(self.words(3))}",
+                f"func {name}({arg} *{self.camel(1, True)}) (int, error) {{",
+                f"\tif {arg} == nil {{",
+                f'\t\treturn 0, fmt.Errorf("nil {self.camel(1)}: %d", {self.number()})',
+                "\t}",
+                f"\treturn len({arg}.{self.camel(1, True)}), nil",
+                "}",
+                "",
+            ]
+        return "\n".join(lines)
+
+    def java(self, num_funcs: int) -> str:
+        lines = [f"package com.{self.snake(1)}.{self.snake(1)};", "", f"public class {self.camel(2, True)} {{"]
+        for _ in range(num_funcs):
+            name, arg = self.camel(), self.camel(1)
+            lines += [
+                f"    /** {' '.join(self.words(6))} */",
+                f"    public {self.camel(1, True)} {name}(final String {arg}) throws Exception {{",
+                f"        if ({arg}.length() > {self.number()}) {{",
+                f'            throw new IllegalArgumentException("{self.camel(1)}");',
+                "        }",
+                f"        return this.{self.camel(1)}.get({arg});",
+                "    }",
+                "",
+            ]
+        return "\n".join(lines) + "}\n"
+
+    def md(self, num_funcs: int) -> str:
+        lines = [f"# {' '.join(self.words(3)).title()}", ""]
+        for _ in range(num_funcs):
+            lines += [f"## {' '.join(self.words(2)).title()}", "", " ".join(self.words(40)) + ".", ""]
+            lines += ["```", f"{self.snake()} --{self.snake(1)}={self.number()}", "```", ""]
+        return "\n".join(lines)
+
+
+def parse_mix(mix: str) -> dict[str, float]:
+    """Parses a language mix like "py=0.5,js=0.3,go=0.2" into normalized weights."""
+    weights = {}
+    for part in mix.split(","):
+        language, _, weight = part.partition("=")
+        if language not in LANGUAGES:
+            raise ValueError(f"Unknown language: {language}, expected one of {LANGUAGES}")
+        weights[language] = float(weight or 1)
+    total = sum(weights.values())
+    return {language: weight / total for language, weight in weights.items()}
+
+
+def make_corpus(
+    root: str, num_files: int, mix: dict[str, float], funcs_per_file: int = 20, duplicates: float = 0.05, seed: int = 0
+) -> dict:
+    """A synthetic repository of `num_files` source files in the given language mix.
+
+    A `duplicates` share of the files are vendored copies of others. Returns the no. of files & bytes written.
+    """
+    rng = np.random.default_rng(seed)
+    generator = _Generator(rng)
+    languages = rng.choice(list(mix), size=num_files, p=list(mix.values()))
+
+    written, num_bytes = [], 0
+    for i, language in enumerate(languages):
+        path = os.path.join(root, f"pkg{i // 100}", f"{generator.snake(1)}_{i}.{language}")
+        if written and rng.random() < duplicates:
+            with open(written[int(rng.integers(0, len(written)))], "rb") as fp:
+                content = fp.read()
+        else:
+            num_funcs = max(1, int(rng.poisson(funcs_per_file)))
+            content = getattr(generator, language)(num_funcs).encode()
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as fp:
+            fp.write(content)
+        written.append(path)
+        num_bytes += len(content)
+    return {"files": num_files, "bytes": num_bytes}
@@ -0,0 +1,43 @@
+import time
+
+import numpy as np
+
+from saku.core.encoding import byte_align_decode, byte_align_encode, decode_postings, encode_postings
+
+
+def _timed(func, *args) -> tuple[float, object]:
+    start_time = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start_time, result
+
+
+def bench_encoding(num_postings: int = 1_000_000, max_doc_id: int = 50_000_000, seed: int = 0) -> dict:
+    rng = np.random.default_rng(seed)
+    doc_ids = np.unique(rng.integers(0, max_doc_id, num_postings))
+    doc_id_list = doc_ids.tolist()
+
+    # Baseline: one integer at a time, as done before the bulk codec
+    encode_time, encoded = _timed(lambda ids: b"".join(byte_align_encode(i) for i in ids), doc_id_list)
+    decode_time, _ = _timed(lambda data: list(byte_align_decode(data)), encoded)
+    baseline = {"encode_sec": encode_time, "decode_sec": decode_time, "bytes": len(encoded)}
+
+    encode_time, encoded = _timed(encode_postings, doc_ids)
+    decode_time, decoded = _timed(decode_postings, encoded)
+    assert np.array_equal(doc_ids, decoded)
+    bulk = {"encode_sec": encode_time, "decode_sec": decode_time, "bytes": len(encoded)}
+
+    for result in (baseline, bulk):
+        result["postings_per_sec"] = len(doc_ids) / (result["encode_sec"] + result["decode_sec"])
+
+    return {"postings": len(doc_ids), "byte_align": baseline, "bulk": bulk}
+
+
+if __name__ == "__main__":
+    results = bench_encoding()
+    print(f"Postings: {results['postings']}")
+    for name in ("byte_align", "bulk"):
+        res = results[name]
+        print(
+            f"{name:>10}: encode {res['encode_sec']:.3f}s, decode {res['decode_sec']:.3f}s, "
+            f"{res['bytes']} bytes, {res['postings_per_sec']:.0f} postings/sec"
+        )
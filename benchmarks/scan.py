@@ -0,0 +1,66 @@
+import os
+import tempfile
+import time
+from pathlib import Path
+
+import magic
+import numpy as np
+
+from saku.index.scanner import FileScanner, FileTypeDetector
+
+
+def make_tree(root: str, num_dirs: int = 200, files_per_dir: int = 25, seed: int = 0) -> int:
+    """A synthetic checkout of sources, binaries, git objects & dependencies. Returns the no. of files written."""
+    rng = np.random.default_rng(seed)
+    num_files = 0
+
+    def write(path: str, content: bytes) -> None:
+        nonlocal num_files
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as fp:
+            fp.write(content)
+        num_files += 1
+
+    write(os.path.join(root, ".gitignore"), b"build/\n*.log\n")
+    for d in range(num_dirs):
+        for f in range(files_per_dir):
+            source = b"".join(b"def func_%d_%d(x):\n    return x * %d\n" % (d, f, i) for i in range(20))
+            write(os.path.join(root, "src", f"pkg{d}", f"module{f}.py"), source)
+        write(os.path.join(root, "assets", f"image{d}.png"), rng.bytes(4096))
+        write(os.path.join(root, "build", f"out{d}.bin"), rng.bytes(4096))
+        write(os.path.join(root, "node_modules", f"dep{d}", "index.js"), b"module.exports = {};\n" * 10)
+        write(os.path.join(root, ".git", "objects", f"{d:02x}", "object"), rng.bytes(1024))
+    return num_files
+
+
+def _baseline(root: str) -> list[str]:
+    # Scanning as done before: walk everything, then ask libmagic about every file
+    paths = [str(p.absolute()) for p in Path(root).rglob("*") if p.is_file() and not p.name.startswith(".")]
+    return [p for p in paths if magic.from_file(p, mime=True).startswith("text")]
+
+
+def _scanner(root: str) -> list[str]:
+    scanner = FileScanner([".git", "node_modules"], max_file_size=10 * 1024 * 1024)
+    detector = FileTypeDetector()
+    return [f.path for f in scanner.scan(root) if detector.mime_type(f.path).startswith("text")]
+
+
+def bench_scan(num_dirs: int = 200, files_per_dir: int = 25) -> dict:
+    with tempfile.TemporaryDirectory() as root:
+        num_files = make_tree(root, num_dirs, files_per_dir)
+
+        results = {"files": num_files}
+        for name, scan in (("baseline", _baseline), ("scanner", _scanner)):
+            start_time = time.perf_counter()
+            text_files = scan(root)
+            elapsed = time.perf_counter() - start_time
+            results[name] = {"sec": elapsed, "text_files": len(text_files), "files_per_sec": num_files / elapsed}
+        return results
+
+
+if __name__ == "__main__":
+    results = bench_scan()
+    print(f"Files: {results['files']}")
+    for name in ("baseline", "scanner"):
+        res = results[name]
+        print(f"{name:>10}: {res['sec']:.3f}s, {res['text_files']} text files, {res['files_per_sec']:.0f} files/sec")
@@ -0,0 +1,81 @@
+import asyncio
+import itertools
+import logging
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.scan import make_tree
+from saku.core.config import SakuConfig
+from saku.index.indexer import Indexer
+from saku.index.query import QueryEngine
+
+QUERIES = ["func_1_2", r"return x \* 7\b", r"def func_3\d_1\(", "module", r"func_\d+_4\(x\)"]
+# Blocking endpoints were run on anyio's thread pool, which is capped at 40 threads
+THREADPOOL_SIZE = 40
+
+
+def make_config(root: str, posting_store: str = "segments", database_uri: str | None = None, **settings) -> SakuConfig:
+    """An embedded setup over SQLite & segment files by default, no servers needed."""
+    return SakuConfig(
+        REPO_DIR=root,
+        STORAGE_BACKEND="embedded",
+        DATA_DIR=root,
+        DATABASE_URI=database_uri,
+        POSTING_STORE=posting_store,
+        SEGMENTS_DIR=os.path.join(root, "index"),
+        REDIS_HOST="localhost",
+        **settings,
+    )
+
+
+def _run_threaded(engine: QueryEngine, num_requests: int, concurrency: int) -> float:
+    queries = itertools.islice(itertools.cycle(QUERIES), num_requests)
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(min(concurrency, THREADPOOL_SIZE)) as executor:
+        list(executor.map(lambda regex: engine.search(regex, True), queries))
+    return time.perf_counter() - start_time
+
+
+async def _run_async(engine: QueryEngine, num_requests: int, concurrency: int) -> float:
+    queries = iter(itertools.islice(itertools.cycle(QUERIES), num_requests))
+
+    async def client() -> None:
+        for regex in queries:
+            await engine.asearch(regex, True)
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return time.perf_counter() - start_time
+
+
+def bench_search_load(concurrencies=(1, 8, 32, 64), num_requests: int = 500, num_dirs: int = 40) -> dict:
+    with tempfile.TemporaryDirectory() as root:
+        make_tree(os.path.join(root, "repo"), num_dirs)
+        config = make_config(root)
+        Indexer(config).index_directory(os.path.join(root, "repo"))
+        logging.getLogger().setLevel(logging.WARNING)
+
+        engine = QueryEngine(config)
+        loop = asyncio.new_event_loop()
+        try:
+            # Warm up the worker processes & connection pools
+            engine.search(QUERIES[0], True)
+            loop.run_until_complete(engine.asearch(QUERIES[0], True))
+
+            results = {}
+            for concurrency in concurrencies:
+                threaded = _run_threaded(engine, num_requests, concurrency)
+                run_async = loop.run_until_complete(_run_async(engine, num_requests, concurrency))
+                results[concurrency] = {"threaded_qps": num_requests / threaded, "async_qps": num_requests / run_async}
+            loop.run_until_complete(engine.aclose())
+        finally:
+            loop.close()
+            engine.verifier.close()
+        return results
+
+
+if __name__ == "__main__":
+    for concurrency, res in bench_search_load().items():
+        print(f"{concurrency:>3} clients: threaded {res['threaded_qps']:.0f} qps, async {res['async_qps']:.0f} qps")
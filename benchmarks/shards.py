@@ -0,0 +1,49 @@
+import logging
+import os
+import tempfile
+import time
+
+from benchmarks.corpus import make_corpus, parse_mix
+from benchmarks.search_load import make_config
+from benchmarks.suite import QUERIES, _percentiles
+from saku.index.shards import ShardedIndexer, ShardedQueryEngine
+
+MIX = "py=0.4,js=0.25,go=0.15,java=0.15,md=0.05"
+
+
+def bench_shards(shard_counts=(1, 2, 4), num_repos: int = 16, files_per_repo: int = 250, repeat: int = 5) -> dict:
+    """Search latency over the same repositories, spread over more & more shards."""
+    results = {}
+    with tempfile.TemporaryDirectory() as root:
+        repo_dir = os.path.join(root, "repos")
+        for i in range(num_repos):
+            make_corpus(os.path.join(repo_dir, f"repo{i}"), files_per_repo, parse_mix(MIX), seed=i)
+        logging.getLogger().setLevel(logging.WARNING)
+
+        for num_shards in shard_counts:
+            data_dir = os.path.join(root, f"shards{num_shards}")
+            config = make_config(data_dir).copy(update={"REPO_DIR": repo_dir, "SHARDS": num_shards})
+            ShardedIndexer(config).index_directory(repo_dir)
+
+            engine = ShardedQueryEngine(config)
+            try:
+                # Warm up the shard processes
+                engine.search(QUERIES[0], True)
+                samples = []
+                for _ in range(repeat):
+                    for regex in QUERIES:
+                        start_time = time.perf_counter()
+                        engine.search(regex, True, count_mode="exact")
+                        samples.append(time.perf_counter() - start_time)
+                results[num_shards] = _percentiles(samples)
+            finally:
+                engine.close()
+    return results
+
+
+if __name__ == "__main__":
+    print(f"{os.cpu_count()} CPUs")
+    for num_shards, res in bench_shards().items():
+        print(
+            f"{num_shards} shards: p50 {res['p50_ms']:.1f} ms, p90 {res['p90_ms']:.1f} ms, p99 {res['p99_ms']:.1f} ms"
+        )
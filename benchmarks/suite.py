@@ -0,0 +1,327 @@
+import json
+import logging
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+
+import fakeredis
+import numpy as np
+import typer
+from redis.client import Redis
+
+from benchmarks.corpus import make_corpus, parse_mix
+from benchmarks.search_load import make_config
+from saku.core.config import ONE_MB
+from saku.core.metrics import Timings
+from saku.db.postings import PostingStore, RedisPostingStore
+from saku.db.segments import SegmentPostingStore
+from saku.index.indexer import PARSE_CHUNK_SIZE, Indexer, parse_documents
+from saku.index.parser import DocumentParser
+from saku.index.planner import QueryPlanner
+from saku.index.postings import blob_grams, line_grams, query_grams, search_postings
+from saku.index.query import QueryEngine
+from saku.index.scanner import FileScanner
+from saku.index.verifier import MatchVerifier
+
+# Common & rare literals, classes, alternations & case folding over the corpus vocabulary
+QUERIES = [
+    "user_account",
+    "def query_result",
+    r"raise ValueError\(",
+    r"func \w+Handler\(",
+    r"(token|session)_cache",
+    r"throw new Error\('missing \w+'\)",
+    r"Returns the \w+ \w+ index",
+    r"\d{3}\)",
+    "(?i)STREAM_READER",
+    r"worker\.\w+\(",
+]
+
+app = typer.Typer()
+
+
+def _percentiles(samples: list[float]) -> dict:
+    ms = np.array(samples) * 1000
+    return {
+        "mean_ms": round(float(ms.mean()), 3),
+        "p50_ms": round(float(np.percentile(ms, 50)), 3),
+        "p90_ms": round(float(np.percentile(ms, 90)), 3),
+        "p99_ms": round(float(np.percentile(ms, 99)), 3),
+    }
+
+
+def _rate(count: int, num_bytes: int, elapsed: float) -> dict:
+    return {
+        "sec": round(elapsed, 4),
+        "docs_per_sec": round(count / elapsed, 1),
+        "mb_per_sec": round(num_bytes / ONE_MB / elapsed, 2),
+    }
+
+
+def _new_posting_store(kind: str, root: str, redis_url: str | None = None) -> PostingStore:
+    if kind == "segments":
+        return SegmentPostingStore(root)
+    if redis_url is None:
+        return RedisPostingStore(fakeredis.FakeRedis())
+    redis = Redis.from_url(redis_url)
+    redis.flushdb()
+    return RedisPostingStore(redis)
+
+
+def _posting_bytes(store: PostingStore) -> int:
+    if isinstance(store, SegmentPostingStore):
+        # Line postings are in a nested store
+        return sum(
+            os.path.getsize(os.path.join(root, name))
+            for root, _, names in os.walk(store.segments_dir)
+            for name in names
+        )
+    return sum(
+        len(key) + sum(map(len, store.redis.lrange(key, 0, -1)))
+        for prefix in (store.KEY_PREFIX, store.LINE_KEY_PREFIX)
+        for key in store.redis.scan_iter(match=prefix + b"*", count=1000)
+    )
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_indexing(
+    root: str, parser: DocumentParser, store_kind: str, scratch_dir: str, redis_url: str | None = None
+) -> dict:
+    """Times scanning, parsing & writing postings one after the other, each on a single thread."""
+    start_time = time.perf_counter()
+    files = list(FileScanner([], max_file_size=10 * ONE_MB).scan(root))
+    scan = _rate(len(files), sum(f.size for f in files), time.perf_counter() - start_time)
+
+    documents = [(doc_id, f.path) for doc_id, f in enumerate(files, 1)]
+    start_time = time.perf_counter()
+    batches = [
+        parse_documents(parser, documents[i : i + PARSE_CHUNK_SIZE]) for i in range(0, len(documents), PARSE_CHUNK_SIZE)
+    ]
+    parse = _rate(len(documents), sum(batch.num_bytes for batch in batches), time.perf_counter() - start_time)
+
+    store = _new_posting_store(store_kind, scratch_dir, redis_url)
+    start_time = time.perf_counter()
+    for batch in batches:
+        store.add_lines(batch.lines)
+        store.add(batch.postings)
+    elapsed = time.perf_counter() - start_time
+    num_postings = sum(len(ids) for batch in batches for ids in [*batch.postings.values(), *batch.lines.values()])
+    write = {
+        "sec": round(elapsed, 4),
+        "postings": num_postings,
+        "postings_per_sec": round(num_postings / elapsed, 1),
+        "grams_per_doc": round(num_postings / max(len(documents), 1), 1),
+    }
+    return {"scan": scan, "parse": parse, "write": write}
+
+
+def bench_queries(engine: QueryEngine, queries: list[str], repeat: int) -> dict:
+    """Times every query stage on its own, and `QueryEngine.search` end to end."""
+    samples = {stage: [] for stage in ("plan", "optimize", "fetch", "intersect", "filter", "verify", "search")}
+    per_query = {}
+    verifier = engine.verifier
+
+    for regex in queries:
+        planned = engine.planner.plan(regex, True)
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            # Uncached, as for a query never seen before
+            engine.planner._plan(regex, True)
+            samples["plan"].append(time.perf_counter() - start_time)
+
+            start_time = time.perf_counter()
+            tree = planned
+            if planned is not None:
+                frequencies = engine.postings.frequencies(query_grams(planned))
+                tree = engine.optimize(planned, frequencies, engine.postings.num_documents())
+            samples["optimize"].append(time.perf_counter() - start_time)
+
+            start_time = time.perf_counter()
+            postings, lines = engine.postings.get(blob_grams(tree)), engine.postings.get_lines(line_grams(tree))
+            tombstones = engine.postings.tombstones()
+            samples["fetch"].append(time.perf_counter() - start_time)
+
+            start_time = time.perf_counter()
+            blob_ids = search_postings(tree, lambda _: postings, tombstones, lambda _: lines)
+            blob_ids = None if blob_ids is None else list(blob_ids)
+            line_starts = None if tree is None else engine._line_starts(tree, lines, regex, True, Timings())
+            samples["intersect"].append(time.perf_counter() - start_time)
+
+            start_time = time.perf_counter()
+            rows = engine._candidates(blob_ids, None, None, None, Timings())
+            samples["filter"].append(time.perf_counter() - start_time)
+            paths = [path for path, _ in rows]
+            if line_starts is not None:
+                line_starts = [line_starts.get(blob_id) for _, blob_id in rows]
+
+            start_time = time.perf_counter()
+            matches = verifier.iter_matches(paths, regex, True, None, line_starts)
+            num_matches = sum(snippets is not None for _, snippets in matches)
+            samples["verify"].append(time.perf_counter() - start_time)
+
+            start_time = time.perf_counter()
+            engine.search(regex, True)
+            samples["search"].append(time.perf_counter() - start_time)
+
+        per_query[regex] = {
+            "planned_grams": len(query_grams(planned)),
+            "grams": len(query_grams(tree)),
+            "candidates": len(paths),
+            "matches": num_matches,
+        }
+
+    return {"stages": {stage: _percentiles(times) for stage, times in samples.items()}, "queries": per_query}
+
+
+def run_suite(
+    num_files: int,
+    mix: str,
+    store_kind: str,
+    database_uri: str | None,
+    repeat: int,
+    seed: int = 0,
+    redis_url: str | None = None,
+    stop_gram_ratio: float | None = None,
+    case_folded: bool = False,
+    line_positions: bool = False,
+) -> dict:
+    with tempfile.TemporaryDirectory() as root:
+        corpus_dir = os.path.join(root, "corpus")
+        corpus = make_corpus(corpus_dir, num_files, parse_mix(mix), seed=seed)
+        config = make_config(
+            root,
+            store_kind,
+            database_uri,
+            INDEX_STOP_GRAM_RATIO=stop_gram_ratio,
+            INDEX_STOP_GRAM_MIN_DOCUMENTS=1,
+            INDEX_CASE_FOLDED=case_folded,
+            INDEX_LINE_POSITIONS=line_positions,
+        )
+        parser = DocumentParser.from_config(config)
+
+        results = {
+            "meta": {
+                "commit": _git_commit(),
+                "created_at": datetime.now().isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "cpus": os.cpu_count(),
+                "files": num_files,
+                "mix": mix,
+                "posting_store": store_kind if store_kind == "segments" or redis_url else "fakeredis",
+                "database": config.DATABASE_URI.split(":", 1)[0],
+                "repeat": repeat,
+                "seed": seed,
+                "stop_gram_ratio": stop_gram_ratio,
+                "case_folded": case_folded,
+                "line_positions": line_positions,
+            },
+            "corpus": {**corpus, "mb": round(corpus["bytes"] / ONE_MB, 2)},
+            "indexing": bench_indexing(corpus_dir, parser, store_kind, os.path.join(root, "scratch"), redis_url),
+        }
+
+        engine = QueryEngine(config)
+        indexer = Indexer(config, engine.documents)
+        if store_kind == "redis":
+            # Both sides share the stand-in or the given server, instead of the Redis server in the config
+            indexer.postings = engine.postings = _new_posting_store(store_kind, root, redis_url)
+        logging.getLogger().setLevel(logging.WARNING)
+        try:
+            start_time = time.perf_counter()
+            indexer.index_directory(corpus_dir)
+            results["indexing"]["total"] = _rate(num_files, corpus["bytes"], time.perf_counter() - start_time)
+
+            posting_bytes = _posting_bytes(engine.postings)
+            source_mb = corpus["bytes"] / ONE_MB
+            results["index_size"] = {
+                "stop_grams": len(engine.postings.stop_grams()),
+                "posting_bytes": posting_bytes,
+                "posting_mb_per_source_mb": round(posting_bytes / ONE_MB / source_mb, 3),
+            }
+            results["querying"] = bench_queries(engine, QUERIES, repeat)
+        finally:
+            engine.verifier.close()
+            if isinstance(indexer.postings, SegmentPostingStore):
+                indexer.postings.close()
+        return results
+
+
+def _flatten(results: dict, prefix: str = "") -> dict[str, float]:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix + key] = value
+    return flat
+
+
+def _higher_is_better(metric: str) -> bool:
+    return metric.endswith("_per_sec")
+
+
+def _lower_is_better(metric: str) -> bool:
+    return metric.endswith(("_ms", ".sec", "_per_source_mb"))
+
+
+@app.command()
+def run(
+    files: int = typer.Option(2000, help="No. of files in the synthetic corpus"),
+    mix: str = typer.Option("py=0.4,js=0.25,go=0.15,java=0.15,md=0.05", help="Language mix of the corpus"),
+    store: str = typer.Option("redis", help="Posting store: redis or segments (the embedded backend's)"),
+    redis_url: str = typer.Option(None, help="Redis database to use, which gets flushed (fakeredis by default)"),
+    database_uri: str = typer.Option(None, help="Database to index into, a temporary SQLite file by default"),
+    repeat: int = typer.Option(5, help="Runs of every query"),
+    seed: int = typer.Option(0),
+    stop_gram_ratio: float = typer.Option(None, help="Stop indexing grams posted for more than this share of files"),
+    case_folded: bool = typer.Option(False, help="Index case folded grams for case insensitive queries too"),
+    line_positions: bool = typer.Option(False, help="Index the lines of grams, to match literals within a line"),
+    output: str = typer.Option(None, help="Write the JSON results to this file instead of stdout"),
+):
+    """Benchmarks every indexing & query stage over a synthetic corpus, emitting the results as JSON."""
+    if store not in ("redis", "segments"):
+        raise typer.BadParameter(f"Unknown posting store: {store}")
+    results = run_suite(
+        files, mix, store, database_uri, repeat, seed, redis_url, stop_gram_ratio, case_folded, line_positions
+    )
+    results = json.dumps(results, indent=2)
+    if output:
+        with open(output, "w") as fp:
+            fp.write(results + "\n")
+    else:
+        print(results)
+
+
+@app.command()
+def compare(baseline: str, current: str, threshold: float = typer.Option(0.1, help="Relative change flagged")):
+    """Compares two result files, failing when any timing or throughput regressed beyond the threshold."""
+    with open(baseline) as fp:
+        before = _flatten(json.load(fp))
+    with open(current) as fp:
+        after = _flatten(json.load(fp))
+
+    regressions = 0
+    for metric in sorted(before.keys() & after.keys()):
+        if not (_higher_is_better(metric) or _lower_is_better(metric)) or not before[metric]:
+            continue
+        change = (after[metric] - before[metric]) / before[metric]
+        regressed = change < -threshold if _higher_is_better(metric) else change > threshold
+        regressions += regressed
+        marker = "REGRESSED" if regressed else ""
+        print(f"{metric:<55} {before[metric]:>14.3f} {after[metric]:>14.3f} {change:>+8.1%} {marker}")
+
+    if regressions:
+        print(f"{regressions} metrics regressed by more than {threshold:.0%}")
+        raise typer.Exit(1)
+
+
+if __name__ == "__main__":
+    app()
@@ -4,14 +4,14 @@ import magic
 from sqlmodel import Session, create_engine
 
 from saku.core.config import SakuConfig
-from saku.core.encoding import byte_align_encode
+from saku.core.encoding import encode_postings
 from saku.db.models import Document, IndexNGram, create_db_and_tables
 from saku.index.parser import DocumentParser
 
 if __name__ == "__main__":
     config = SakuConfig()
     engine = create_engine(config.DATABASE_URI)
-    parser = DocumentParser(config.MAX_SPARSE_GRAM_LENGTH)
+    parser = DocumentParser.from_config(config)
 
     session = Session(engine)
     create_db_and_tables(engine)
@@ -58,7 +58,7 @@ if __name__ == "__main__":
 
     print(f"Loading indices into database")
     for ngram, posting_list in tokens.items():
-        doc_ids = b"".join(byte_align_encode(posting) for posting in posting_list)
+        doc_ids = encode_postings(posting_list)
         index_ngram = IndexNGram(ngram=ngram, doc_ids=doc_ids)
         session.add(index_ngram)
 
@@ -1,37 +1,113 @@
+import json
 import os
-import subprocess
+import re
 from pathlib import Path
+from typing import Literal
 
-from fastapi import Body, FastAPI, HTTPException
+from fastapi import Body, FastAPI, HTTPException, Query
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from git import GitCommandError, Repo
 from pydantic import HttpUrl
 
 from saku.core.config import SakuConfig
+from saku.core.metrics import METRICS
+from saku.index.indexer import Indexer
+from saku.index.jobs import JobManager
 from saku.index.query import QueryEngine
+from saku.index.shards import ShardedIndexer, ShardedQueryEngine
 
 app = FastAPI()
 config = SakuConfig()
-query_engine = QueryEngine(config)
+METRICS.enabled = config.METRICS_ENABLED
+if config.SHARDS > 1:
+    query_engine, indexer = ShardedQueryEngine(config), ShardedIndexer(config)
+else:
+    query_engine = QueryEngine(config)
+    indexer = Indexer(config, query_engine.documents)
+jobs = JobManager(indexer, config.INDEX_MAX_CONCURRENT_JOBS)
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await query_engine.aclose()
 
 
 @app.post("/repo")
 def clone(url: HttpUrl):
     try:
         Repo.clone_from(url, os.path.join(config.REPO_DIR, Path(url).stem))
+        query_engine.refresh_repos()
         return {"message": f"`{url} clone successfully`"}
     except GitCommandError:
         raise HTTPException(400, "Repo already exists")
 
 
 @app.put("/repo/index")
-def index():
-    subprocess.run(["./venv/bin/python", "./saku/index/indexer.py"])
-    subprocess.run(["./venv/bin/python", "./saku/index/indexer.py"])
-    return {"message": "Indexing completed"}
+def index(name: str | None = None):
+    """Queues an indexing job for the named repo, or one for every repo. Poll them on `/jobs/{id}`."""
+    if name is None:
+        paths = [entry.path for entry in os.scandir(config.REPO_DIR) if entry.is_dir()]
+    else:
+        path = os.path.join(config.REPO_DIR, name)
+        if os.path.dirname(os.path.normpath(path)) != os.path.normpath(config.REPO_DIR) or not os.path.isdir(path):
+            raise HTTPException(404, f"Unknown repo: {name}")
+        paths = [path]
+
+    query_engine.refresh_repos()
+    return {"jobs": [jobs.submit(path).to_dict() for path in paths]}
+
+
+@app.get("/jobs/{job_id}")
+def job_status(job_id: str):
+    if (job := jobs.get(job_id)) is None:
+        raise HTTPException(404, f"Unknown job: {job_id}")
+    return job.to_dict()
 
 
 @app.post("/search")
-def search(
+async def search(
+    regex: bytes = Body(..., embed=True),
+    skip: int = 0,
+    limit: int = 20,
+    case_sensitive: bool = True,
+    size_lt: int | None = None,
+    size_gt: int | None = None,
+    path_like: str | None = None,
+    count: Literal["estimate", "exact"] = "estimate",
+    context: int | None = Query(None, ge=0),
+    breakdown: bool = False,
+):
+    """Returns whole matched files, or only the matched lines when `context` lines are asked for.
+
+    `breakdown` adds the time spent per stage of the search.
+    """
+    regex_str = regex.decode("utf-8")
+    try:
+        return await query_engine.asearch(
+            regex_str, case_sensitive, skip, limit, size_lt, size_gt, path_like, count, context, breakdown
+        )
+    except re.error as e:
+        raise HTTPException(400, f"Invalid regex: {e}")
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    """Per stage histograms of searches & indexing, in the Prometheus text format."""
+    if not METRICS.enabled:
+        raise HTTPException(404, "Metrics are disabled")
+    return PlainTextResponse(METRICS.render(), media_type="text/plain; version=0.0.4")
+
+
+def _ndjson_line(event: dict) -> str:
+    return json.dumps(event) + "\n"
+
+
+def _sse_event(event: dict) -> str:
+    return f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+
+@app.post("/search/stream")
+async def search_stream(
     regex: bytes = Body(..., embed=True),
     skip: int = 0,
     limit: int = 20,
@@ -39,9 +115,33 @@ def search(
     size_lt: int | None = None,
     size_gt: int | None = None,
     path_like: str | None = None,
+    count: Literal["estimate", "exact"] = "estimate",
+    context: int | None = Query(None, ge=0),
+    format: Literal["ndjson", "sse"] = "ndjson",
 ):
+    """Streams every match as soon as it is verified, followed by a summary record."""
     regex_str = regex.decode("utf-8")
-    return query_engine.search(regex_str, case_sensitive, skip, limit, size_lt, size_gt, path_like)
+    try:
+        events = await query_engine.aiter_search(
+            regex_str, case_sensitive, skip, limit, size_lt, size_gt, path_like, count, context
+        )
+    except re.error as e:
+        raise HTTPException(400, f"Invalid regex: {e}")
+
+    if format == "sse":
+        encode, media_type = _sse_event, "text/event-stream"
+    else:
+        encode, media_type = _ndjson_line, "application/x-ndjson"
+
+    async def stream():
+        try:
+            async for event in events:
+                yield encode(event)
+        finally:
+            # The client went away, stop verifying
+            await events.aclose()
+
+    return StreamingResponse(stream(), media_type=media_type)
 
 
 if __name__ == "__main__":
@@ -1,3 +1,6 @@
+import os
+from typing import Literal
+
 from pydantic import BaseSettings, Field, PostgresDsn, validator
 
 ONE_MB = 1024 * 1024
@@ -14,28 +17,136 @@ class SakuConfig(BaseSettings):
     # Maximum File that can be considered for Indexing (in MB)
     MAX_FILE_SIZE_TO_INDEX: int = Field(default=10, gt=0)
 
+    # Directories never scanned, by name (.gitignore'd ones are skipped as well)
+    SCAN_EXCLUDES: list[str] = Field(default=[".git", ".hg", ".svn", "node_modules", "__pycache__"])
+
+    # No. of threads listing directories
+    SCAN_WORKERS: int = Field(default=8, gt=0)
+
     # Maximum File that can be considered for Indexing (in MB)
     MAX_SPARSE_GRAM_LENGTH: int = Field(default=3, gt=2)
 
+    # Bigram weight table (.npy) used to generate sparse grams, defaults to byte value sums
+    BIGRAM_WEIGHTS_PATH: str | None = None
+
+    # Also index the grams of the lower cased content, so that case insensitive queries prune candidates
+    # as well as case sensitive ones. Costs more parsing & postings, re-index after changing
+    INDEX_CASE_FOLDED: bool = False
+
+    # Also post the offsets of the lines every gram is found on, so that the grams of a literal must share a line
+    # and only those lines are searched. Costs larger postings, re-index after changing
+    INDEX_LINE_POSITIONS: bool = False
+
+    # No. of threads reading file metadata & detecting mime types
+    INDEX_METADATA_WORKERS: int = Field(default=12, gt=0)
+
+    # No. of processes generating n-grams (Defaults to the no. of CPUs)
+    INDEX_PARSE_WORKERS: int | None = Field(default=None, gt=0)
+
+    # No. of parsed batches that can wait for the postings writer
+    INDEX_QUEUE_SIZE: int = Field(default=4, gt=0)
+
+    # No. of deleted documents & removed postings after which the postings are compacted
+    INDEX_COMPACTION_THRESHOLD: int = Field(default=100_000, gt=0)
+
+    # No. of indexing jobs running at once, the others wait in a queue
+    INDEX_MAX_CONCURRENT_JOBS: int = Field(default=2, gt=0)
+
+    # Grams posted for more than this share of the indexed blobs stop being indexed, which shrinks the
+    # postings. Queries leave them to the verifier. Unset to index every gram
+    INDEX_STOP_GRAM_RATIO: float | None = Field(default=None, gt=0, le=1)
+
+    # No. of indexed blobs before any stop gram gets picked
+    INDEX_STOP_GRAM_MIN_DOCUMENTS: int = Field(default=1000, gt=0)
+
     @property
     def max_file_size_to_index_in_bytes(self) -> int:
         return self.MAX_FILE_SIZE_TO_INDEX * ONE_MB
 
+    # ---- QUERYING
+    # No. of regex query plans to memoize
+    QUERY_PLAN_CACHE_SIZE: int = Field(default=1024, ge=0)
+
+    # No. of processes verifying candidate documents (Defaults to the no. of CPUs)
+    VERIFY_WORKERS: int | None = Field(default=None, gt=0)
+
+    # Grams, and whole query plans, expected to match more than this share of the indexed blobs
+    # are not worth fetching the postings of, their candidates are verified instead
+    QUERY_MAX_MATCH_RATIO: float = Field(default=0.5, gt=0, le=1)
+
+    # Filter & order candidates over an in-memory copy of the documents' metadata, instead of in the database
+    QUERY_DOCUMENTS_IN_MEMORY: bool = True
+
+    # Seconds after which that copy is reloaded, to pick up documents changed by other processes
+    QUERY_DOCUMENTS_MAX_AGE: float = Field(default=60, gt=0)
+
+    # ---- METRICS
+    # Record per stage histograms of searches & indexing, served on `/metrics`
+    METRICS_ENABLED: bool = True
+
+    # ---- STORAGE
+    # "server" keeps postings in Redis & documents in Postgres. "embedded" keeps both in local files
+    # (posting segments & SQLite) within a single process, with no server to run
+    STORAGE_BACKEND: Literal["server", "embedded"] = "server"
+
+    # Directory holding the SQLite database of the embedded backend
+    DATA_DIR: str = "./data"
+
+    # No. of shards the repositories are spread over, each searched by its own process.
+    # Re-index everything after changing it
+    SHARDS: int = Field(default=1, gt=0)
+
+    # ---- POSTINGS
+    # Where posting lists live, in Redis or in memory mapped segment files (Defaults to the backend's)
+    POSTING_STORE: Literal["redis", "segments"] | None = None
+
+    # Directory holding the posting segments
+    SEGMENTS_DIR: str = "./index"
+
+    # No. of similarly sized segments merged together
+    SEGMENT_MERGE_FACTOR: int = Field(default=10, gt=1)
+
     # ---- REDIS
-    REDIS_HOST: str
-    REDIS_PORT: int
+    # Only needed when postings are stored in Redis
+    REDIS_HOST: str | None = None
+    REDIS_PORT: int = 6379
+    REDIS_DB: int = Field(default=0, ge=0)
+
+    # Max. no. of connections pooled by the async query path
+    REDIS_POOL_SIZE: int = Field(default=64, gt=0)
 
     # ---- DATABASE
-    DATABASE_HOST: str
-    DATABASE_USER: str
-    DATABASE_PASSWORD: str
-    DATABASE_NAME: str
+    # Postgres of the server backend, unless a DATABASE_URI is given
+    DATABASE_HOST: str | None = None
+    DATABASE_USER: str | None = None
+    DATABASE_PASSWORD: str | None = None
+    DATABASE_NAME: str | None = None
     DATABASE_URI: str | None = None
 
-    @validator("DATABASE_URI")
+    # No. of connections kept open, and the no. that can be opened on top of them under load
+    DATABASE_POOL_SIZE: int = Field(default=10, gt=0)
+    DATABASE_MAX_OVERFLOW: int = Field(default=20, ge=0)
+
+    @validator("POSTING_STORE", always=True)
+    def default_posting_store(cls, v: str | None, values: dict[str, str | int]) -> str:
+        if v is not None:
+            return v
+        return "segments" if values.get("STORAGE_BACKEND") == "embedded" else "redis"
+
+    @validator("REDIS_HOST", always=True)
+    def check_redis_host(cls, v: str | None, values: dict[str, str | int]) -> str | None:
+        if v is None and values.get("POSTING_STORE") == "redis":
+            raise ValueError("REDIS_HOST is needed to store postings in Redis")
+        return v
+
+    @validator("DATABASE_URI", always=True)
     def construct_database_connection_uri(cls, v: str | None, values: dict[str, str | int]) -> str | PostgresDsn:
         if isinstance(v, str):
             return v
+        if values.get("STORAGE_BACKEND") == "embedded":
+            return f"sqlite:///{os.path.abspath(os.path.join(values['DATA_DIR'], 'saku.db'))}"
+        if not all(values.get(field) for field in ("DATABASE_HOST", "DATABASE_USER", "DATABASE_NAME")):
+            raise ValueError("DATABASE_URI, or DATABASE_HOST, DATABASE_USER & DATABASE_NAME are needed")
         return PostgresDsn.build(
             scheme="postgresql",
             host=values.get("DATABASE_HOST"),
@@ -43,3 +154,10 @@ class SakuConfig(BaseSettings):
             password=values.get("DATABASE_PASSWORD"),
             path=f"/{values.get('DATABASE_NAME') or ''}",
         )
+
+    @property
+    def async_database_uri(self) -> str:
+        # Same database, through an asyncio driver
+        scheme, rest = self.DATABASE_URI.split("://", 1)
+        driver = {"postgresql": "postgresql+asyncpg", "postgres": "postgresql+asyncpg", "sqlite": "sqlite+aiosqlite"}
+        return f"{driver.get(scheme.split('+')[0], scheme)}://{rest}"
@@ -1,4 +1,7 @@
-from typing import Iterator
+import zlib
+from typing import Iterable, Iterator
+
+import numpy as np
 
 
 def byte_align_encode(num: int) -> bytes:
@@ -39,3 +42,77 @@ def byte_align_decode(encoded_bytes: bytes) -> Iterator[int]:
     # If the last byte had the continuation bit set, return an error
     if byte_ & 0x80:
         raise ValueError("Invalid byte alignment")
+
+
+def encode_postings(doc_ids: Iterable[int] | np.ndarray) -> bytes:
+    # Gap encode the sorted ids, then byte align every gap in one vectorized pass
+    ids = np.asarray(doc_ids, dtype=np.int64)
+    if ids.size == 0:
+        return b""
+    if ids[0] < 0:
+        raise ValueError("Posting ids must be non negative")
+
+    gaps = np.diff(ids, prepend=0)
+    if (gaps[1:] <= 0).any():
+        raise ValueError("Posting ids must be sorted and unique")
+    gaps = gaps.astype(np.uint64)
+
+    # No. of 7 bit groups needed by every gap (at least one, even for 0)
+    num_bytes = np.ones(gaps.size, dtype=np.int64)
+    for shift in range(7, 64, 7):
+        num_bytes += gaps >= np.uint64(1 << shift)
+
+    offsets = np.cumsum(num_bytes) - num_bytes
+    encoded_bytes = np.empty(int(num_bytes.sum()), dtype=np.uint8)
+    for i in range(int(num_bytes.max())):
+        mask = num_bytes > i
+        byte_val = (gaps[mask] >> np.uint64(7 * i)) & np.uint64(0x7F)
+        # Set the continuation bit on every byte but the last one of a gap
+        continuation = (num_bytes[mask] > i + 1).astype(np.uint64) << np.uint64(7)
+        encoded_bytes[offsets[mask] + i] = byte_val | continuation
+    return encoded_bytes.tobytes()
+
+
+def decode_postings(encoded_bytes: bytes) -> np.ndarray:
+    stream = np.frombuffer(encoded_bytes, dtype=np.uint8)
+    if stream.size == 0:
+        return np.empty(0, dtype=np.int64)
+
+    # Bytes without the continuation bit terminate a gap
+    is_last = (stream & 0x80) == 0
+    if not is_last[-1]:
+        raise ValueError("Invalid byte alignment")
+
+    gap_index = np.cumsum(is_last) - is_last
+    gap_starts = np.concatenate(([0], np.flatnonzero(is_last)[:-1] + 1))
+    byte_index = np.arange(stream.size) - gap_starts[gap_index]
+    if byte_index.max() > 9:
+        raise ValueError("Posting gap overflows 64 bits")
+
+    parts = (stream & 0x7F).astype(np.uint64) << (7 * byte_index).astype(np.uint64)
+    gaps = np.bitwise_or.reduceat(parts, gap_starts)
+    return np.cumsum(gaps).astype(np.int64)
+
+
+def encode_ngrams(ngrams: Iterable[bytes]) -> bytes:
+    # Length prefixed, sorted n-grams compressed together
+    encoded_bytes = bytearray()
+    for ngram in sorted(ngrams):
+        if len(ngram) > 0xFF:
+            raise ValueError("N-gram too long to encode")
+        encoded_bytes.append(len(ngram))
+        encoded_bytes += ngram
+    return zlib.compress(encoded_bytes)
+
+
+def decode_ngrams(encoded_bytes: bytes) -> set[bytes]:
+    data = zlib.decompress(encoded_bytes)
+    ngrams = set()
+    i = 0
+    while i < len(data):
+        ngram_end = i + 1 + data[i]
+        if ngram_end > len(data):
+            raise ValueError("Invalid n-gram encoding")
+        ngrams.add(data[i + 1 : ngram_end])
+        i = ngram_end
+    return ngrams
@@ -0,0 +1,148 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import AbstractContextManager, contextmanager, nullcontext
+from typing import Iterator
+
+# Upper bounds of the buckets, in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 10, 100, 1000, 10_000, 100_000, 1_000_000)
+# Stage of timings that are disabled
+_UNTIMED = nullcontext()
+
+
+def _format_value(value: float) -> str:
+    return "+Inf" if value == float("inf") else str(value)
+
+
+def _labels(label: str | None, value: str, **extra: str) -> str:
+    pairs = ([(label, value)] if label else []) + list(extra.items())
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}" if pairs else ""
+
+
+class Histogram:
+    """A Prometheus histogram, with an optional single label."""
+
+    def __init__(self, registry: "MetricsRegistry", name: str, documentation: str, buckets, label: str | None):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.label = label
+        # label value -> the count of every bucket (not cumulative, +Inf last) followed by the sum
+        self._series: dict[str, list[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, label_value: str = "") -> None:
+        if not self.registry.enabled:
+            return
+        with self._lock:
+            if (series := self._series.get(label_value)) is None:
+                series = self._series[label_value] = [0] * (len(self.buckets) + 2)
+            series[bisect_left(self.buckets, value)] += 1
+            series[-1] += value
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            series = {value: list(counts) for value, counts in self._series.items()}
+        for value, counts in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts[:-1]):
+                cumulative += count
+                yield f"{self.name}_bucket{_labels(self.label, value, le=_format_value(bound))} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.label, value)} {_format_value(counts[-1])}"
+            yield f"{self.name}_count{_labels(self.label, value)} {cumulative}"
+
+
+class Counter:
+    """A Prometheus counter, with an optional single label."""
+
+    def __init__(self, registry: "MetricsRegistry", name: str, documentation: str, label: str | None):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self._values: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, label_value: str = "") -> None:
+        if not self.registry.enabled:
+            return
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            values = dict(self._values)
+        for value, total in sorted(values.items()):
+            yield f"{self.name}{_labels(self.label, value)} {_format_value(total)}"
+
+
+class MetricsRegistry:
+    """Metrics of the process, rendered in the Prometheus text format.
+
+    Disabling the registry turns every observation into a single attribute check.
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.metrics: list[Histogram | Counter] = []
+
+    def histogram(self, name: str, documentation: str, buckets=LATENCY_BUCKETS, label: str | None = None) -> Histogram:
+        histogram = Histogram(self, name, documentation, buckets, label)
+        self.metrics.append(histogram)
+        return histogram
+
+    def counter(self, name: str, documentation: str, label: str | None = None) -> Counter:
+        counter = Counter(self, name, documentation, label)
+        self.metrics.append(counter)
+        return counter
+
+    def render(self) -> str:
+        return "".join(f"{line}\n" for metric in self.metrics for line in metric.render())
+
+
+METRICS = MetricsRegistry()
+
+
+class Timings:
+    """Seconds spent per stage of a single request or indexing run.
+
+    Stages entered several times, or from several threads, add up. `observe` hands
+    them over to a histogram labelled by stage. Stages are not timed when disabled,
+    by default as long as the metrics are.
+    """
+
+    def __init__(self, enabled: bool | None = None):
+        self.enabled = METRICS.enabled if enabled is None else enabled
+        self.seconds: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+    def get(self, stage: str) -> float:
+        return self.seconds.get(stage, 0.0)
+
+    def stage(self, stage: str) -> AbstractContextManager[None]:
+        return self._timed(stage) if self.enabled else _UNTIMED
+
+    @contextmanager
+    def _timed(self, stage: str) -> Iterator[None]:
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - started_at)
+
+    def observe(self, histogram: Histogram) -> None:
+        for stage, seconds in self.seconds.items():
+            histogram.observe(seconds, stage)
+
+    def to_ms(self) -> dict[str, float]:
+        return {stage: round(seconds * 1000, 3) for stage, seconds in self.seconds.items()}
@@ -0,0 +1,74 @@
+import os
+from typing import NamedTuple
+
+from git import Repo, exc
+
+
+class RepoInfo(NamedTuple):
+    remote_url: str | None
+    branch: str
+
+
+def _web_url(remote: str) -> str:
+    remote = remote.replace("git@github.com:", "https://github.com/")
+    return remote.removesuffix(".git")
+
+
+class RepoRegistry:
+    """The git repositories cloned into `repo_dir`, mapping files back to their web URLs.
+
+    Repositories are only looked up on `refresh`, after which resolving a path
+    costs a dict lookup per directory level.
+    """
+
+    def __init__(self, repo_dir: str):
+        self.repo_dir = os.path.abspath(repo_dir)
+        self.repos: dict[str, RepoInfo] = {}
+        self.refresh()
+
+    @staticmethod
+    def _read_repo(repo_path: str) -> RepoInfo | None:
+        try:
+            repo = Repo(repo_path)
+        except (exc.InvalidGitRepositoryError, exc.NoSuchPathError):
+            return None
+
+        remote_url = _web_url(repo.remotes.origin.url) if "origin" in repo.remotes else None
+        try:
+            branch = repo.active_branch.name
+        except TypeError:
+            # Detached HEAD
+            branch = repo.head.commit.hexsha
+        return RepoInfo(remote_url, branch)
+
+    def refresh(self) -> None:
+        repos = {}
+        if os.path.isdir(self.repo_dir):
+            for entry in os.scandir(self.repo_dir):
+                if entry.is_dir() and (info := self._read_repo(entry.path)):
+                    repos[entry.path] = info
+        self.repos = repos
+
+    def find_repo(self, path: str) -> str | None:
+        root = path
+        while True:
+            if root in self.repos:
+                return root
+            parent = os.path.dirname(root)
+            if parent == root:
+                return None
+            root = parent
+
+    def get_url(self, path: str) -> str | None:
+        """Returns the web URL of a file, its path when it is not in a repo, or `None` for git internals."""
+        root = self.find_repo(path)
+        if root is None:
+            return path
+
+        relative_path = path[len(root) :]
+        if relative_path.startswith("/.git/"):
+            return None
+        info = self.repos[root]
+        if info.remote_url is None:
+            return path
+        return f"{info.remote_url}/blob/{info.branch}{relative_path}"
@@ -1,10 +1,132 @@
+import asyncio
+import os
+from typing import Iterable
+
+import numpy as np
+from redis.asyncio import BlockingConnectionPool
+from redis.asyncio import Redis as AsyncRedis
+from redis.client import Redis
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.ext.asyncio import create_async_engine
 from sqlmodel import Session, create_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from saku.core.config import SakuConfig
+from saku.db.models import Document
+from saku.db.postings import AsyncRedisPostingReader, PostingStore, RedisPostingStore
+from saku.db.segments import SegmentPostingStore
+
+
+def _prepare_sqlite(database_uri: str) -> None:
+    database = make_url(database_uri).database
+    if database and database != ":memory:":
+        os.makedirs(os.path.dirname(os.path.abspath(database)), exist_ok=True)
+
+
+def _set_sqlite_pragmas(dbapi_connection, _) -> None:
+    # Searches keep reading while the indexer writes, and writers wait on each other instead of failing
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=30000")
+    cursor.close()
+
+
+def _configure_engine(engine: Engine) -> None:
+    if engine.dialect.name == "sqlite":
+        event.listen(engine, "connect", _set_sqlite_pragmas)
 
 
 class DbConnector:
     def __init__(self, database_uri: str):
+        if database_uri.startswith("sqlite"):
+            _prepare_sqlite(database_uri)
         self.engine = create_engine(database_uri)
+        _configure_engine(self.engine)
 
     def get_session(self) -> Session:
         session = Session(bind=self.engine)
         return session
+
+    def upsert_documents(self, rows: list[dict]) -> list[Document]:
+        """Insert documents in bulk, updating the metadata of paths already tracked, and return them with their ids."""
+        if not rows:
+            return []
+
+        insert = postgresql.insert if self.engine.dialect.name == "postgresql" else sqlite.insert
+        stmt = insert(Document.__table__)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Document.path],
+            set_={column: stmt.excluded[column] for column in ("size", "mime_type", "last_modified")},
+        )
+
+        with self.get_session() as session:
+            # A single cached statement run through executemany, batched into multi row inserts by the driver
+            session.execute(stmt, rows)
+            session.commit()
+            return session.query(Document).filter(Document.path.in_([row["path"] for row in rows])).all()
+
+
+class AsyncDbConnector:
+    """Sessions over an asyncio driver, pooling up to `pool_size + max_overflow` connections."""
+
+    def __init__(self, database_uri: str, pool_size: int = 10, max_overflow: int = 20):
+        pool_options = {"pool_size": pool_size, "max_overflow": max_overflow}
+        if database_uri.startswith("sqlite"):
+            # SQLite connections are not pooled by size
+            pool_options = {}
+            _prepare_sqlite(database_uri)
+        self.engine = create_async_engine(database_uri, **pool_options)
+        _configure_engine(self.engine.sync_engine)
+
+    def get_session(self) -> AsyncSession:
+        return AsyncSession(bind=self.engine)
+
+    async def close(self) -> None:
+        await self.engine.dispose()
+
+
+class ThreadedPostingReader:
+    """Async reads of a blocking posting store, run on the default thread pool."""
+
+    def __init__(self, postings: PostingStore):
+        self.postings = postings
+
+    async def get(self, ngrams: Iterable[bytes]) -> dict[bytes, np.ndarray]:
+        return await asyncio.to_thread(self.postings.get, list(ngrams))
+
+    async def get_lines(self, ngrams: Iterable[bytes]) -> dict[bytes, np.ndarray]:
+        return await asyncio.to_thread(self.postings.get_lines, list(ngrams))
+
+    async def tombstones(self) -> np.ndarray:
+        return await asyncio.to_thread(self.postings.tombstones)
+
+    async def num_documents(self) -> int:
+        return await asyncio.to_thread(self.postings.num_documents)
+
+    async def frequencies(self, ngrams: Iterable[bytes]) -> dict[bytes, int]:
+        return await asyncio.to_thread(self.postings.frequencies, list(ngrams))
+
+    async def close(self) -> None:
+        pass
+
+
+def create_posting_store(config: SakuConfig, background_merge: bool = False) -> PostingStore:
+    if config.POSTING_STORE == "segments":
+        return SegmentPostingStore(config.SEGMENTS_DIR, config.SEGMENT_MERGE_FACTOR, background_merge)
+    return RedisPostingStore(Redis(host=config.REDIS_HOST, port=config.REDIS_PORT, db=config.REDIS_DB))
+
+
+def create_async_posting_reader(
+    config: SakuConfig, postings: PostingStore
+) -> AsyncRedisPostingReader | ThreadedPostingReader:
+    """An async reader of the same postings as the given store."""
+    if isinstance(postings, SegmentPostingStore):
+        return ThreadedPostingReader(postings)
+    # Requests wait for a free connection rather than fail once the pool is exhausted
+    pool = BlockingConnectionPool(
+        host=config.REDIS_HOST, port=config.REDIS_PORT, db=config.REDIS_DB, max_connections=config.REDIS_POOL_SIZE
+    )
+    return AsyncRedisPostingReader(AsyncRedis(connection_pool=pool))
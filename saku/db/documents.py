@@ -0,0 +1,203 @@
+import re
+import threading
+import time
+from datetime import datetime
+from typing import Iterable
+
+import numpy as np
+from sqlmodel import select
+
+from saku.db.connector import DbConnector
+from saku.db.models import Document
+
+# Blob id of the documents whose content is not indexed
+NO_BLOB = -1
+# No. of documents read from the database per query
+READ_CHUNK_SIZE = 1000
+# No. of path regexes whose matches are kept
+PATH_CACHE_SIZE = 64
+
+DocumentRow = tuple[int, str, int, datetime, int | None]
+
+
+def _matches(pattern: re.Pattern, paths: np.ndarray) -> np.ndarray:
+    return np.fromiter((pattern.search(path) is not None for path in paths), dtype=bool, count=len(paths))
+
+
+class DocumentColumns:
+    """An immutable version of the document metadata, one array per column, latest modified first."""
+
+    def __init__(
+        self,
+        ids: np.ndarray,
+        paths: np.ndarray,
+        sizes: np.ndarray,
+        modified: np.ndarray,
+        blob_ids: np.ndarray,
+        path_cache: dict[str, np.ndarray] | None = None,
+    ):
+        self.ids = ids
+        self.paths = paths
+        self.sizes = sizes
+        # Negated modification times, so that the rows are in ascending order
+        self.modified = modified
+        self.blob_ids = blob_ids
+        # Rows sorted by blob id, built on the first lookup of candidate blobs
+        self._blob_order: tuple[np.ndarray, np.ndarray] | None = None
+        # Row of every path, built on the first lookup of modification times
+        self._path_rows: dict[str, int] | None = None
+        self._path_cache = path_cache or {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_rows(cls, rows: list[DocumentRow]) -> "DocumentColumns":
+        modified = np.array([-row[3].timestamp() for row in rows], dtype=np.float64)
+        order = np.argsort(modified, kind="stable")
+        return cls(
+            np.array([row[0] for row in rows], dtype=np.int64)[order],
+            np.array([row[1] for row in rows], dtype=object)[order],
+            np.array([row[2] for row in rows], dtype=np.int64)[order],
+            modified[order],
+            np.array([NO_BLOB if row[4] is None else row[4] for row in rows], dtype=np.int64)[order],
+        )
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def replace(self, doc_ids: np.ndarray, rows: list[DocumentRow]) -> "DocumentColumns":
+        """A new version without the given documents, to which the given rows are added."""
+        keep = ~np.isin(self.ids, doc_ids)
+        added = DocumentColumns.from_rows(rows)
+        positions = np.searchsorted(self.modified[keep], added.modified, side="right")
+
+        # Matched paths carry over, only the added rows are matched
+        with self._lock:
+            cached = list(self._path_cache.items())
+        path_cache = {
+            path_like: np.insert(matches[keep], positions, _matches(re.compile(path_like), added.paths))
+            for path_like, matches in cached
+        }
+        columns = [
+            np.insert(column[keep], positions, added_column)
+            for column, added_column in zip(
+                (self.ids, self.paths, self.sizes, self.modified, self.blob_ids),
+                (added.ids, added.paths, added.sizes, added.modified, added.blob_ids),
+            )
+        ]
+        return DocumentColumns(*columns, path_cache=path_cache)
+
+    def _rows_of_blobs(self, blob_ids: np.ndarray) -> np.ndarray:
+        if self._blob_order is None:
+            order = np.argsort(self.blob_ids, kind="stable")
+            self._blob_order = order, self.blob_ids[order]
+        order, sorted_blob_ids = self._blob_order
+
+        starts = np.searchsorted(sorted_blob_ids, blob_ids, side="left")
+        counts = np.searchsorted(sorted_blob_ids, blob_ids, side="right") - starts
+        # Expand every [start, start + count) range of documents having the blob
+        offsets = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        return np.sort(order[offsets])
+
+    def last_modified(self, paths: Iterable[str]) -> dict[str, float]:
+        """Modification timestamps of the tracked documents among the given paths."""
+        if self._path_rows is None:
+            self._path_rows = {path: row for row, path in enumerate(self.paths.tolist())}
+        rows = self._path_rows
+        return {path: -float(self.modified[rows[path]]) for path in paths if path in rows}
+
+    def path_matches(self, path_like: str) -> np.ndarray:
+        with self._lock:
+            matches = self._path_cache.get(path_like)
+        if matches is None:
+            matches = _matches(re.compile(path_like), self.paths)
+            with self._lock:
+                if len(self._path_cache) >= PATH_CACHE_SIZE:
+                    del self._path_cache[next(iter(self._path_cache))]
+                self._path_cache[path_like] = matches
+        return matches
+
+    def candidates(
+        self, blob_ids: Iterable[int] | None, size_lt: int | None, size_gt: int | None, path_like: str | None
+    ) -> list[tuple[str, int | None]]:
+        """Paths & blob ids of the documents having any of the blobs (all of them if `None`), latest modified first."""
+        if blob_ids is None:
+            rows = np.arange(len(self))
+        else:
+            rows = self._rows_of_blobs(np.fromiter(blob_ids, dtype=np.int64))
+
+        if size_gt is not None and size_gt > 0:
+            rows = rows[self.sizes[rows] >= size_gt]
+        if size_lt is not None and size_lt > 0:
+            rows = rows[self.sizes[rows] <= size_lt]
+        if path_like:
+            rows = rows[self.path_matches(path_like)[rows]]
+
+        paths, blob_ids = self.paths[rows].tolist(), self.blob_ids[rows].tolist()
+        return [(path, None if blob_id == NO_BLOB else blob_id) for path, blob_id in zip(paths, blob_ids)]
+
+
+class DocumentTable:
+    """The metadata of every tracked document held in memory, to filter & order candidates without the database.
+
+    Searches read the current `DocumentColumns`, which writers replace. The indexer of the same process
+    syncs the documents it changes right away. Those changed by other processes (the CLI, or indexers of
+    other shards) are picked up by reloading the table in the background, once it is `max_age` seconds old.
+    """
+
+    def __init__(self, db: DbConnector, max_age: float):
+        self.db = db
+        self.max_age = max_age
+        self.columns = DocumentColumns.from_rows([])
+        self.loaded_at: float | None = None
+        # Held by writers only
+        self._lock = threading.Lock()
+
+    def _read(self, doc_ids: list[int] | None = None) -> list[DocumentRow]:
+        query = select(Document.id, Document.path, Document.size, Document.last_modified, Document.blob_id)
+        with self.db.get_session() as session:
+            if doc_ids is None:
+                return session.exec(query).all()
+            rows = []
+            for i in range(0, len(doc_ids), READ_CHUNK_SIZE):
+                rows.extend(session.exec(query.where(Document.id.in_(doc_ids[i : i + READ_CHUNK_SIZE]))).all())
+            return rows
+
+    def load(self) -> None:
+        with self._lock:
+            self._load()
+
+    def _load(self) -> None:
+        loaded_at = time.monotonic()
+        self.columns = DocumentColumns.from_rows(self._read())
+        self.loaded_at = loaded_at
+
+    def _reload(self) -> None:
+        # Started with the lock acquired on behalf of this thread
+        try:
+            self._load()
+        finally:
+            self._lock.release()
+
+    def sync(self, doc_ids: Iterable[int]) -> None:
+        """Re-reads the given documents, dropping those no longer tracked."""
+        doc_ids = list(doc_ids)
+        if not doc_ids:
+            return
+        with self._lock:
+            self.columns = self.columns.replace(np.array(doc_ids, dtype=np.int64), self._read(doc_ids))
+
+    def current(self) -> DocumentColumns:
+        """The latest columns, reloading them in the background when they got too old."""
+        if self.loaded_at is None:
+            self.load()
+        elif time.monotonic() - self.loaded_at > self.max_age and self._lock.acquire(blocking=False):
+            threading.Thread(target=self._reload, name="documents-reload", daemon=True).start()
+        return self.columns
+
+    def candidates(
+        self, blob_ids: Iterable[int] | None, size_lt: int | None, size_gt: int | None, path_like: str | None
+    ) -> list[tuple[str, int | None]]:
+        return self.current().candidates(blob_ids, size_lt, size_gt, path_like)
+
+    def last_modified(self, paths: Iterable[str]) -> dict[str, float]:
+        return self.current().last_modified(paths)
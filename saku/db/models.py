@@ -4,6 +4,18 @@ from typing import Optional
 from sqlmodel import Field, SQLModel
 
 
+class Blob(SQLModel, table=True):
+    # Never reuse the ids of dropped blobs, they may still be tombstoned in the postings
+    __table_args__ = {"sqlite_autoincrement": True}
+
+    # Postings refer to blobs, so that identical files are only indexed once
+    id: Optional[int] = Field(default=None, primary_key=True)
+    # Git blob SHA-1 of the content
+    sha: str = Field(unique=True, index=True)
+    size: int
+    last_indexed: Optional[datetime] = None
+
+
 class Document(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     path: str = Field(unique=True)
@@ -11,11 +23,19 @@ class Document(SQLModel, table=True):
     mime_type: str
     last_modified: datetime
     last_indexed: Optional[datetime] = None
+    blob_id: Optional[int] = Field(default=None, foreign_key="blob.id", index=True)
+
+
+class IndexedRepo(SQLModel, table=True):
+    path: str = Field(primary_key=True)
+    # HEAD commit of the repository when it was last indexed
+    commit: str
+    indexed_at: datetime
 
 
 class IndexNGram(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
-    ngram: str = Field(unique=True, index=True)
+    ngram: bytes = Field(unique=True, index=True)
     doc_ids: Optional[bytes] = None
     last_updated: Optional[datetime] = None
 
@@ -0,0 +1,292 @@
+from typing import Iterable, Protocol
+
+import numpy as np
+from redis.asyncio import Redis as AsyncRedis
+from redis.client import Redis
+from redis.exceptions import WatchError
+
+from saku.core.encoding import decode_postings, encode_postings
+from saku.index.postings import EMPTY_POSTINGS, LINE_OFFSET_BITS
+
+ADDED = b"+"
+REMOVED = b"-"
+
+
+def apply_chunks(chunks: list[bytes]) -> np.ndarray:
+    # Replay the added & removed chunks of a posting list in the order they were written
+    postings = EMPTY_POSTINGS
+    for chk in chunks:
+        doc_ids = decode_postings(chk[1:])
+        if chk[:1] == REMOVED:
+            postings = np.setdiff1d(postings, doc_ids, assume_unique=True)
+        elif len(postings):
+            postings = np.union1d(postings, doc_ids)
+        else:
+            postings = doc_ids
+    return postings
+
+
+def drop_tombstoned(postings: np.ndarray, tombstones: np.ndarray, lines: bool = False) -> np.ndarray:
+    # Line postings carry their blob id in the high bits
+    if lines:
+        return postings[~np.isin(postings >> LINE_OFFSET_BITS, tombstones)]
+    return np.setdiff1d(postings, tombstones, assume_unique=True)
+
+
+def _frequencies(ngrams: list[bytes], scores: list[float | None], stopped: list[int]) -> dict[bytes, int]:
+    return {ngram: int(score or 0) for ngram, score, stop in zip(ngrams, scores, stopped) if not stop}
+
+
+class PostingStore(Protocol):
+    """Posting lists of the indexed n-grams, keyed by blob ids.
+
+    Deleted blobs are tombstoned, readers filter them out until a compaction drops them for good.
+    The document frequency of every n-gram is kept alongside its posting list. Frequencies still
+    count tombstoned & re-added blobs, and are exact again after a compaction. Stop grams are
+    posted for too many blobs to be worth indexing, they have no posting list nor frequency.
+    Line postings are kept in a namespace of their own, without frequencies, and are only ever
+    added: those of deleted blobs are dropped along with them during a compaction.
+    """
+
+    def add(self, postings: dict[bytes, list[int]]) -> None:
+        ...
+
+    def add_lines(self, postings: dict[bytes, list[int]]) -> None:
+        ...
+
+    def remove(self, postings: dict[bytes, list[int]]) -> None:
+        ...
+
+    def update(self, added: dict[bytes, list[int]], removed: dict[bytes, list[int]], new_blobs: int = 0) -> None:
+        ...
+
+    def get(self, ngrams: Iterable[bytes]) -> dict[bytes, np.ndarray]:
+        ...
+
+    def get_lines(self, ngrams: Iterable[bytes]) -> dict[bytes, np.ndarray]:
+        ...
+
+    def delete_documents(self, doc_ids: list[int]) -> None:
+        ...
+
+    def tombstones(self) -> np.ndarray:
+        ...
+
+    def pending_compaction(self) -> int:
+        ...
+
+    def compact(self) -> None:
+        ...
+
+    def num_documents(self) -> int:
+        ...
+
+    def frequencies(self, ngrams: Iterable[bytes]) -> dict[bytes, int]:
+        ...
+
+    def frequent_grams(self, min_frequency: int) -> dict[bytes, int]:
+        ...
+
+    def stop_grams(self) -> set[bytes]:
+        ...
+
+    def add_stop_grams(self, ngrams: Iterable[bytes]) -> None:
+        ...
+
+
+class RedisPostingStore:
+    """Posting lists stored in Redis as lists of compressed chunks.
+
+    Every indexed batch appends one sorted, delta-encoded chunk per n-gram with
+    `RPUSH`, which keeps concurrent writers safe without read-modify-write.
+    Chunks either add doc ids to or remove them from the posting list.
+    Deleted documents are only tombstoned, and dropped from the posting lists
+    during compaction. Document frequencies are kept in a sorted set, which
+    needs Redis 6.2 or later.
+    """
+
+    KEY_PREFIX = b"pl:"
+    LINE_KEY_PREFIX = b"ll:"
+    TOMBSTONES_KEY = b"tombstones"
+    PENDING_COMPACTION_KEY = b"compaction:pending"
+    FREQUENCIES_KEY = b"stats:frequencies"
+    NUM_DOCUMENTS_KEY = b"stats:documents"
+    STOP_GRAMS_KEY = b"stats:stop_grams"
+
+    def __init__(self, redis: Redis):
+        self.redis = redis
+
+    def _key(self, ngram: bytes) -> bytes:
+        return self.KEY_PREFIX + ngram
+
+    def _push(self, postings: dict[bytes, list[int]], op: bytes) -> None:
+        sign = -1 if op == REMOVED else 1
+        pipe = self.redis.pipeline(transaction=False)
+        for ngram, doc_ids in postings.items():
+            doc_ids = np.unique(doc_ids)
+            pipe.rpush(self._key(ngram), op + encode_postings(doc_ids))
+            pipe.zincrby(self.FREQUENCIES_KEY, sign * len(doc_ids), ngram)
+        pipe.execute()
+
+    def add(self, postings: dict[bytes, list[int]]) -> None:
+        self._push(postings, ADDED)
+
+    def add_lines(self, postings: dict[bytes, list[int]]) -> None:
+        pipe = self.redis.pipeline(transaction=False)
+        for ngram, lines in postings.items():
+            pipe.rpush(self.LINE_KEY_PREFIX + ngram, ADDED + encode_postings(np.unique(lines)))
+        pipe.execute()
+
+    def remove(self, postings: dict[bytes, list[int]]) -> None:
+        if not postings:
+            return
+        self._push(postings, REMOVED)
+        self.redis.incrby(self.PENDING_COMPACTION_KEY, sum(map(len, postings.values())))
+
+    def update(self, added: dict[bytes, list[int]], removed: dict[bytes, list[int]], new_blobs: int = 0) -> None:
+        self.add(added)
+        self.remove(removed)
+        if new_blobs:
+            self.redis.incrby(self.NUM_DOCUMENTS_KEY, new_blobs)
+
+    def _get(self, prefix: bytes, ngrams: Iterable[bytes]) -> dict[bytes, np.ndarray]:
+        ngrams = list(ngrams)
+        pipe = self.redis.pipeline(transaction=False)
+        for ngram in ngrams:
+            pipe.lrange(prefix + ngram, 0, -1)
+        return {ngram: apply_chunks(chunks) for ngram, chunks in zip(ngrams, pipe.execute())}
+
+    def get(self, ngrams: Iterable[bytes]) -> dict[bytes, np.ndarray]:
+        return self._get(self.KEY_PREFIX, ngrams)
+
+    def get_lines(self, ngrams: Iterable[bytes]) -> dict[bytes, np.ndarray]:
+        return self._get(self.LINE_KEY_PREFIX, ngrams)
+
+    def delete_documents(self, doc_ids: list[int]) -> None:
+        if not doc_ids:
+            return
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.sadd(self.TOMBSTONES_KEY, *doc_ids)
+        pipe.incrby(self.PENDING_COMPACTION_KEY, len(doc_ids))
+        pipe.decrby(self.NUM_DOCUMENTS_KEY, len(doc_ids))
+        pipe.execute()
+
+    def tombstones(self) -> np.ndarray:
+        members = self.redis.smembers(self.TOMBSTONES_KEY)
+        return np.sort(np.array([int(doc_id) for doc_id in members], dtype=np.int64))
+
+    def pending_compaction(self) -> int:
+        return int(self.redis.get(self.PENDING_COMPACTION_KEY) or 0)
+
+    def compact(self) -> None:
+        """Rewrite every posting list as a single chunk without the tombstoned documents."""
+        pending = self.pending_compaction()
+        tombstones = self.tombstones()
+
+        for key in self.redis.scan_iter(match=self.KEY_PREFIX + b"*", count=1000):
+            self._compact_key(key, tombstones)
+        if len(tombstones):
+            for key in self.redis.scan_iter(match=self.LINE_KEY_PREFIX + b"*", count=1000):
+                self._compact_key(key, tombstones, lines=True)
+
+        pipe = self.redis.pipeline(transaction=False)
+        if len(tombstones):
+            pipe.srem(self.TOMBSTONES_KEY, *tombstones.tolist())
+        # Changes made while compacting stay pending
+        pipe.decrby(self.PENDING_COMPACTION_KEY, pending)
+        pipe.execute()
+
+    def _compact_key(self, key: bytes, tombstones: np.ndarray, lines: bool = False) -> None:
+        with self.redis.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(key)
+                    chunks = pipe.lrange(key, 0, -1)
+                    ngram = key[len(self.KEY_PREFIX) :]
+                    postings = drop_tombstoned(apply_chunks(chunks), tombstones, lines)
+
+                    pipe.multi()
+                    pipe.delete(key)
+                    if len(postings):
+                        pipe.rpush(key, ADDED + encode_postings(postings))
+                    # Line postings have no frequencies
+                    if not lines and len(postings):
+                        pipe.zadd(self.FREQUENCIES_KEY, {ngram: len(postings)})
+                    elif not lines:
+                        pipe.zrem(self.FREQUENCIES_KEY, ngram)
+                    pipe.execute()
+                    return
+                except WatchError:
+                    # Written to while compacting, try again
+                    continue
+
+    def num_documents(self) -> int:
+        return int(self.redis.get(self.NUM_DOCUMENTS_KEY) or 0)
+
+    def frequencies(self, ngrams: Iterable[bytes]) -> dict[bytes, int]:
+        """No. of blobs posted per n-gram, leaving out stop grams."""
+        ngrams = list(ngrams)
+        if not ngrams:
+            return {}
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zmscore(self.FREQUENCIES_KEY, ngrams)
+        pipe.smismember(self.STOP_GRAMS_KEY, ngrams)
+        return _frequencies(ngrams, *pipe.execute())
+
+    def frequent_grams(self, min_frequency: int) -> dict[bytes, int]:
+        grams = self.redis.zrangebyscore(self.FREQUENCIES_KEY, min_frequency, "+inf", withscores=True)
+        return {ngram: int(frequency) for ngram, frequency in grams}
+
+    def stop_grams(self) -> set[bytes]:
+        return self.redis.smembers(self.STOP_GRAMS_KEY)
+
+    def add_stop_grams(self, ngrams: Iterable[bytes]) -> None:
+        """Stops posting the n-grams, dropping their posting lists & line postings."""
+        ngrams = list(ngrams)
+        if not ngrams:
+            return
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.sadd(self.STOP_GRAMS_KEY, *ngrams)
+        pipe.delete(*map(self._key, ngrams), *(self.LINE_KEY_PREFIX + ngram for ngram in ngrams))
+        pipe.zrem(self.FREQUENCIES_KEY, *ngrams)
+        pipe.execute()
+
+
+class AsyncRedisPostingReader:
+    """The read side of `RedisPostingStore` over `redis.asyncio`, for serving queries."""
+
+    def __init__(self, redis: AsyncRedis):
+        self.redis = redis
+
+    async def _get(self, prefix: bytes, ngrams: Iterable[bytes]) -> dict[bytes, np.ndarray]:
+        ngrams = list(ngrams)
+        pipe = self.redis.pipeline(transaction=False)
+        for ngram in ngrams:
+            pipe.lrange(prefix + ngram, 0, -1)
+        return {ngram: apply_chunks(chunks) for ngram, chunks in zip(ngrams, await pipe.execute())}
+
+    async def get(self, ngrams: Iterable[bytes]) -> dict[bytes, np.ndarray]:
+        return await self._get(RedisPostingStore.KEY_PREFIX, ngrams)
+
+    async def get_lines(self, ngrams: Iterable[bytes]) -> dict[bytes, np.ndarray]:
+        return await self._get(RedisPostingStore.LINE_KEY_PREFIX, ngrams)
+
+    async def tombstones(self) -> np.ndarray:
+        members = await self.redis.smembers(RedisPostingStore.TOMBSTONES_KEY)
+        return np.sort(np.array([int(doc_id) for doc_id in members], dtype=np.int64))
+
+    async def num_documents(self) -> int:
+        return int(await self.redis.get(RedisPostingStore.NUM_DOCUMENTS_KEY) or 0)
+
+    async def frequencies(self, ngrams: Iterable[bytes]) -> dict[bytes, int]:
+        ngrams = list(ngrams)
+        if not ngrams:
+            return {}
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zmscore(RedisPostingStore.FREQUENCIES_KEY, ngrams)
+        pipe.smismember(RedisPostingStore.STOP_GRAMS_KEY, ngrams)
+        return _frequencies(ngrams, *await pipe.execute())
+
+    async def close(self) -> None:
+        await self.redis.close()
+        await self.redis.connection_pool.disconnect()
@@ -0,0 +1,483 @@
+import atexit
+import fcntl
+import heapq
+import logging
+import math
+import mmap
+import os
+import struct
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from itertools import groupby
+from typing import Iterable, Iterator
+
+import numpy as np
+
+from saku.core.config import ONE_MB
+from saku.core.encoding import decode_ngrams, decode_postings, encode_ngrams, encode_postings
+from saku.db.postings import ADDED, REMOVED, apply_chunks, drop_tombstoned
+from saku.index.postings import EMPTY_POSTINGS
+
+SEGMENT_MAGIC = b"SAKUSEG2"
+SEGMENT_SUFFIX = ".seg"
+TEMP_SUFFIX = ".tmp"
+LOCK_SUFFIX = ".lock"
+# Magic, no. of grams, no. of removed postings, no. of blobs added, positions of the gram blob,
+# gram offsets, chunk offsets & frequencies
+FOOTER = struct.Struct("<8sQQqQQQQ")
+
+# Segments smaller than this are all in the first merge tier
+MIN_MERGE_TIER_SIZE = ONE_MB
+
+LOG = logging
+
+
+class SegmentWriter:
+    """Streams a segment to disk, n-grams must be appended in sorted order.
+
+    Layout: magic | chunks | gram blob | gram offsets | chunk offsets | frequencies | footer
+    Every n-gram owns an added chunk followed by a removed chunk, either of which may be empty,
+    and the no. of blobs they add to its document frequency.
+    """
+
+    def __init__(self, path: str, num_documents: int = 0):
+        self._fp = open(path, "wb")
+        self._fp.write(SEGMENT_MAGIC)
+        self._position = len(SEGMENT_MAGIC)
+        self._grams = bytearray()
+        self._gram_offsets = [0]
+        self._chunk_offsets = [self._position]
+        self._frequencies = []
+        self._num_removed = 0
+        self._num_documents = num_documents
+
+    def _write(self, data: bytes) -> None:
+        self._fp.write(data)
+        self._position += len(data)
+        self._chunk_offsets.append(self._position)
+
+    def append(
+        self, ngram: bytes, added_chunk: bytes, removed_chunk: bytes = b"", frequency: int = 0, num_removed: int = 0
+    ) -> None:
+        self._grams += ngram
+        self._gram_offsets.append(len(self._grams))
+        self._write(added_chunk)
+        self._write(removed_chunk)
+        self._frequencies.append(frequency)
+        self._num_removed += num_removed
+
+    def close(self) -> None:
+        gram_blob_pos = self._position
+        self._fp.write(self._grams)
+        gram_offsets_pos = gram_blob_pos + len(self._grams)
+        gram_offsets = np.array(self._gram_offsets, dtype="<u8").tobytes()
+        self._fp.write(gram_offsets)
+        chunk_offsets_pos = gram_offsets_pos + len(gram_offsets)
+        chunk_offsets = np.array(self._chunk_offsets, dtype="<u8").tobytes()
+        self._fp.write(chunk_offsets)
+        frequencies_pos = chunk_offsets_pos + len(chunk_offsets)
+        self._fp.write(np.array(self._frequencies, dtype="<i8").tobytes())
+
+        num_grams = len(self._gram_offsets) - 1
+        footer = (
+            SEGMENT_MAGIC,
+            num_grams,
+            self._num_removed,
+            self._num_documents,
+            gram_blob_pos,
+            gram_offsets_pos,
+            chunk_offsets_pos,
+            frequencies_pos,
+        )
+        self._fp.write(FOOTER.pack(*footer))
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+        self._fp.close()
+
+
+class Segment:
+    """Read only, memory mapped segment. Posting chunks are served without copying."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as fp:
+            self._buffer = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._buffer)
+
+        footer = FOOTER.unpack_from(self._buffer, len(self._buffer) - FOOTER.size)
+        magic, self.num_grams, self.num_removed, self.num_documents, gram_blob_pos, *positions = footer
+        if magic != SEGMENT_MAGIC or self._buffer[: len(SEGMENT_MAGIC)] != SEGMENT_MAGIC:
+            raise ValueError(f"Invalid segment, re-index to upgrade older ones: {path}")
+
+        gram_offsets_pos, chunk_offsets_pos, frequencies_pos = positions
+        self._gram_blob_pos = gram_blob_pos
+        self._gram_offsets = np.frombuffer(self._buffer, "<u8", self.num_grams + 1, gram_offsets_pos)
+        self._chunk_offsets = np.frombuffer(self._buffer, "<u8", 2 * self.num_grams + 1, chunk_offsets_pos)
+        self.frequencies = np.frombuffer(self._buffer, "<i8", self.num_grams, frequencies_pos)
+
+    @property
+    def size(self) -> int:
+        return len(self._buffer)
+
+    def __len__(self) -> int:
+        return self.num_grams
+
+    def __getitem__(self, i: int) -> bytes:
+        start = self._gram_blob_pos + int(self._gram_offsets[i])
+        end = self._gram_blob_pos + int(self._gram_offsets[i + 1])
+        return self._buffer[start:end]
+
+    def find(self, ngram: bytes) -> int | None:
+        i = bisect_left(self, ngram)
+        return i if i < self.num_grams and self[i] == ngram else None
+
+    def chunks(self, i: int) -> tuple[memoryview, memoryview]:
+        added_start, removed_start, removed_end = map(int, self._chunk_offsets[2 * i : 2 * i + 3])
+        return self._view[added_start:removed_start], self._view[removed_start:removed_end]
+
+    def __iter__(self) -> Iterator[bytes]:
+        return (self[i] for i in range(self.num_grams))
+
+
+def _merge_chunks(chunks: list[tuple[memoryview, memoryview]]) -> tuple[np.ndarray, np.ndarray]:
+    # Fold consecutive (added, removed) chunks into a single equivalent pair
+    added, removed = EMPTY_POSTINGS, EMPTY_POSTINGS
+    for added_chunk, removed_chunk in chunks:
+        chunk_added = decode_postings(added_chunk[1:]) if len(added_chunk) else EMPTY_POSTINGS
+        chunk_removed = decode_postings(removed_chunk[1:]) if len(removed_chunk) else EMPTY_POSTINGS
+        added = np.union1d(np.setdiff1d(added, chunk_removed, assume_unique=True), chunk_added)
+        removed = np.setdiff1d(np.union1d(removed, chunk_removed), chunk_added, assume_unique=True)
+    return added, removed
+
+
+class SegmentMerger(threading.Thread):
+    def __init__(self, store: "SegmentPostingStore"):
+        super().__init__(name="segment-merger", daemon=True)
+        self._store = store
+        self._wakeup = threading.Event()
+        self._stopped = False
+
+    def notify(self) -> None:
+        self._wakeup.set()
+
+    def run(self) -> None:
+        while not self._stopped:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            if self._stopped:
+                continue
+            try:
+                self._store.merge_small_segments()
+            except Exception:
+                # Retried on the next write
+                LOG.exception(f"Merging segments in {self._store.segments_dir} failed")
+
+    def close(self) -> None:
+        # Lets an ongoing merge finish
+        self._stopped = True
+        self._wakeup.set()
+        self.join()
+
+
+class SegmentPostingStore:
+    """Posting lists stored in immutable, memory mapped segment files.
+
+    Every written batch becomes a new segment holding a sorted n-gram dictionary
+    and the compressed posting chunks of each n-gram. Posting lists are rebuilt
+    by replaying the chunks of all segments from oldest to newest. Runs of
+    similarly sized segments are merged in the background, and a compaction
+    rewrites everything into a single segment without tombstoned documents.
+    Line postings are kept in a nested store, compacted along with this one.
+    Writers of every process sharing the directory take its lock files.
+    """
+
+    TOMBSTONES_FILE = "tombstones"
+    STOP_GRAMS_FILE = "stop_grams"
+    LINES_DIR = "lines"
+
+    def __init__(
+        self, segments_dir: str, merge_factor: int = 10, background_merge: bool = False, line_postings: bool = False
+    ):
+        self.segments_dir = segments_dir
+        self.merge_factor = merge_factor
+        self.line_postings = line_postings
+        os.makedirs(segments_dir, exist_ok=True)
+
+        self._write_lock = threading.Lock()
+        self._merge_lock = threading.Lock()
+        self._open: dict[str, tuple[int, Segment]] = {}
+        self._stop_grams: tuple[int, set[bytes]] = (0, set())
+
+        self._merger = None
+        if background_merge:
+            # Temp files only exist while their lock is held, so the unlocked ones are leftovers of interrupted writes
+            with self._locked(self._merge_lock, "merge"), self._locked(self._write_lock, "write"):
+                for name in os.listdir(segments_dir):
+                    if name.endswith(TEMP_SUFFIX):
+                        os.remove(os.path.join(segments_dir, name))
+            self._merger = SegmentMerger(self)
+            self._merger.start()
+            atexit.register(self.close)
+
+        self._lines = None
+        if not line_postings:
+            lines_dir = os.path.join(segments_dir, self.LINES_DIR)
+            self._lines = SegmentPostingStore(lines_dir, merge_factor, background_merge, line_postings=True)
+
+    def close(self) -> None:
+        if self._merger is not None:
+            self._merger.close()
+            self._merger = None
+        if self._lines is not None:
+            self._lines.close()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.segments_dir, name)
+
+    @contextmanager
+    def _locked(self, lock: threading.Lock, name: str) -> Iterator[None]:
+        """Holds the lock across threads & the lock file across processes writing to the same directory."""
+        with lock, open(self._path(name + LOCK_SUFFIX), "wb") as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            yield
+
+    def _segment_names(self) -> list[str]:
+        return sorted(name for name in os.listdir(self.segments_dir) if name.endswith(SEGMENT_SUFFIX))
+
+    def segments(self) -> list[Segment]:
+        """Currently live segments, oldest first."""
+        while True:
+            try:
+                names = self._segment_names()
+                opened = {}
+                for name in names:
+                    inode = os.stat(self._path(name)).st_ino
+                    cached = self._open.get(name)
+                    opened[name] = cached if cached and cached[0] == inode else (inode, Segment(self._path(name)))
+            except FileNotFoundError:
+                # Merged away while listing
+                continue
+
+            self._open = opened
+            return [segment for _, segment in opened.values()]
+
+    def _write_segment(
+        self, path: str, ngrams: Iterable[tuple[bytes, bytes, bytes, int, int]], num_documents: int
+    ) -> None:
+        temp_path = path + TEMP_SUFFIX
+        writer = SegmentWriter(temp_path, num_documents)
+        for ngram, added_chunk, removed_chunk, frequency, num_removed in ngrams:
+            writer.append(ngram, added_chunk, removed_chunk, frequency, num_removed)
+        writer.close()
+        os.replace(temp_path, path)
+
+    def update(self, added: dict[bytes, list[int]], removed: dict[bytes, list[int]], new_blobs: int = 0) -> None:
+        if not added and not removed and not new_blobs:
+            return
+
+        def encoded_ngrams():
+            for ngram in sorted(added.keys() | removed.keys()):
+                added_ids = np.unique(added.get(ngram, []))
+                removed_ids = np.unique(removed.get(ngram, []))
+                added_chunk = ADDED + encode_postings(added_ids) if len(added_ids) else b""
+                removed_chunk = REMOVED + encode_postings(removed_ids) if len(removed_ids) else b""
+                yield ngram, added_chunk, removed_chunk, len(added_ids) - len(removed_ids), len(removed_ids)
+
+        with self._locked(self._write_lock, "write"):
+            names = self._segment_names()
+            sequence = int(names[-1].removesuffix(SEGMENT_SUFFIX)) + 1 if names else 0
+            self._write_segment(self._path(f"{sequence:012d}{SEGMENT_SUFFIX}"), encoded_ngrams(), new_blobs)
+
+        if self._merger is not None:
+            self._merger.notify()
+
+    def add(self, postings: dict[bytes, list[int]]) -> None:
+        self.update(postings, {})
+
+    def add_lines(self, postings: dict[bytes, list[int]]) -> None:
+        self._lines.add(postings)
+
+    def remove(self, postings: dict[bytes, list[int]]) -> None:
+        self.update({}, postings)
+
+    def get(self, ngrams: Iterable[bytes]) -> dict[bytes, np.ndarray]:
+        segments = self.segments()
+        postings = {}
+        for ngram in ngrams:
+            chunks = []
+            for segment in segments:
+                i = segment.find(ngram)
+                if i is not None:
+                    chunks.extend(chk for chk in segment.chunks(i) if len(chk))
+            postings[ngram] = apply_chunks(chunks)
+        return postings
+
+    def get_lines(self, ngrams: Iterable[bytes]) -> dict[bytes, np.ndarray]:
+        return self._lines.get(ngrams)
+
+    def delete_documents(self, doc_ids: list[int]) -> None:
+        if not doc_ids:
+            return
+        with self._locked(self._write_lock, "write"):
+            self._write_tombstones(np.union1d(self.tombstones(), doc_ids))
+
+    def _write_tombstones(self, tombstones: np.ndarray) -> None:
+        temp_path = self._path(self.TOMBSTONES_FILE + TEMP_SUFFIX)
+        with open(temp_path, "wb") as fp:
+            fp.write(encode_postings(tombstones))
+        os.replace(temp_path, self._path(self.TOMBSTONES_FILE))
+
+    def tombstones(self) -> np.ndarray:
+        try:
+            with open(self._path(self.TOMBSTONES_FILE), "rb") as fp:
+                return decode_postings(fp.read())
+        except FileNotFoundError:
+            return EMPTY_POSTINGS
+
+    def pending_compaction(self) -> int:
+        return len(self.tombstones()) + sum(segment.num_removed for segment in self.segments())
+
+    def num_documents(self) -> int:
+        return sum(segment.num_documents for segment in self.segments()) - len(self.tombstones())
+
+    def frequencies(self, ngrams: Iterable[bytes]) -> dict[bytes, int]:
+        """No. of blobs posted per n-gram, leaving out stop grams."""
+        segments = self.segments()
+        stop_grams = self.stop_grams()
+        frequencies = {}
+        for ngram in ngrams:
+            if ngram in stop_grams:
+                continue
+            frequency = 0
+            for segment in segments:
+                i = segment.find(ngram)
+                if i is not None:
+                    frequency += int(segment.frequencies[i])
+            frequencies[ngram] = frequency
+        return frequencies
+
+    def frequent_grams(self, min_frequency: int) -> dict[bytes, int]:
+        segments = self.segments()
+        if not segments:
+            return {}
+        # Any n-gram posted for `min_frequency` blobs was posted for a share of them in some segment
+        threshold = math.ceil(min_frequency / len(segments))
+        candidates = {segment[int(i)] for segment in segments for i in np.flatnonzero(segment.frequencies >= threshold)}
+        frequencies = self.frequencies(candidates)
+        return {ngram: frequency for ngram, frequency in frequencies.items() if frequency >= min_frequency}
+
+    def _stop_grams_path(self) -> str:
+        # Line postings follow the stop grams of the enclosing store
+        segments_dir = os.path.dirname(self.segments_dir) if self.line_postings else self.segments_dir
+        return os.path.join(segments_dir, self.STOP_GRAMS_FILE)
+
+    def stop_grams(self) -> set[bytes]:
+        try:
+            modified_at = os.stat(self._stop_grams_path()).st_mtime_ns
+        except FileNotFoundError:
+            return set()
+        if self._stop_grams[0] != modified_at:
+            with open(self._stop_grams_path(), "rb") as fp:
+                self._stop_grams = (modified_at, decode_ngrams(fp.read()))
+        return self._stop_grams[1]
+
+    def add_stop_grams(self, ngrams: Iterable[bytes]) -> None:
+        """Stops posting the n-grams, their posting lists & line postings are dropped by compacting right away."""
+        with self._locked(self._write_lock, "write"):
+            stop_grams = self.stop_grams() | set(ngrams)
+            temp_path = self._path(self.STOP_GRAMS_FILE + TEMP_SUFFIX)
+            with open(temp_path, "wb") as fp:
+                fp.write(encode_ngrams(stop_grams))
+            os.replace(temp_path, self._path(self.STOP_GRAMS_FILE))
+        self.compact()
+
+    def _merge(self, segments: list[Segment], tombstones: np.ndarray, is_base: bool) -> None:
+        """Merge consecutive segments into one, that replaces the newest of them.
+
+        Until the older segments are removed, readers may see both the merged & the
+        older segments. Replaying a merged segment over its own parts is harmless.
+        """
+
+        stop_grams = self.stop_grams()
+
+        def merged_ngrams():
+            def entries_of(order: int) -> Iterator[tuple[bytes, int, int]]:
+                return ((ngram, order, i) for i, ngram in enumerate(segments[order]))
+
+            entries = heapq.merge(*map(entries_of, range(len(segments))))
+            for ngram, group in groupby(entries, key=lambda entry: entry[0]):
+                if ngram in stop_grams:
+                    continue
+                group = list(group)
+                chunks = [segments[order].chunks(i) for _, order, i in group]
+                if len(chunks) == 1 and not len(chunks[0][1]) and not len(tombstones):
+                    # Nothing to fold, copy as is
+                    _, order, i = group[0]
+                    yield ngram, bytes(chunks[0][0]), b"", int(segments[order].frequencies[i]), 0
+                    continue
+
+                added, removed = _merge_chunks(chunks)
+                kept = drop_tombstoned(added, tombstones, self.line_postings)
+                if is_base:
+                    # Nothing older to remove postings from, so the frequency is exact
+                    removed = EMPTY_POSTINGS
+                    frequency = len(kept)
+                else:
+                    # A blob added & removed within the run folds into a removal, so the frequencies of the parts add up
+                    frequency = sum(int(segments[order].frequencies[i]) for _, order, i in group)
+                    frequency -= len(added) - len(kept)
+                added = kept
+                if not len(added) and not len(removed):
+                    continue
+                added_chunk = ADDED + encode_postings(added) if len(added) else b""
+                removed_chunk = REMOVED + encode_postings(removed) if len(removed) else b""
+                yield ngram, added_chunk, removed_chunk, frequency, len(removed)
+
+        # Tombstoned blobs are only dropped when compacting, which merges every segment
+        num_documents = sum(segment.num_documents for segment in segments)
+        if not self.line_postings:
+            num_documents -= len(tombstones)
+        self._write_segment(segments[-1].path, merged_ngrams(), num_documents)
+        for segment in segments[:-1]:
+            os.remove(segment.path)
+
+    def _find_merge_run(self, segments: list[Segment]) -> list[Segment] | None:
+        # Newest run of consecutive segments, sharing the same size tier
+        def tier(segment: Segment) -> int:
+            return int(math.log(max(segment.size / MIN_MERGE_TIER_SIZE, 1), self.merge_factor))
+
+        end = len(segments)
+        while end > 0:
+            start = end - 1
+            while start > 0 and tier(segments[start - 1]) == tier(segments[end - 1]):
+                start -= 1
+            if end - start >= self.merge_factor:
+                return segments[start:end]
+            end = start
+        return None
+
+    def merge_small_segments(self) -> None:
+        with self._locked(self._merge_lock, "merge"):
+            while True:
+                segments = self.segments()
+                run = self._find_merge_run(segments)
+                if run is None:
+                    return
+                self._merge(run, EMPTY_POSTINGS, is_base=run[0] is segments[0])
+
+    def _compact(self, tombstones: np.ndarray) -> None:
+        with self._locked(self._merge_lock, "merge"):
+            segments = self.segments()
+            if segments:
+                self._merge(segments, tombstones, is_base=True)
+
+    def compact(self) -> None:
+        """Merge every segment into one, dropping removed postings & tombstoned documents."""
+        tombstones = self.tombstones()
+        self._compact(tombstones)
+        self._lines._compact(tombstones)
+
+        with self._locked(self._write_lock, "write"):
+            # Documents deleted while compacting stay tombstoned
+            self._write_tombstones(np.setdiff1d(self.tombstones(), tombstones, assume_unique=True))
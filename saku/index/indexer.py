@@ -1,122 +1,579 @@
+import hashlib
 import logging
+import math
+import multiprocessing
 import os
+import threading
 import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass, field
 from datetime import datetime
 from multiprocessing.pool import ThreadPool
-from pathlib import Path
+from queue import Queue
+from typing import Iterable, Iterator
 
-import magic
-from git import Repo
-from redis.client import Redis
+from git import GitCommandError, InvalidGitRepositoryError, NoSuchPathError, Repo
 
-from saku.core.config import SakuConfig
-from saku.core.encoding import byte_align_encode
-from saku.core.utils import chunk, un_chunk
-from saku.db.connector import DbConnector
-from saku.db.models import Document, IndexNGram, create_db_and_tables
+from saku.core.config import ONE_MB, SakuConfig
+from saku.core.metrics import METRICS, Timings
+from saku.core.utils import chunk
+from saku.db.connector import DbConnector, create_posting_store
+from saku.db.documents import DocumentTable
+from saku.db.models import Blob, Document, IndexedRepo, create_db_and_tables
 from saku.index.parser import DocumentParser
+from saku.index.postings import LINE_OFFSET_BITS
+from saku.index.scanner import FileScanner, FileTypeDetector
 
 logging.basicConfig(level=logging.DEBUG)
 LOG = logging
 
 CHUNK_SIZE = 1000
+PARSE_CHUNK_SIZE = 100
+
+INDEX_STAGE_SECONDS = METRICS.histogram(
+    "saku_index_stage_seconds", "Time spent per stage of an indexing run, summed over its batches", label="stage"
+)
+INDEX_DOCUMENTS = METRICS.counter("saku_index_documents_total", "Documents gone through each indexing stage", "stage")
+
+
+@dataclass
+class StageStats:
+    name: str
+    docs: int = 0
+    num_bytes: int = 0
+    # No. of docs the stage has to go through, once known
+    total: int | None = None
+    started: float | None = None
+    finished: float | None = None
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def start(self) -> None:
+        with self._lock:
+            if self.started is None:
+                self.started = time.time()
+
+    def add(self, docs: int, num_bytes: int = 0) -> None:
+        with self._lock:
+            if self.started is None:
+                self.started = time.time()
+            self.docs += docs
+            self.num_bytes += num_bytes
+            self.finished = time.time()
+
+    def add_total(self, docs: int) -> None:
+        with self._lock:
+            self.total = (self.total or 0) + docs
+
+    @property
+    def elapsed(self) -> float:
+        return max((self.finished or 0) - (self.started or 0), 1e-9)
+
+    def report(self) -> str:
+        elapsed = self.elapsed
+        report = f"{self.name}: {self.docs} docs in {elapsed:.2f}s ({self.docs / elapsed:.1f} docs/sec"
+        if self.num_bytes:
+            report += f", {self.num_bytes / ONE_MB / elapsed:.2f} MB/sec"
+        return report + ")"
+
+    def to_dict(self) -> dict:
+        elapsed = self.elapsed
+        docs_per_sec = self.docs / elapsed if self.docs else 0.0
+        eta = None
+        if self.total is not None and docs_per_sec:
+            eta = max(self.total - self.docs, 0) / docs_per_sec
+        return {
+            "docs": self.docs,
+            "total": self.total,
+            "docs_per_sec": round(docs_per_sec, 1),
+            "mb_per_sec": round(self.num_bytes / ONE_MB / elapsed, 2) if self.num_bytes else 0.0,
+            "eta_sec": None if eta is None else round(eta, 1),
+        }
+
+
+def new_stage_stats() -> dict[str, StageStats]:
+    return {name: StageStats(name) for name in ("scan", "metadata", "parse", "write")}
+
+
+@dataclass
+class ParsedBatch:
+    # Postings are keyed by blob ids, every set of identical documents is parsed once.
+    # Blobs are content addressed & never change, so they are only ever added.
+    # n-gram -> ids of the blobs containing it
+    postings: dict[bytes, list[int]]
+    doc_ids: list[int]
+    num_bytes: int
+    indexed_at: datetime
+    parse_seconds: float = 0.0
+    # n-gram -> line postings of the blobs
+    lines: dict[bytes, list[int]] = field(default_factory=dict)
+
+    @staticmethod
+    def merge(batches: list["ParsedBatch"]) -> "ParsedBatch":
+        postings, lines = {}, {}
+        for batch in batches:
+            for ngram, doc_ids in batch.postings.items():
+                postings.setdefault(ngram, []).extend(doc_ids)
+            for ngram, line_ids in batch.lines.items():
+                lines.setdefault(ngram, []).extend(line_ids)
+
+        return ParsedBatch(
+            postings=postings,
+            doc_ids=[doc_id for batch in batches for doc_id in batch.doc_ids],
+            num_bytes=sum(batch.num_bytes for batch in batches),
+            indexed_at=min(batch.indexed_at for batch in batches),
+            parse_seconds=sum(batch.parse_seconds for batch in batches),
+            lines=lines,
+        )
+
+
+@dataclass
+class ChangeSet:
+    # Untracked files to start tracking & index
+    new_file_paths: list[str] = field(default_factory=list)
+    # Tracked documents that may have changed since indexing
+    tracked_docs: list[Document] = field(default_factory=list)
+    deleted_docs: list[Document] = field(default_factory=list)
+    # No. of files looked at to find the changes
+    num_scanned: int = 0
+
+    def extend(self, other: "ChangeSet") -> None:
+        self.new_file_paths.extend(other.new_file_paths)
+        self.tracked_docs.extend(other.tracked_docs)
+        self.deleted_docs.extend(other.deleted_docs)
+        self.num_scanned += other.num_scanned
+
+
+def git_blob_sha(path: str) -> str:
+    # Same as `git hash-object`, so that blobs line up with the ones in git
+    with open(path, "rb") as fp:
+        content = fp.read()
+    return hashlib.sha1(b"blob %d\0" % len(content) + content).hexdigest()
+
+
+def parse_documents(parser: DocumentParser, documents: list[tuple[int, str]]) -> ParsedBatch:
+    """Parse blobs through one of their paths."""
+    parsed_ngrams, parsed_lines = {}, {}
+    doc_ids = []
+    num_bytes = 0
+    indexed_at = datetime.now()
+    started_at = time.perf_counter()
+
+    for doc_id, doc_path in documents:
+        line_grams = {}
+        try:
+            if parser.line_positions:
+                current_grams, line_grams = parser.parse_document_lines(doc_path)
+            else:
+                current_grams = parser.parse_document(doc_path)
+            num_bytes += os.path.getsize(doc_path)
+        except OSError as e:
+            LOG.warning(f"Skipping Document: {doc_path}, {e}")
+            continue
+
+        doc_ids.append(doc_id)
+        for grm in current_grams:
+            parsed_ngrams.setdefault(grm, []).append(doc_id)
+        for grm, offsets in line_grams.items():
+            parsed_lines.setdefault(grm, []).extend(((doc_id << LINE_OFFSET_BITS) | offsets).tolist())
+
+    parse_seconds = time.perf_counter() - started_at
+    return ParsedBatch(parsed_ngrams, doc_ids, num_bytes, indexed_at, parse_seconds, parsed_lines)
+
+
+# Parser of the current parse worker process
+_worker_parser: DocumentParser | None = None
+
+
+def _init_parse_worker(parser: DocumentParser) -> None:
+    global _worker_parser
+    _worker_parser = parser
+
+
+def _parse_in_worker(documents: list[tuple[int, str]]) -> ParsedBatch:
+    return parse_documents(_worker_parser, documents)
 
 
 class Indexer:
-    def __init__(self, config: SakuConfig):
+    def __init__(self, config: SakuConfig, documents: DocumentTable | None = None):
         self.config = config
-        self.pool = ThreadPool(12)
+        # In-memory document metadata of the query engine in this process, kept in sync
+        self.documents = documents
+        self.pool = ThreadPool(config.INDEX_METADATA_WORKERS)
         self.db = DbConnector(config.DATABASE_URI)
-        self.parser = DocumentParser(config.MAX_SPARSE_GRAM_LENGTH)
-        self.client = Redis(host=config.REDIS_HOST, port=config.REDIS_PORT, db=0)
+        self.parser = DocumentParser.from_config(config)
+        self.postings = create_posting_store(config, background_merge=True)
+        self.scanner = FileScanner(config.SCAN_EXCLUDES, config.max_file_size_to_index_in_bytes, config.SCAN_WORKERS)
+        self.detector = FileTypeDetector()
+        # Blobs being parsed by any indexing run, so that concurrent runs never parse the same blob twice
+        self._parsing_blobs: set[int] = set()
+        self._blobs_lock = threading.RLock()
 
         # Initialize Tables
         create_db_and_tables(self.db.engine)
 
-    def index_directory(self, dir_path):
+    def index_directory(self, dir_path, stats: dict[str, StageStats] | None = None):
+        """Index a directory through a staged pipeline.
+
+        scan -> metadata & mime detection (threads) -> parsing (processes) -> a single postings writer.
+        Each stage only runs a bounded amount of work ahead of the next one.
+
+        Git repositories (the directory itself or its children) that were indexed before are only
+        diffed against their last indexed commit, everything else is scanned in full.
+        Uncommitted changes in those repositories are not picked up.
+        Progress is tracked in the given `stats` (see `new_stage_stats`) while indexing.
+        """
+        dir_path = os.path.abspath(dir_path)
+        stats = stats or new_stage_stats()
+        started_at = time.perf_counter()
+        timings = Timings()
+
+        stats["scan"].start()
+        with timings.stage("diff"):
+            heads = self._repository_heads(dir_path)
+            with self.db.get_session() as session:
+                results = session.query(IndexedRepo).filter(IndexedRepo.path.in_(list(heads)))
+                indexed_commits = {r.path: r.commit for r in results}
+
+            changes = ChangeSet()
+            diffed_roots = set()
+            for root, head in heads.items():
+                diff = self._diff_repository(root, indexed_commits.get(root), head)
+                if diff is not None:
+                    changes.extend(self._diff_changes(root, *diff))
+                    diffed_roots.add(root)
+        LOG.debug(f"Diffed {len(diffed_roots)} of {len(heads)} repositories against their last indexed commit")
+
+        with timings.stage("scan"):
+            changes.extend(self._scan_changes(dir_path, diffed_roots))
+        stats["scan"].add(changes.num_scanned)
+        stats["metadata"].add_total(len(changes.new_file_paths) + len(changes.tracked_docs))
+        LOG.debug(f"Already Tracked {len(changes.tracked_docs)} changed files")
+
+        # Drop deleted files from index
+        with timings.stage("drop"):
+            self.drop_documents(changes.deleted_docs)
+
+        docs_to_index = self._detect_documents_to_index(
+            changes.new_file_paths, changes.tracked_docs, stats["metadata"], timings
+        )
+
+        write_queue = Queue(maxsize=self.config.INDEX_QUEUE_SIZE)
+        write_errors = []
+        writer = threading.Thread(target=self._write_batches, args=(write_queue, stats["write"], timings, write_errors))
+        writer.start()
+
+        parse_workers = self.config.INDEX_PARSE_WORKERS or os.cpu_count()
+        # Forking while the metadata & writer threads run may leave locks held in the parsers
+        context = multiprocessing.get_context("spawn")
+        submitted_blobs = set()
+        try:
+            with ProcessPoolExecutor(parse_workers, context, _init_parse_worker, (self.parser,)) as executor:
+                pending = set()
+                for docs in docs_to_index:
+                    blobs = self._assign_blobs(docs, submitted_blobs)
+                    stats["parse"].add_total(len(blobs))
+                    stats["write"].add_total(len(blobs))
+                    for blobs_chunk in chunk(blobs, PARSE_CHUNK_SIZE):
+                        stats["parse"].start()
+                        pending.add(executor.submit(_parse_in_worker, blobs_chunk))
+
+                        # Wait for the parsers to catch up, and the writer through the bounded queue
+                        while len(pending) >= 2 * parse_workers:
+                            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                            self._enqueue_parsed(done, write_queue, stats["parse"], timings)
+
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    self._enqueue_parsed(done, write_queue, stats["parse"], timings)
+        finally:
+            write_queue.put(None)
+            writer.join()
+            with self._blobs_lock:
+                self._parsing_blobs -= submitted_blobs
+
+        if write_errors:
+            raise write_errors[0]
+
+        timings.add("total", time.perf_counter() - started_at)
+        timings.observe(INDEX_STAGE_SECONDS)
+        for name, stage in stats.items():
+            INDEX_DOCUMENTS.inc(stage.docs, name)
+            LOG.info(stage.report())
+        LOG.info(f"Stage timings (ms): {timings.to_ms()}")
+
+        # Only once everything got indexed, the next run can diff from here
+        self._record_heads(heads)
+
+        self._add_stop_grams()
+        if self.postings.pending_compaction() >= self.config.INDEX_COMPACTION_THRESHOLD:
+            LOG.info("Compacting postings")
+            self.postings.compact()
+
+    @staticmethod
+    def _repository_heads(dir_path: str) -> dict[str, str]:
+        """HEAD commits of the git repository at `dir_path`, or else of the repositories right under it."""
+        candidates = [dir_path]
+        if not os.path.isdir(os.path.join(dir_path, ".git")):
+            candidates = [entry.path for entry in os.scandir(dir_path) if entry.is_dir()]
+
+        heads = {}
+        for path in candidates:
+            try:
+                heads[path] = Repo(path).head.commit.hexsha
+            except (InvalidGitRepositoryError, NoSuchPathError, ValueError):
+                # Not a repository, or one without any commits
+                continue
+        return heads
+
+    def _diff_repository(self, root: str, last_commit: str | None, head: str) -> tuple[list[str], list[str]] | None:
+        """Paths present & deleted since the last indexed commit, or `None` when the repository needs a full scan."""
+        if last_commit is None:
+            return None
+        if last_commit == head:
+            return [], []
+
+        try:
+            output = Repo(root).git.diff("--name-status", "--no-renames", "-z", f"{last_commit}..{head}")
+        except GitCommandError as e:
+            # Most likely history got rewritten
+            LOG.warning(f"Cannot diff {root} from {last_commit}, scanning it in full: {e}")
+            return None
+
+        present, deleted = [], []
+        fields = output.split("\0")
+        for status, path in zip(fields[::2], fields[1::2]):
+            if self.scanner.is_excluded(path):
+                continue
+            (deleted if status == "D" else present).append(os.path.join(root, path))
+        return present, deleted
+
+    def _diff_changes(self, root: str, present_paths: list[str], deleted_paths: list[str]) -> ChangeSet:
+        tracked_docs: dict[str, Document] = {}
+        with self.db.get_session() as session:
+            for paths in chunk(present_paths + deleted_paths, CHUNK_SIZE):
+                tracked_docs.update((d.path, d) for d in session.query(Document).filter(Document.path.in_(paths)))
+
+            # Text files tracked but never indexed
+            not_indexed = session.query(Document).filter(
+                Document.path.like(f"{root}/%"), Document.last_indexed.is_(None), Document.mime_type.like("text%")
+            )
+            not_indexed = {d.path: d for d in not_indexed if d.path not in tracked_docs}
+
+        changes = ChangeSet(num_scanned=len(present_paths) + len(deleted_paths))
+        for path in present_paths:
+            if not self.scanner.is_listed(path):
+                # Deleted from the working tree or grown too large, same as when scanning
+                deleted_paths.append(path)
+            elif path in tracked_docs:
+                changes.tracked_docs.append(tracked_docs[path])
+            else:
+                changes.new_file_paths.append(path)
+        changes.tracked_docs.extend(not_indexed.values())
+        changes.deleted_docs = [tracked_docs[path] for path in deleted_paths if path in tracked_docs]
+        return changes
+
+    def _scan_changes(self, dir_path: str, skipped_roots: set[str]) -> ChangeSet:
         with self.db.get_session() as session:
-            results = session.query(Document).filter(Document.path.like(f"{dir_path}%"))
+            results = session.query(Document).filter(Document.path.like(f"{dir_path}/%"))
+            for root in skipped_roots:
+                results = results.filter(Document.path.notlike(f"{root}/%"))
             tracked_files: dict[str, Document] = {f.path: f for f in results}
 
-        files_present_in_path = set(
-            str(pth.absolute()) for pth in Path(dir_path).rglob("*") if pth.is_file() and not pth.name.startswith(".")
-        )
+        files_present_in_path = {f.path for f in self.scanner.scan(dir_path, skipped_roots)}
         LOG.debug(f"Found {len(files_present_in_path)} files in {dir_path}")
         tracked_file_paths = set(tracked_files.keys())
 
-        newer_file_paths = files_present_in_path - tracked_file_paths
-        deleted_file_paths = tracked_file_paths - files_present_in_path
-        already_tracked_file_paths = tracked_file_paths - deleted_file_paths
-        LOG.debug(f"Already Tracked {len(already_tracked_file_paths)} files")
+        return ChangeSet(
+            new_file_paths=list(files_present_in_path - tracked_file_paths),
+            tracked_docs=[tracked_files[pth] for pth in tracked_file_paths & files_present_in_path],
+            deleted_docs=[tracked_files[pth] for pth in tracked_file_paths - files_present_in_path],
+            num_scanned=len(files_present_in_path),
+        )
+
+    def _record_heads(self, heads: dict[str, str]) -> None:
+        indexed_at = datetime.now()
+        with self.db.get_session() as session:
+            for root, head in heads.items():
+                session.merge(IndexedRepo(path=root, commit=head, indexed_at=indexed_at))
+            session.commit()
 
-        # Drop deleted files from index
-        documents_to_delete = [tracked_files[pth] for pth in deleted_file_paths]
-        self.drop_documents(documents_to_delete)
+    def _add_stop_grams(self) -> None:
+        ratio = self.config.INDEX_STOP_GRAM_RATIO
+        num_documents = self.postings.num_documents()
+        if ratio is None or num_documents < self.config.INDEX_STOP_GRAM_MIN_DOCUMENTS:
+            return
+        stop_grams = self.postings.frequent_grams(math.floor(ratio * num_documents) + 1)
+        if stop_grams:
+            LOG.info(f"Dropping the postings of {len(stop_grams)} stop grams, posted for over {ratio:.0%} of blobs")
+            self.postings.add_stop_grams(stop_grams)
+
+    @staticmethod
+    def _with_blob_shas(documents: list[Document]) -> list[tuple[Document, str]]:
+        docs = []
+        for doc in documents:
+            try:
+                docs.append((doc, git_blob_sha(doc.path)))
+            except OSError as e:
+                LOG.warning(f"Skipping Document: {doc.path}, {e}")
+        return docs
+
+    def _assign_blobs(self, documents: list[tuple[Document, str]], submitted: set[int]) -> list[tuple[int, str]]:
+        """Point documents to the blobs of their content, returning a path of every blob still to be parsed.
+
+        `submitted` is updated with the returned blobs.
+        """
+        if not documents:
+            return []
+
+        indexed_at = datetime.now()
+        with self._blobs_lock, self.db.get_session() as session:
+            blobs = {b.sha: b for b in session.query(Blob).filter(Blob.sha.in_(list({sha for _, sha in documents})))}
+            for doc, sha in documents:
+                if sha not in blobs:
+                    blobs[sha] = Blob(sha=sha, size=doc.size)
+                    session.add(blobs[sha])
+            session.flush()
+
+            to_parse, replaced_blob_ids = [], set()
+            docs_by_blob: dict[int, list[int]] = {}
+            for doc, sha in documents:
+                blob = blobs[sha]
+                docs_by_blob.setdefault(blob.id, []).append(doc.id)
+                if doc.blob_id is not None and doc.blob_id != blob.id:
+                    replaced_blob_ids.add(doc.blob_id)
+                if blob.last_indexed is None and blob.id not in self._parsing_blobs:
+                    self._parsing_blobs.add(blob.id)
+                    submitted.add(blob.id)
+                    to_parse.append((blob.id, doc.path))
+
+            blobs_by_id = {b.id: b for b in blobs.values()}
+            for blob_id, doc_ids in docs_by_blob.items():
+                updates = {"blob_id": blob_id}
+                if blobs_by_id[blob_id].last_indexed is not None:
+                    # Same content got indexed already
+                    updates["last_indexed"] = indexed_at
+                session.query(Document).filter(Document.id.in_(doc_ids)).update(updates, synchronize_session=False)
+            session.commit()
+            self._sync_documents(doc.id for doc, _ in documents)
+
+            self._drop_orphan_blobs(replaced_blob_ids)
+        return to_parse
+
+    def _drop_orphan_blobs(self, blob_ids: set[int]) -> None:
+        if not blob_ids:
+            return
+
+        with self._blobs_lock, self.db.get_session() as session:
+            results = session.query(Document.blob_id).filter(Document.blob_id.in_(blob_ids)).distinct()
+            orphan_ids = list(blob_ids - {blob_id for (blob_id,) in results})
+            if not orphan_ids:
+                return
+
+            # Postings of orphan blobs are filtered out while querying, until the next compaction
+            self.postings.delete_documents(orphan_ids)
+            session.query(Blob).filter(Blob.id.in_(orphan_ids)).delete(synchronize_session=False)
+            session.commit()
+
+    @staticmethod
+    def _enqueue_parsed(done, write_queue: Queue, stats: StageStats, timings: Timings) -> None:
+        for future in done:
+            batch = future.result()
+            stats.add(len(batch.doc_ids), batch.num_bytes)
+            timings.add("parse", batch.parse_seconds)
+            write_queue.put(batch)
+
+    def _detect_documents_to_index(
+        self, new_file_paths: list[str], tracked_docs: list[Document], stats: StageStats, timings: Timings
+    ) -> Iterator[list[tuple[Document, str]]]:
+        stats.start()
+
+        def track(file_paths: list[str]) -> tuple[list[str], list[tuple[Document, str]]]:
+            with timings.stage("metadata"):
+                return file_paths, self._with_blob_shas(self.track_new_documents(file_paths))
+
+        def recheck(documents: list[Document]) -> tuple[list[Document], list[tuple[Document, str]]]:
+            with timings.stage("metadata"):
+                return documents, self._with_blob_shas(self.filter_consistent_docs(documents))
 
         # Track newer docs
-        new_file_paths = list(newer_file_paths)
         LOG.debug(f"Tracking {len(new_file_paths)} newer files")
-        newer_docs_to_index_chunks = self.pool.map(self.track_new_documents, chunk(new_file_paths, 2000))
-        newer_docs_to_index = un_chunk(newer_docs_to_index_chunks)
+        for file_paths, docs in self.pool.imap_unordered(track, chunk(new_file_paths, 2000)):
+            stats.add(len(file_paths), sum(d.size for d, _ in docs))
+            yield docs
 
         # Identify docs to re-index
-        LOG.debug(f"Checking if {len(already_tracked_file_paths)} files need reindexing")
-        already_tracked_docs = map(tracked_files.get, already_tracked_file_paths)
-        modified_docs_chunks = self.pool.map(self.filter_consistent_docs, chunk(list(already_tracked_docs), 50))
-        modified_docs = un_chunk(modified_docs_chunks)
-        LOG.debug(f"{len(modified_docs)} need reindexing")
-
-        # Index docs
-        docs_to_index = newer_docs_to_index + modified_docs
-        chunked = [docs_to_index[i : i + CHUNK_SIZE] for i in range(0, len(docs_to_index), CHUNK_SIZE)]
-        parsed_ngram_chunks = self.pool.map(self.index_documents, chunked)
+        LOG.debug(f"Checking if {len(tracked_docs)} files need reindexing")
+        for documents, docs in self.pool.imap_unordered(recheck, chunk(tracked_docs, 50)):
+            stats.add(len(documents), sum(d.size for d, _ in docs))
+            yield docs
+
+    def _write_batches(self, write_queue: Queue, stats: StageStats, timings: Timings, errors: list[Exception]) -> None:
+        # Single writer, merging parsed batches into larger posting chunks
+        pending: list[ParsedBatch] = []
+        finished = False
+
+        while not finished:
+            batch = write_queue.get()
+            finished = batch is None
+            if batch is not None and not errors:
+                pending.append(batch)
+
+            pending_docs = sum(len(b.doc_ids) for b in pending)
+            if pending and (finished or pending_docs >= CHUNK_SIZE):
+                try:
+                    stats.start()
+                    with timings.stage("write"):
+                        self.write_batch(ParsedBatch.merge(pending))
+                    stats.add(pending_docs, sum(b.num_bytes for b in pending))
+                except Exception as e:
+                    # Keep draining the queue, so that the producers never block on a dead writer
+                    LOG.exception("Failed to write postings")
+                    errors.append(e)
+                pending = []
 
     def drop_documents(self, documents: list[Document]) -> None:
-        session = self.db.get_session()
         deleted_document_ids = [d.id for d in documents]
-        session.query(Document).filter(Document.id in deleted_document_ids).delete()
+        if not deleted_document_ids:
+            return
+
+        session = self.db.get_session()
+        session.query(Document).filter(Document.id.in_(deleted_document_ids)).delete(synchronize_session=False)
         session.commit()
         session.close()
+        self._sync_documents(deleted_document_ids)
 
-    def track_new_documents(self, file_paths: list[str]):
-        docs = []
+        # Blobs stay indexed as long as any other document has the same content
+        self._drop_orphan_blobs({d.blob_id for d in documents if d.blob_id is not None})
+
+    def track_new_documents(self, file_paths: list[str]) -> list[Document]:
+        rows = []
         docs_not_indexed = 0
-        doc_paths_indexed = []
 
         f_stats = map(os.stat, file_paths)
         for file_path, fstat in zip(file_paths, f_stats):
             file_size = fstat.st_size
             last_modified = datetime.fromtimestamp(fstat.st_mtime)
 
-            if file_size > 1024 * 1024:
+            if file_size > self.config.max_file_size_to_index_in_bytes:
                 docs_not_indexed += 1
                 continue
 
-            mime_type = magic.from_file(file_path, mime=True)
+            mime_type = self.detector.mime_type(file_path)
             if not mime_type.startswith("text"):
                 docs_not_indexed += 1
                 continue
 
-            data = {"path": file_path, "size": file_size, "last_modified": last_modified, "mime_type": mime_type}
-            doc_paths_indexed.append(file_path)
-            docs.append(Document.parse_obj(data))
+            rows.append({"path": file_path, "size": file_size, "last_modified": last_modified, "mime_type": mime_type})
 
         LOG.debug(f"Skipping {docs_not_indexed} non text files")
-
-        with self.db.get_session() as session:
-            session.add_all(docs)
-            session.commit()
-
-            results = []
-            # results = session.query(Document).filter(Document.path.in_(doc_paths_indexed)).all()
-            session.close()
-
-        return results
+        documents = self.db.upsert_documents(rows)
+        self._sync_documents(doc.id for doc in documents)
+        return documents
 
     def filter_consistent_docs(self, documents: list[Document]) -> list[Document]:
         session = self.db.get_session()
 
-        docs_to_reindex = []
+        docs_to_reindex, updated_doc_ids = [], []
         for doc in documents:
             fstat = os.stat(doc.path)
             file_size = fstat.st_size
@@ -128,9 +585,10 @@ class Indexer:
                 or (doc.last_indexed is None and doc.mime_type.startswith("text"))  # Not indexed
                 or (doc.last_indexed is not None and doc.last_indexed < last_modified)  # Modified after indexing
             ):
-                mime_type = magic.from_file(doc.path, mime=True)
+                mime_type = self.detector.mime_type(doc.path)
                 updates = {"size": file_size, "last_modified": last_modified, "mime_type": mime_type}
                 session.query(Document).filter(Document.id == doc.id).update(updates)
+                updated_doc_ids.append(doc.id)
 
                 if mime_type.startswith("text"):
                     # Re-index only text files
@@ -138,50 +596,49 @@ class Indexer:
 
         session.commit()
         session.close()
+        self._sync_documents(updated_doc_ids)
         return docs_to_reindex
 
-    def index_documents(self, documents: list[Document]) -> set[str]:
-        parsed_ngrams = {}
-
-        start_time = time.time()
-        for doc in documents:
-            LOG.debug(f"Indexing Document: {doc.path}")
-            current_grams = self.parser.parse_document(doc.path)
-            doc.last_indexed = datetime.now()
-
-            for grm in current_grams:
-                parsed_ngrams.setdefault(grm, []).append(doc.id)
-        LOG.debug(f"Indexed: {time.time() - start_time}")
+    def _sync_documents(self, doc_ids: Iterable[int]) -> None:
+        if self.documents is not None:
+            self.documents.sync(doc_ids)
+
+    def index_documents(self, documents: list[Document]) -> set[bytes]:
+        timings = Timings()
+        with timings.stage("parse"):
+            blobs = self._assign_blobs(self._with_blob_shas(documents), set())
+            batch = parse_documents(self.parser, blobs)
+        with timings.stage("write"):
+            self.write_batch(batch)
+
+        timings.observe(INDEX_STAGE_SECONDS)
+        LOG.debug(f"Indexed {len(batch.doc_ids)} documents, timings (ms): {timings.to_ms()}")
+        return set(batch.postings.keys())
+
+    def write_batch(self, batch: ParsedBatch) -> None:
+        added, lines = batch.postings, batch.lines
+        if stop_grams := self.postings.stop_grams():
+            added = {ngram: doc_ids for ngram, doc_ids in added.items() if ngram not in stop_grams}
+            lines = {ngram: line_ids for ngram, line_ids in lines.items() if ngram not in stop_grams}
+        # Lines go first, so that blobs only match once their lines can be found
+        if lines:
+            self.postings.add_lines(lines)
+        self.postings.update(added, {}, len(batch.doc_ids))
 
-        pipe = self.client.pipeline()
-        for ngram, postings in parsed_ngrams.items():
-            pipe.sadd(f"ng:{ngram}", *postings)
-        pipe.execute()
-        LOG.debug(f"Redis Save: {time.time() - start_time}")
-
-        # Save to DB
-        session = self.db.get_session()
-        # known_ngrams = set(parsed_ngrams.keys())
-        # index_grams = session.query(IndexNGram.ngram).filter(IndexNGram.ngram.in_(known_ngrams)).all()
-        # new_ngrams = known_ngrams - set(g.ngram for g in index_grams)
-        # print("DB read: ", time.time() - start_time)
-        #
-        # new_index_grams = []
-        # for ngram, posting_list in zip(new_ngrams, map(parsed_ngrams.get, new_ngrams)):
-        #     encoded_doc_ids = b"".join(byte_align_encode(posting) for posting in posting_list)
-        #     index_gram = IndexNGram(ngram=ngram, doc_ids=encoded_doc_ids)
-        #     new_index_grams.append(index_gram)
-        #
-        # session.add_all(new_index_grams)
-        session.add_all(documents)
-        session.commit()
-        session.close()
-        LOG.debug(f"DB Save: {time.time() - start_time}")
-        return set(parsed_ngrams.keys())
+        with self.db.get_session() as session:
+            session.query(Blob).filter(Blob.id.in_(batch.doc_ids)).update(
+                {"last_indexed": batch.indexed_at}, synchronize_session=False
+            )
+            # Including the documents of the blob that were found while parsing it
+            session.query(Document).filter(Document.blob_id.in_(batch.doc_ids)).update(
+                {"last_indexed": batch.indexed_at}, synchronize_session=False
+            )
+            session.commit()
 
 
 if __name__ == "__main__":
     overall_start = time.time()
-    indexer = Indexer(SakuConfig())
-    indexer.index_directory("/home/raz/Temp/repos")
+    config = SakuConfig()
+    indexer = Indexer(config)
+    indexer.index_directory(config.REPO_DIR)
     LOG.debug(f"Total Time Taken : {time.time() - overall_start}")
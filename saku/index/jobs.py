@@ -0,0 +1,123 @@
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from saku.index.indexer import Indexer, StageStats, new_stage_stats
+
+LOG = logging
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+
+# No. of finished jobs kept around for their status
+MAX_FINISHED_JOBS = 1000
+
+
+@dataclass
+class IndexJob:
+    path: str
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    status: str = QUEUED
+    stats: dict[str, StageStats] = field(default_factory=new_stage_stats)
+    error: str | None = None
+    created_at: float = field(default_factory=time.time)
+    started_at: float | None = None
+    finished_at: float | None = None
+
+    @property
+    def active(self) -> bool:
+        return self.status in (QUEUED, RUNNING)
+
+    @property
+    def stage(self) -> str:
+        if self.status != RUNNING:
+            return self.status
+
+        metadata, parse, write = self.stats["metadata"], self.stats["parse"], self.stats["write"]
+        if metadata.total is None:
+            return "scan"
+        if metadata.docs < metadata.total:
+            return "metadata"
+        if parse.docs < (parse.total or 0):
+            return "parse"
+        if write.docs < (write.total or 0):
+            return "write"
+        return "finishing"
+
+    def to_dict(self) -> dict:
+        stages = {name: stage.to_dict() for name, stage in self.stats.items()}
+        # The slowest stage decides when the job is done
+        etas = [stage["eta_sec"] for stage in stages.values() if stage["eta_sec"] is not None]
+        return {
+            "id": self.id,
+            "path": self.path,
+            "status": self.status,
+            "stage": self.stage,
+            "files_processed": self.stats["metadata"].docs,
+            "files_total": self.stats["metadata"].total,
+            "eta_sec": max(etas) if self.status == RUNNING and etas else None,
+            "stages": stages,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobManager:
+    """Runs indexing jobs in the background, at most `max_concurrent_jobs` at a time.
+
+    Indexing a path that is already queued or being indexed returns the existing job.
+    """
+
+    def __init__(self, indexer: Indexer, max_concurrent_jobs: int = 2):
+        self.indexer = indexer
+        self.executor = ThreadPoolExecutor(max_concurrent_jobs, thread_name_prefix="index-job")
+        self.jobs: OrderedDict[str, IndexJob] = OrderedDict()
+        self._active_jobs: dict[str, IndexJob] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, path: str) -> IndexJob:
+        with self._lock:
+            if job := self._active_jobs.get(path):
+                return job
+
+            job = IndexJob(path)
+            self.jobs[job.id] = job
+            self._active_jobs[path] = job
+            self._evict_finished_jobs()
+
+        self.executor.submit(self._run, job)
+        return job
+
+    def get(self, job_id: str) -> IndexJob | None:
+        return self.jobs.get(job_id)
+
+    def _evict_finished_jobs(self) -> None:
+        finished = [job_id for job_id, job in self.jobs.items() if not job.active]
+        for job_id in finished[: max(len(finished) - MAX_FINISHED_JOBS, 0)]:
+            del self.jobs[job_id]
+
+    def _run(self, job: IndexJob) -> None:
+        job.status = RUNNING
+        job.started_at = time.time()
+        try:
+            self.indexer.index_directory(job.path, job.stats)
+            job.status = COMPLETED
+        except Exception as e:
+            LOG.exception(f"Indexing {job.path} failed")
+            job.error = str(e)
+            job.status = FAILED
+        finally:
+            job.finished_at = time.time()
+            with self._lock:
+                del self._active_jobs[job.path]
+
+    def close(self) -> None:
+        self.executor.shutdown(cancel_futures=True)
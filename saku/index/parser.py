@@ -1,56 +1,229 @@
-from typing import Iterator
+from pathlib import Path
+from typing import Iterable, Iterator
 
+import numpy as np
 from code_tokenize import tokenize as code_tokenize
-from nltk import bigrams
+from numpy.lib.stride_tricks import sliding_window_view
+
+from saku.core.config import SakuConfig
+from saku.index.postings import MAX_LINE_OFFSET
 
 MAX_INDEX_LINE_LENGTH = 512
+NUM_BIGRAMS = 256 * 256
+# Gram keys starting with a byte from here on are reserved. Such bytes never occur in UTF-8 text, but do in
+# other encodings, so raw grams starting with one are escaped with `ESCAPED_GRAM_PREFIX`
+RESERVED_GRAM_BYTE = 0xFD
+ESCAPED_GRAM_PREFIX = b"\xfd"
+# Sets the grams of case folded content apart
+FOLDED_GRAM_PREFIX = b"\xff"
+# The only non ASCII chars that case insensitive regexes match ASCII letters with
+NON_ASCII_FOLDS = {"\u0131": "i", "\u212a": "k", "\u017f": "s"}
+
+
+def _bigram_ids(data: np.ndarray) -> np.ndarray:
+    return (data[:-1].astype(np.int32) << 8) | data[1:]
+
+
+def _pack_grams(data: np.ndarray, starts: np.ndarray, gram_length: int) -> np.ndarray:
+    # Pack short grams into integers, which sort a lot faster than raw bytes
+    packed = np.zeros(len(starts), dtype=np.uint64)
+    for i in range(gram_length):
+        packed = (packed << np.uint64(8)) | data[starts + i]
+    return packed
+
+
+def _unique_grams(data: np.ndarray, starts: np.ndarray, gram_length: int) -> list[bytes]:
+    if gram_length > 8:
+        grams = np.ascontiguousarray(sliding_window_view(data, gram_length)[starts])
+        return np.unique(grams.view(f"V{gram_length}").ravel()).tolist()
+
+    unique_grams = np.unique(_pack_grams(data, starts, gram_length)).astype(">u8").tobytes()
+    return [unique_grams[i + 8 - gram_length : i + 8] for i in range(0, len(unique_grams), 8)]
+
+
+def _escape_reserved(grams: list[bytes]) -> list[bytes]:
+    # Grams are sorted, so those starting with a reserved byte come last
+    i = len(grams)
+    while i and grams[i - 1][0] >= RESERVED_GRAM_BYTE:
+        i -= 1
+        grams[i] = ESCAPED_GRAM_PREFIX + grams[i]
+    return grams
+
+
+def fold_case(data: bytes) -> bytes:
+    # UTF-8 never encodes a char as part of another one, so replacing the bytes of a char is safe
+    data = data.lower()
+    for char, folded in NON_ASCII_FOLDS.items():
+        data = data.replace(char.encode("utf-8"), folded.encode("utf-8"))
+    return data
+
+
+def _line_grams(
+    data: np.ndarray, starts: np.ndarray, gram_length: int, breaks: np.ndarray, line_starts: np.ndarray
+) -> Iterator[tuple[bytes, np.ndarray]]:
+    # Leave out the grams spanning a line break
+    starts = starts[breaks[starts + gram_length] == breaks[starts]]
+    if not len(starts):
+        return
+
+    if gram_length > 8:
+        grams = np.ascontiguousarray(sliding_window_view(data, gram_length)[starts])
+        keys = np.unique(grams.view(f"V{gram_length}").ravel(), return_inverse=True)[1]
+    else:
+        keys = _pack_grams(data, starts, gram_length)
+    # Group the occurrences by gram, the stable sort keeps those of a gram in line order
+    order = np.argsort(keys, kind="stable")
+    keys, starts = keys[order], starts[order]
+    offsets = np.minimum(line_starts[breaks[starts]], MAX_LINE_OFFSET)
+
+    # First occurrence of every gram, and of every line of it
+    is_first = np.concatenate(([True], keys[1:] != keys[:-1]))
+    keep = is_first | np.concatenate(([True], offsets[1:] != offsets[:-1]))
+    starts, offsets, firsts = starts[keep], offsets[keep], np.flatnonzero(is_first[keep])
+    grams = np.ascontiguousarray(sliding_window_view(data, gram_length)[starts[firsts]]).tobytes()
+    bounds = np.append(firsts, len(offsets)).tolist()
+    for i in range(len(firsts)):
+        grm = grams[i * gram_length : (i + 1) * gram_length]
+        if grm[0] >= RESERVED_GRAM_BYTE:
+            grm = ESCAPED_GRAM_PREFIX + grm
+        yield grm, offsets[bounds[i] : bounds[i + 1]]
+
+
+def default_bigram_weights() -> np.ndarray:
+    # Sum of the byte values in a bigram
+    byte_values = np.arange(256, dtype=np.int32)
+    return np.add.outer(byte_values, byte_values).ravel()
+
+
+def count_bigrams(file_paths: Iterable[str]) -> np.ndarray:
+    counts = np.zeros(NUM_BIGRAMS, dtype=np.int64)
+    for file_path in file_paths:
+        with open(file_path, "rb") as fp:
+            data = np.frombuffer(fp.read(), dtype=np.uint8)
+        if len(data) > 1:
+            counts += np.bincount(_bigram_ids(data), minlength=NUM_BIGRAMS)
+    return counts
+
+
+def frequency_bigram_weights(counts: np.ndarray) -> np.ndarray:
+    # Rarer bigrams weigh more, so sparse grams end at selective bigrams
+    unique_counts, rarity = np.unique(counts, return_inverse=True)
+    return (len(unique_counts) - 1 - rarity).astype(np.int32)
+
+
+def save_bigram_weights(file_path: str, weights: np.ndarray) -> None:
+    with open(file_path, "wb") as fp:
+        np.save(fp, weights.astype(np.int32))
+
+
+def load_bigram_weights(file_path: str) -> np.ndarray:
+    weights = np.load(file_path)
+    if weights.shape != (NUM_BIGRAMS,):
+        raise ValueError(f"Invalid bigram weight table: {file_path}")
+    return weights.astype(np.int32)
 
 
 class DocumentParser:
-    def __init__(self, max_sparse_gram_length: int):
+    def __init__(
+        self,
+        max_sparse_gram_length: int,
+        bigram_weights: np.ndarray | None = None,
+        case_folded: bool = False,
+        line_positions: bool = False,
+    ):
         self._max_sparse_gram_length = max_sparse_gram_length
+        self._bigram_weights = default_bigram_weights() if bigram_weights is None else bigram_weights
+        self.case_folded = case_folded
+        self.line_positions = line_positions
 
-    @staticmethod
-    def _weigh_token(token: str) -> list[int]:
-        return [sum(ord(grm) for grm in bigram) for bigram in list(bigrams(token))]
+    @classmethod
+    def from_config(cls, config: SakuConfig) -> "DocumentParser":
+        # Indexing & querying must agree on the weights, else query grams will not match indexed grams
+        bigram_weights = load_bigram_weights(config.BIGRAM_WEIGHTS_PATH) if config.BIGRAM_WEIGHTS_PATH else None
+        return cls(config.MAX_SPARSE_GRAM_LENGTH, bigram_weights, config.INDEX_CASE_FOLDED, config.INDEX_LINE_POSITIONS)
+
+    def _weigh_token(self, data: np.ndarray) -> np.ndarray:
+        return self._bigram_weights[_bigram_ids(data)]
+
+    def _gram_starts(self, data: np.ndarray) -> Iterator[tuple[int, np.ndarray]]:
+        """Yields every gram length, with the positions of the sparse grams of that length.
+
+        A gram spans from one bigram to a later one, when every bigram in between
+        weighs no more than the first one and less than the last one. Each gram
+        length is handled for all start positions at once.
+        """
+        weights = self._weigh_token(data) if len(data) > 1 else np.empty(0, dtype=np.int32)
+
+        # Whether all bigrams between start & end weigh <= the start bigram
+        within_start = np.ones(len(weights), dtype=bool)
+        # Max weight of the bigrams between start & end, that weigh < the start bigram
+        max_between = np.full(len(weights), -1, dtype=np.int32)
 
-    def generate_index_grams(self, token: str) -> Iterator[str]:
-        weights = self._weigh_token(token)
+        for offset in range(1, self._max_sparse_gram_length):
+            num_starts = len(weights) - offset
+            if num_starts <= 0:
+                break
+
+            start_wts = weights[:num_starts]
+            end_wts = weights[offset:]
+            within_start = within_start[:num_starts]
+            max_between = max_between[:num_starts]
+
+            yield offset + 2, np.flatnonzero(within_start & (end_wts > max_between))
+
+            max_between = np.where(end_wts < start_wts, np.maximum(max_between, end_wts), max_between)
+            within_start = within_start & (end_wts <= start_wts)
+
+    def generate_index_grams(self, token: bytes) -> Iterator[bytes]:
+        """Yields the unique sparse grams of the token, escaping those that start with a reserved byte."""
+        data = np.frombuffer(token, dtype=np.uint8)
+        for gram_length, starts in self._gram_starts(data):
+            yield from _escape_reserved(_unique_grams(data, starts, gram_length))
 
-        for start, start_wt in enumerate(weights[:-1]):
-            max_wt = -1
-            for end in range(start + 1, min(start + self._max_sparse_gram_length, len(weights))):
-                current_wt = weights[end]
-                if max_wt < current_wt:
-                    yield token[start : end + 2]
+    def generate_line_grams(
+        self, token: bytes, index_grams: set[bytes] | None = None
+    ) -> Iterator[tuple[bytes, np.ndarray]]:
+        """Yields the unique sparse grams of every line of the token, with the sorted offsets of those lines.
 
-                    if start_wt == current_wt:
-                        continue
+        The grams of the whole token are added to `index_grams` along the way, if given.
+        """
+        data = np.frombuffer(token, dtype=np.uint8)
+        is_break = data == ord("\n")
+        # No. of line breaks before every position
+        breaks = np.concatenate(([0], np.cumsum(is_break)))
+        line_starts = np.concatenate(([0], np.flatnonzero(is_break) + 1))
+        for gram_length, starts in self._gram_starts(data):
+            if index_grams is not None:
+                index_grams.update(_escape_reserved(_unique_grams(data, starts, gram_length)))
+            yield from _line_grams(data, starts, gram_length, breaks, line_starts)
 
-                    max_wt = current_wt
-                    if start_wt < max_wt:
-                        break
+    def generate_folded_grams(self, token: bytes) -> Iterator[bytes]:
+        """Yields the unique sparse grams of the case folded token, prefixed with `FOLDED_GRAM_PREFIX`."""
+        data = np.frombuffer(fold_case(token), dtype=np.uint8)
+        for gram_length, starts in self._gram_starts(data):
+            for grm in _unique_grams(data, starts, gram_length):
+                yield FOLDED_GRAM_PREFIX + grm
 
     @staticmethod
-    def ast_tokenize(fp) -> Iterator[str]:
+    def ast_tokenize(fp) -> Iterator[bytes]:
         content = fp.read()
         if content:
-            tokens = code_tokenize(content, lang="python", syntax_error="warning")
+            tokens = code_tokenize(content.decode("utf-8", "ignore"), lang="python", syntax_error="warning")
             for token in tokens:
                 if token.type in ["newline"]:
                     continue
 
-                yield token.text
+                yield token.text.encode("utf-8")
 
     @staticmethod
-    def line_tokenize(fp) -> Iterator[str]:
+    def line_tokenize(fp) -> Iterator[bytes]:
         for line in fp.readlines():
             if len(line) > MAX_INDEX_LINE_LENGTH:
                 continue
             yield line
 
     @staticmethod
-    def chunk_tokenize(fp, chunk_size: int = 16) -> Iterator[str]:
+    def chunk_tokenize(fp, chunk_size: int = 16) -> Iterator[bytes]:
         while True:
             chunk = fp.read(chunk_size)
             if not chunk:
@@ -58,18 +231,35 @@ class DocumentParser:
             yield chunk
 
     @staticmethod
-    def no_tokenize(fp) -> Iterator[str]:
+    def no_tokenize(fp) -> Iterator[bytes]:
         yield fp.read()
 
-    def parse_document(self, file_path: str) -> set[str]:
+    def parse_document_lines(self, file_path: str) -> tuple[set[bytes], dict[bytes, np.ndarray]]:
+        """The grams of the document, and the offsets of the lines each gram (not spanning lines) is found on."""
+        with open(file_path, "rb") as fp:
+            content = fp.read()
+
+        document_grams = set()
+        line_grams = dict(self.generate_line_grams(content, document_grams))
+        if self.case_folded:
+            document_grams.update(self.generate_folded_grams(content))
+        return document_grams, line_grams
+
+    def parse_document(self, file_path: str) -> set[bytes]:
         document_grams = set()
 
-        with open(file_path) as fp:
-            try:
-                for token in self.no_tokenize(fp):
-                    token_grams = self.generate_index_grams(token)
-                    document_grams.update(token_grams)
-            except UnicodeDecodeError:
-                print("UnicodeDecodeError ", file_path)
+        with open(file_path, "rb") as fp:
+            for token in self.no_tokenize(fp):
+                token_grams = self.generate_index_grams(token)
+                document_grams.update(token_grams)
+                if self.case_folded:
+                    document_grams.update(self.generate_folded_grams(token))
 
         return document_grams
+
+
+if __name__ == "__main__":
+    # Build a frequency based weight table from the repos. Re-index after replacing the weights
+    config = SakuConfig()
+    repo_files = [str(pth) for pth in Path(config.REPO_DIR).rglob("*") if pth.is_file() and ".git" not in pth.parts]
+    save_bigram_weights(config.BIGRAM_WEIGHTS_PATH, frequency_bigram_weights(count_bigrams(repo_files)))
@@ -0,0 +1,294 @@
+from functools import cache, lru_cache
+from re import _casefix as sre_casefix
+from re import _constants as sre_constants
+from re import _parser as sre_parse
+from typing import NamedTuple
+
+from saku.index.parser import DocumentParser, fold_case
+from saku.index.postings import And, Gram, Line, Or, QueryNode
+
+# Cased characters end well before this code point
+MAX_CASED_CODE_POINT = 0x1F000
+
+# Verifying a candidate takes about as long as fetching & intersecting this many postings
+CANDIDATE_COST = 1000
+
+
+class _Info(NamedTuple):
+    # Set of strings the sub pattern matches exactly, if small enough to enumerate
+    exact: frozenset[str] | None
+    # Condition any document containing a match satisfies, `None` matching all
+    query: QueryNode | None
+
+
+ANY = _Info(None, None)
+EMPTY = _Info(frozenset({""}), None)
+
+
+class _Estimate(NamedTuple):
+    # What is left of the plan, `None` matching all
+    query: QueryNode | None
+    # Expected no. of blobs matching it
+    matches: float
+    # No. of postings fetched to evaluate it
+    cost: int
+
+
+@cache
+def _case_folds() -> dict[str, frozenset[str]]:
+    folds: dict[str, set[str]] = {}
+    for code in range(MAX_CASED_CODE_POINT):
+        char = chr(code)
+        lower = char.lower()
+        if lower != char and len(lower) == 1:
+            folds.setdefault(lower, {lower}).add(char)
+
+    for code, extra_codes in sre_casefix._EXTRA_CASES.items():
+        folds.setdefault(chr(code), {chr(code)}).update(map(chr, extra_codes))
+    return {lower: frozenset(chars) for lower, chars in folds.items()}
+
+
+def _fold(char: str) -> str:
+    return fold_case(char.encode("utf-8")).decode("utf-8")
+
+
+def _and(nodes: list[QueryNode | None]) -> QueryNode | None:
+    children = []
+    for node in nodes:
+        if node is None:
+            continue
+        for child in node.children if isinstance(node, And) else (node,):
+            if child not in children:
+                children.append(child)
+
+    if not children:
+        return None
+    return children[0] if len(children) == 1 else And(tuple(children))
+
+
+def _line(node: QueryNode | None) -> QueryNode | None:
+    # Grams of a string on one line, as long as there are several of them to tell lines apart by
+    return Line(node.children) if isinstance(node, And) else node
+
+
+def _or(nodes: list[QueryNode | None]) -> QueryNode | None:
+    children = []
+    for node in nodes:
+        if node is None:
+            # Some alternative can not be pruned
+            return None
+        for child in node.children if isinstance(node, Or) else (node,):
+            if child not in children:
+                children.append(child)
+
+    if not children:
+        return None
+    return children[0] if len(children) == 1 else Or(tuple(children))
+
+
+class QueryPlanner:
+    """Plans a regex into a boolean AND/OR tree of the n-grams produced by the indexer.
+
+    Literal runs of the regex are expanded into small sets of exact strings, and
+    each string is replaced by the sparse grams `DocumentParser` generates for it.
+    Sparse grams only depend on their own content, so every one of them is also
+    indexed for any document that contains the string.
+
+    Case insensitive regexes are planned over the case folded grams, if the parser
+    indexes them. Their literals are folded the same way, which keeps the strings
+    of each run as few as for a case sensitive regex.
+
+    If the parser records the lines of grams, the grams of a string without line
+    breaks are required to be found on a single line, rather than anywhere in a blob.
+    """
+
+    MAX_EXACT_SET_SIZE = 16
+    MAX_CLASS_SIZE = 16
+    MAX_LITERAL_REPEAT = 4
+
+    def __init__(self, parser: DocumentParser, cache_size: int = 1024):
+        self.parser = parser
+        self.plan = lru_cache(maxsize=cache_size)(self._plan)
+        self.is_literal = lru_cache(maxsize=cache_size)(self._is_literal)
+
+    def _analyze_regex(self, regex: str, case_sensitive: bool) -> tuple[_Info, bool]:
+        parsed = sre_parse.parse(regex, 0 if case_sensitive else sre_constants.SRE_FLAG_IGNORECASE)
+        ignore_case = bool(parsed.state.flags & sre_constants.SRE_FLAG_IGNORECASE)
+        fold = ignore_case and self.parser.case_folded
+        return self._analyze_sequence(parsed, ignore_case, fold), fold
+
+    def _plan(self, regex: str, case_sensitive: bool = True) -> QueryNode | None:
+        return self._query(*self._analyze_regex(regex, case_sensitive))
+
+    def _is_literal(self, regex: str, case_sensitive: bool = True) -> bool:
+        """Whether every match of the regex is one of a few strings, none of which spans lines."""
+        info, _ = self._analyze_regex(regex, case_sensitive)
+        return info.exact is not None and not any("\n" in text for text in info.exact)
+
+    def _grams(self, text: str, fold: bool) -> QueryNode | None:
+        data = text.encode("utf-8")
+        grams = self.parser.generate_folded_grams(data) if fold else self.parser.generate_index_grams(data)
+        query = _and([Gram(grm) for grm in grams])
+        if self.parser.line_positions and not fold and "\n" not in text:
+            # Folded grams have no line postings
+            return _line(query)
+        return query
+
+    def _query(self, info: _Info, fold: bool) -> QueryNode | None:
+        if info.exact is None:
+            return info.query
+        return _or([self._grams(text, fold) for text in sorted(info.exact)])
+
+    def _analyze_sequence(self, items, ignore_case: bool, fold: bool) -> _Info:
+        conditions = []
+        run = {""}
+        is_exact = True
+
+        for op, av in items:
+            for info in self._analyze(op, av, ignore_case, fold):
+                if info.exact is not None and len(run) * len(info.exact) <= self.MAX_EXACT_SET_SIZE:
+                    run = {prefix + suffix for prefix in run for suffix in info.exact}
+                    continue
+
+                # Flush the current literal run, and start over after this sub pattern
+                is_exact = False
+                conditions.append(self._query(_Info(frozenset(run), None), fold))
+                if info.exact is not None:
+                    run = set(info.exact)
+                else:
+                    conditions.append(info.query)
+                    run = {""}
+
+        if is_exact:
+            return _Info(frozenset(run), None)
+
+        conditions.append(self._query(_Info(frozenset(run), None), fold))
+        return _Info(None, _and(conditions))
+
+    def _analyze(self, op, av, ignore_case: bool, fold: bool) -> list[_Info]:
+        if op is sre_constants.LITERAL:
+            chars = self._variants(chr(av), ignore_case, fold)
+            return [ANY] if chars is None else [_Info(chars, None)]
+
+        if op is sre_constants.IN:
+            chars = self._char_class(av, ignore_case, fold)
+            return [ANY] if chars is None else [_Info(chars, None)]
+
+        if op is sre_constants.AT:
+            return [EMPTY]
+
+        if op is sre_constants.SUBPATTERN:
+            _, add_flags, del_flags, pattern = av
+            if add_flags & sre_constants.SRE_FLAG_IGNORECASE:
+                ignore_case = True
+            if del_flags & sre_constants.SRE_FLAG_IGNORECASE:
+                ignore_case = False
+            return [self._analyze_sequence(pattern, ignore_case, fold)]
+
+        if op is sre_constants.ATOMIC_GROUP:
+            return [self._analyze_sequence(av, ignore_case, fold)]
+
+        if op is sre_constants.BRANCH:
+            _, branches = av
+            infos = [self._analyze_sequence(branch, ignore_case, fold) for branch in branches]
+            if all(info.exact is not None for info in infos):
+                exact = frozenset().union(*(info.exact for info in infos))
+                if len(exact) <= self.MAX_EXACT_SET_SIZE:
+                    return [_Info(exact, None)]
+            return [_Info(None, _or([self._query(info, fold) for info in infos]))]
+
+        if op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT, sre_constants.POSSESSIVE_REPEAT):
+            min_repeat, max_repeat, pattern = av
+            info = self._analyze_sequence(pattern, ignore_case, fold)
+            if min_repeat == 0:
+                if max_repeat == 1 and info.exact is not None:
+                    return [_Info(info.exact | {""}, None)]
+                return [ANY]
+
+            if info.exact is None:
+                return [info]
+            copies = min(min_repeat, self.MAX_LITERAL_REPEAT)
+            if copies == min_repeat == max_repeat:
+                return [info] * copies
+            return [info] * copies + [ANY]
+
+        # Any char, negated classes, look arounds and back references
+        return [ANY]
+
+    def _variants(self, char: str, ignore_case: bool, fold: bool) -> frozenset[str] | None:
+        if not ignore_case:
+            return frozenset(_fold(char) if fold else char)
+        lower = char.lower()
+        if len(lower) != 1:
+            # Folds into multiple chars, leave it to the verifier
+            return None
+        chars = _case_folds().get(lower, frozenset(char))
+        return frozenset(map(_fold, chars)) if fold else chars
+
+    def _char_class(self, items, ignore_case: bool, fold: bool) -> frozenset[str] | None:
+        chars = set()
+        for op, av in items:
+            if op is sre_constants.LITERAL:
+                chars.add(chr(av))
+            elif op is sre_constants.RANGE and av[1] - av[0] < self.MAX_CLASS_SIZE:
+                chars.update(map(chr, range(av[0], av[1] + 1)))
+            else:
+                # Negated classes & categories (\w, \d ...) are too broad
+                return None
+
+        if ignore_case or fold:
+            variants = [self._variants(char, ignore_case, fold) for char in chars]
+            if None in variants:
+                return None
+            chars = set().union(*variants)
+        return frozenset(chars) if len(chars) <= self.MAX_CLASS_SIZE else None
+
+
+def _estimate(node: QueryNode, frequencies: dict[bytes, int], num_documents: int, max_matches: float) -> _Estimate:
+    if isinstance(node, Gram):
+        frequency = frequencies.get(node.gram)
+        if frequency is None or frequency > max_matches:
+            return _Estimate(None, num_documents, 0)
+        return _Estimate(node, frequency, frequency)
+
+    if isinstance(node, Line):
+        # Lines having all the grams are picked out of the blobs having them
+        estimate = _estimate(And(node.children), frequencies, num_documents, max_matches)
+        return estimate._replace(query=_line(estimate.query))
+
+    children = [_estimate(child, frequencies, num_documents, max_matches) for child in node.children]
+    if isinstance(node, Or):
+        if any(child.query is None for child in children):
+            return _Estimate(None, num_documents, 0)
+        matches = min(sum(child.matches for child in children), num_documents)
+        return _Estimate(_or([child.query for child in children]), matches, sum(child.cost for child in children))
+
+    kept, matches, cost = [], float(num_documents), 0
+    for child in sorted((child for child in children if child.query is not None), key=lambda child: child.matches):
+        # Candidates the child rules out, as if grams occurred independently of each other
+        ruled_out = matches * (1 - child.matches / num_documents)
+        if ruled_out * CANDIDATE_COST < child.cost:
+            continue
+        kept.append(child.query)
+        matches -= ruled_out
+        cost += child.cost
+    return _Estimate(_and(kept), matches, cost)
+
+
+def optimize_plan(
+    node: QueryNode | None, frequencies: dict[bytes, int], num_documents: int, max_match_ratio: float
+) -> QueryNode | None:
+    """Trims a plan down to the grams worth fetching, going by the document frequencies of its grams.
+
+    Stop grams (missing from `frequencies`) and grams posted for more than `max_match_ratio` of the
+    blobs are left to the verifier. ANDed grams are picked from the most selective on, as long as
+    the candidates they rule out take longer to verify than their postings to fetch. Plans still
+    expected to match more than `max_match_ratio` of the blobs skip the index altogether.
+    Trimmed plans only match more blobs, never less.
+    """
+    if node is None or num_documents <= 0:
+        # Nothing known about the grams
+        return node
+    max_matches = max_match_ratio * num_documents
+    estimate = _estimate(node, frequencies, num_documents, max_matches)
+    return estimate.query if estimate.matches <= max_matches else None
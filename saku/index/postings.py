@@ -0,0 +1,209 @@
+from dataclasses import dataclass
+from typing import Callable, Iterable, Iterator
+
+import numpy as np
+
+BLOCK_SIZE = 1024
+EMPTY_POSTINGS = np.empty(0, dtype=np.int64)
+
+# Line postings of a gram are kept apart from its blob postings. Each one holds the blob id in its
+# high bits, and the offset of a line of the blob having the gram in its low bits
+LINE_OFFSET_BITS = 32
+# Stands for every line from there on
+MAX_LINE_OFFSET = (1 << LINE_OFFSET_BITS) - 1
+
+
+@dataclass(frozen=True)
+class Gram:
+    gram: bytes
+
+
+@dataclass(frozen=True)
+class And:
+    children: tuple["QueryNode", ...]
+
+
+@dataclass(frozen=True)
+class Or:
+    children: tuple["QueryNode", ...]
+
+
+@dataclass(frozen=True)
+class Line:
+    """Grams all found on a single line, evaluated over their line postings."""
+
+    children: tuple[Gram, ...]
+
+
+# A query tree of n-grams. `None` stands for "match all documents"
+QueryNode = Gram | And | Or | Line
+PostingFetcher = Callable[[Iterable[bytes]], dict[bytes, np.ndarray]]
+
+
+def query_grams(node: QueryNode | None) -> set[bytes]:
+    if node is None:
+        return set()
+    if isinstance(node, Gram):
+        return {node.gram}
+    return set().union(*map(query_grams, node.children))
+
+
+def blob_grams(node: QueryNode | None) -> set[bytes]:
+    """Grams whose blob postings `node` is evaluated over."""
+    if isinstance(node, (And, Or)):
+        return set().union(*map(blob_grams, node.children))
+    return set() if isinstance(node, Line) else query_grams(node)
+
+
+def line_grams(node: QueryNode | None) -> set[bytes]:
+    """Grams whose line postings `node` is evaluated over."""
+    if isinstance(node, (And, Or)):
+        return set().union(*map(line_grams, node.children))
+    return query_grams(node) if isinstance(node, Line) else set()
+
+
+def line_postings(node: QueryNode | None, lines: dict[bytes, np.ndarray]) -> np.ndarray | None:
+    """Line postings of the lines that every match of the plan is found on, if it is made of `Line` nodes only."""
+    if isinstance(node, Line):
+        return intersect([lines.get(child.gram, EMPTY_POSTINGS) for child in node.children])
+    if isinstance(node, Or):
+        children = [line_postings(child, lines) for child in node.children]
+        if any(child is None for child in children):
+            return None
+        return union(children)
+    return None
+
+
+def line_offsets(node: QueryNode | None, lines: dict[bytes, np.ndarray]) -> dict[int, np.ndarray] | None:
+    """Offsets of the lines per blob given by `line_postings`, if the plan is made of `Line` nodes only."""
+    postings = line_postings(node, lines)
+    if postings is None:
+        return None
+    blob_ids, firsts = np.unique(postings >> LINE_OFFSET_BITS, return_index=True)
+    return dict(zip(blob_ids.tolist(), np.split(postings & MAX_LINE_OFFSET, firsts[1:])))
+
+
+def _gallop(postings: np.ndarray, lo: int, target: int) -> int:
+    # Exponential search for the first index >= lo holding a value greater than target
+    step = 1
+    hi = lo
+    while hi < len(postings) and postings[hi] <= target:
+        lo = hi
+        hi += step
+        step <<= 1
+    hi = min(hi, len(postings))
+    return lo + int(np.searchsorted(postings[lo:hi], target, side="right"))
+
+
+def iter_intersection(postings: list[np.ndarray], block_size: int = BLOCK_SIZE) -> Iterator[np.ndarray]:
+    """Lazily intersect sorted posting lists, yielding blocks of common doc ids.
+
+    The smallest list drives the intersection, the others are only probed within
+    the window that the current block can possibly match.
+    """
+    if not postings:
+        return
+
+    postings = sorted(postings, key=len)
+    smallest, others = postings[0], postings[1:]
+    cursors = [0] * len(others)
+
+    for block_start in range(0, len(smallest), block_size):
+        block = smallest[block_start : block_start + block_size]
+        for i, other in enumerate(others):
+            lo = cursors[i]
+            hi = _gallop(other, lo, block[-1])
+            cursors[i] = hi
+
+            window = other[lo:hi]
+            if not len(window):
+                block = EMPTY_POSTINGS
+                break
+            positions = np.minimum(np.searchsorted(window, block), len(window) - 1)
+            block = block[window[positions] == block]
+            if not len(block):
+                break
+
+        if len(block):
+            yield block
+
+
+def intersect(postings: list[np.ndarray]) -> np.ndarray:
+    blocks = list(iter_intersection(postings))
+    return np.concatenate(blocks) if blocks else EMPTY_POSTINGS
+
+
+def union(postings: list[np.ndarray]) -> np.ndarray:
+    if not postings:
+        return EMPTY_POSTINGS
+    return np.unique(np.concatenate(postings))
+
+
+def _evaluate(
+    node: QueryNode | None, postings: dict[bytes, np.ndarray], lines: dict[bytes, np.ndarray]
+) -> np.ndarray | None:
+    if node is None:
+        return None
+
+    if isinstance(node, Gram):
+        return postings.get(node.gram, EMPTY_POSTINGS)
+
+    if isinstance(node, Line):
+        # Blobs having a line with every gram
+        return np.unique(line_postings(node, lines) >> LINE_OFFSET_BITS)
+
+    if isinstance(node, Or):
+        children = []
+        for child in node.children:
+            child_postings = _evaluate(child, postings, lines)
+            if child_postings is None:
+                # Any branch may match every document
+                return None
+            children.append(child_postings)
+        return union(children)
+
+    children = []
+    for child in node.children:
+        child_postings = _evaluate(child, postings, lines)
+        if child_postings is None:
+            continue
+        if not len(child_postings):
+            # Nothing left to intersect with
+            return EMPTY_POSTINGS
+        children.append(child_postings)
+    return intersect(children) if children else None
+
+
+def search_postings(
+    node: QueryNode | None,
+    fetch: PostingFetcher,
+    deleted: np.ndarray | None = None,
+    fetch_lines: PostingFetcher | None = None,
+) -> Iterator[int] | None:
+    """Evaluate a query tree over the postings returned by `fetch`, and the line postings by `fetch_lines`.
+
+    Returns a lazy iterator of matching doc ids in ascending order, skipping the
+    `deleted` doc ids, or `None` when the query cannot prune any document.
+    """
+    if node is None:
+        return None
+
+    postings = fetch(blob_grams(node))
+    grams = line_grams(node)
+    lines = fetch_lines(grams) if grams else {}
+
+    if isinstance(node, And):
+        children = [_evaluate(child, postings, lines) for child in node.children]
+        children = [child for child in children if child is not None]
+        if not children:
+            return None
+        blocks = iter_intersection(children)
+    else:
+        result = _evaluate(node, postings, lines)
+        if result is None:
+            return None
+        blocks = iter([result])
+
+    if deleted is not None and len(deleted):
+        blocks = (block[~np.isin(block, deleted, assume_unique=True)] for block in blocks)
+    return (int(doc_id) for block in blocks for doc_id in block)
@@ -1,78 +1,105 @@
-import os
-import re
-import subprocess
-from functools import partial
-from multiprocessing import Pool
+import asyncio
+import threading
+import time
+from typing import AsyncIterator, Iterable, Iterator
 
-from git import Repo, exc
-from redis.client import Redis
+import numpy as np
+from sqlmodel import select
+from sqlmodel.sql.expression import Select
 
 from saku.core.config import SakuConfig
-from saku.core.utils import chunk, un_chunk
-from saku.db.connector import DbConnector
-from saku.db.models import Document
+from saku.core.metrics import COUNT_BUCKETS, METRICS, Timings
+from saku.core.repos import RepoRegistry
+from saku.db.connector import AsyncDbConnector, DbConnector, create_async_posting_reader, create_posting_store
+from saku.db.documents import DocumentTable
+from saku.db.models import Document, create_db_and_tables
+from saku.index.parser import DocumentParser
+from saku.index.planner import QueryPlanner, optimize_plan
+from saku.index.postings import QueryNode, blob_grams, line_grams, line_offsets, query_grams, search_postings
+from saku.index.verifier import MatchVerifier
 
-SEARCHER_PATH = "/home/raz/go/bin/saku_regex"
-GREPPER_PATH = "/usr/bin/pcregrep"
-ESCAPE = r"\.*+?^${}()|[]"
+COUNT_MODES = ("estimate", "exact")
 
+QUERY_STAGE_SECONDS = METRICS.histogram("saku_query_stage_seconds", "Time spent per stage of a search", label="stage")
+QUERY_CANDIDATES = METRICS.histogram("saku_query_candidates", "No. of candidate documents per search", COUNT_BUCKETS)
 
-def grep_match_detector(paths: list[str], regex: str, case_sensitive: bool):
-    args = [
-        "-I",  # Ignore binary files
-        "-l",  # List matching files names
-        "--buffer-size=1048576",  # 1 MB
-    ]
 
-    if not case_sensitive:
-        args.append("-i")
-    if "\n" in regex:
-        args.append("-M")  # Multiline mode
+def _read_text(path: str) -> str:
+    with open(path) as fp:
+        return fp.read()
 
-    for char in ESCAPE:
-        regex = regex.replace(char, f"\\{char}")
 
-    p = subprocess.run([GREPPER_PATH, *args, regex, *paths], stdout=subprocess.PIPE)
-    matching_files = [line for line in p.stdout.decode("utf-8").split("\n") if line]
-    return matching_files
+class _MatchCounter:
+    """Counts the matches among the verified candidates, picking out those on the requested page."""
 
+    def __init__(self, num_candidates: int, skip: int, limit: int, count_mode: str):
+        self.num_candidates = num_candidates
+        self.skip = skip
+        self.limit = limit
+        self.count_mode = count_mode
+        self.num_matched = 0
+        self.num_returned = 0
+        self.verified = 0
 
-class QueryEngine:
-    NGRAM_MATCHER = re.compile(r'"(.+?[^\\])"')
+    def add(self, paths: list[str], matched: bool) -> list[str]:
+        """Counts a group of identical documents, returning the paths on the page."""
+        self.verified += len(paths)
+        if not matched:
+            return []
+
+        page = []
+        for path in paths:
+            self.num_matched += 1
+            if self.skip < self.num_matched <= self.skip + self.limit:
+                self.num_returned += 1
+                page.append(path)
+        return page
+
+    @property
+    def done(self) -> bool:
+        return self.count_mode != "exact" and self.num_matched >= self.skip + self.limit
+
+    def summary(self, timings: Timings) -> dict:
+        total_exact = self.verified == self.num_candidates
+        total = self.num_matched if total_exact else round(self.num_matched * self.num_candidates / self.verified)
+        return {
+            "type": "summary",
+            "total": total,
+            "total_exact": total_exact,
+            "skip": self.skip,
+            "limit": self.num_returned,
+            "candidates": self.num_candidates,
+            "verified": self.verified,
+            "timings": timings.to_ms(),
+        }
 
+
+class QueryEngine:
     def __init__(self, config: SakuConfig):
         self.config = config
-        self.pool = Pool(12)
+        self.verifier = MatchVerifier(config.VERIFY_WORKERS)
         self.db = DbConnector(config.DATABASE_URI)
-        self.redis = Redis(host=config.REDIS_HOST, port=config.REDIS_PORT, db=0)
+        self.postings = create_posting_store(config)
+        # Connection pools of the async query path
+        self.async_db = AsyncDbConnector(
+            config.async_database_uri, config.DATABASE_POOL_SIZE, config.DATABASE_MAX_OVERFLOW
+        )
+        self.async_postings = create_async_posting_reader(config, self.postings)
+        self.parser = DocumentParser.from_config(config)
+        self.planner = QueryPlanner(self.parser, config.QUERY_PLAN_CACHE_SIZE)
+        self.repos = RepoRegistry(config.REPO_DIR)
+        self.documents = None
+        if config.QUERY_DOCUMENTS_IN_MEMORY:
+            # The database may not have been indexed into yet
+            create_db_and_tables(self.db.engine)
+            self.documents = DocumentTable(self.db, config.QUERY_DOCUMENTS_MAX_AGE)
+            self.documents.load()
 
-    @staticmethod
-    def generate_ngrams(regex: str) -> list[str] | None:
-        p = subprocess.run([SEARCHER_PATH, regex], stdout=subprocess.PIPE)
-        encoded_ngrams = [l for l in p.stdout.split(b"\n") if l]
-
-        ngram_strings = []
-        for ngram in encoded_ngrams:
-            ng = ngram.decode("unicode-escape")
-            if ng.startswith("("):
-                # Handle OR
-                matches = QueryEngine.NGRAM_MATCHER.findall(ng)
-                ngram_strings.append([f"ng:{ng}" for ng in matches])
-
-            elif ng.startswith('"'):
-                match = QueryEngine.NGRAM_MATCHER.match(ng)
-                ngram_strings.append(f"ng:{match.group(1)}")
-            elif ng == "+":
-                # Match all
-                return None
-
-            else:
-                # Case should not be encountered
-                return None
-
-        # ngram_strings = [ng.decode("unicode-escape") if ng]
-        # ngrams = [f"ng:{g[1:4]}" for g in ngram_strings if g[1:4]]
-        return ngram_strings
+    def generate_ngrams(self, regex: str, case_sensitive: bool = True) -> QueryNode | None:
+        return self.planner.plan(regex, case_sensitive)
+
+    def optimize(self, query_tree: QueryNode, frequencies: dict[bytes, int], num_documents: int) -> QueryNode | None:
+        return optimize_plan(query_tree, frequencies, num_documents, self.config.QUERY_MAX_MATCH_RATIO)
 
     def search(
         self,
@@ -83,67 +110,356 @@ class QueryEngine:
         size_lt: int | None = None,
         size_gt: int | None = None,
         path_like: str | None = None,
+        count_mode: str = "estimate",
+        context: int | None = None,
+        breakdown: bool = False,
     ):
-        ngrams = self.generate_ngrams(regex)
+        """Search documents matching the regex, latest modified first.
 
-        session = self.db.get_session()
-        query = session.query(Document)
+        Verification stops once `skip + limit` matches are found, and the total is
+        extrapolated from the verified candidates, unless `count_mode` is "exact".
+        Matches carry the whole file content, or only the matched lines with
+        `context` lines around them when it is given. With `breakdown`, the time
+        spent per stage and the no. of candidates are returned too.
+        """
+        events = self.iter_search(
+            regex, case_sensitive, skip, limit, size_lt, size_gt, path_like, count_mode, context, breakdown=breakdown
+        )
+        return self._search_result(list(events), skip, context, breakdown)
 
-        if size_gt is int and size_gt > 0:
-            query = query.filter(Document.size >= size_gt)
+    def iter_search(
+        self,
+        regex: str,
+        case_sensitive: bool,
+        skip: int = 0,
+        limit: int = 20,
+        size_lt: int | None = None,
+        size_gt: int | None = None,
+        path_like: str | None = None,
+        count_mode: str = "estimate",
+        context: int | None = None,
+        cancelled: threading.Event | None = None,
+        breakdown: bool = False,
+    ) -> Iterator[dict]:
+        """Like `search`, but yields a "match" event as soon as each match is verified.
 
-        if size_lt is int and size_lt > 0:
-            query = query.filter(Document.size <= size_lt)
+        A final "summary" event carries the totals and timings, which are only taken
+        while metrics are enabled or with `breakdown`. Invalid queries raise right away,
+        before any event is produced. Setting `cancelled` stops the verification.
+        """
+        if count_mode not in COUNT_MODES:
+            raise ValueError(f"Unknown count mode: {count_mode}")
 
-        if path_like:
-            query = query.filter(Document.path.regexp_match(path_like))
+        started_at = time.perf_counter()
+        timings = Timings(METRICS.enabled or breakdown)
+        with timings.stage("plan"):
+            query_tree = self.generate_ngrams(regex, case_sensitive)
 
-        if len(ngrams) > 1:
-            serialized_doc_ids = self.redis.sinter(*ngrams)
-            doc_ids = [int(x.decode()) for x in serialized_doc_ids]
-            query = query.filter(Document.id.in_(doc_ids))
+        if query_tree is not None:
+            with timings.stage("optimize"):
+                frequencies = self.postings.frequencies(query_grams(query_tree))
+                query_tree = self.optimize(query_tree, frequencies, self.postings.num_documents())
 
-        query = query.order_by(Document.last_modified.desc())
-        docs = list(query)
+        blob_ids = line_starts = None
+        if query_tree is not None:
+            with timings.stage("fetch"):
+                postings, lines = self.postings.get(blob_grams(query_tree)), self.postings.get_lines(
+                    line_grams(query_tree)
+                )
+                tombstones = self.postings.tombstones()
+            blob_ids, line_starts = self._prune(query_tree, postings, lines, tombstones, regex, case_sensitive, timings)
 
-        possible_matches = [d.path for d in docs]
-        possible_match_chunks = chunk(possible_matches, 100)
+        rows = self._candidates(blob_ids, size_lt, size_gt, path_like, timings)
 
-        match_detector = partial(grep_match_detector, regex=regex, case_sensitive=case_sensitive)
-        matched_file_chunks = self.pool.map(match_detector, possible_match_chunks)
-        matched_files = un_chunk(matched_file_chunks)
-        matched_files = list(filter(lambda x: x is not None, matched_files))
-        filtered_matches = matched_files[skip : skip + limit]
+        return self._iter_matches(
+            self._group_candidates(rows),
+            line_starts,
+            regex,
+            case_sensitive,
+            _MatchCounter(len(rows), skip, limit, count_mode),
+            context,
+            cancelled,
+            started_at,
+            timings,
+        )
 
-        matched_content = {
-            self.get_git_url(path): open(path).read() for path in filtered_matches if self.get_git_url(path)
-        }
-        return {
-            "total": len(matched_files),
+    async def asearch(
+        self,
+        regex: str,
+        case_sensitive: bool,
+        skip: int = 0,
+        limit: int = 20,
+        size_lt: int | None = None,
+        size_gt: int | None = None,
+        path_like: str | None = None,
+        count_mode: str = "estimate",
+        context: int | None = None,
+        breakdown: bool = False,
+    ):
+        """`search`, without blocking the event loop."""
+        events = await self.aiter_search(
+            regex, case_sensitive, skip, limit, size_lt, size_gt, path_like, count_mode, context, breakdown
+        )
+        events = [event async for event in events]
+        return self._search_result(events, skip, context, breakdown)
+
+    async def aiter_search(
+        self,
+        regex: str,
+        case_sensitive: bool,
+        skip: int = 0,
+        limit: int = 20,
+        size_lt: int | None = None,
+        size_gt: int | None = None,
+        path_like: str | None = None,
+        count_mode: str = "estimate",
+        context: int | None = None,
+        breakdown: bool = False,
+    ) -> AsyncIterator[dict]:
+        """`iter_search` over the pooled async connections, verifying on the shared process pool.
+
+        Invalid queries raise on awaiting, the events are then produced by the returned iterator.
+        Closing it stops the verification.
+        """
+        if count_mode not in COUNT_MODES:
+            raise ValueError(f"Unknown count mode: {count_mode}")
+
+        started_at = time.perf_counter()
+        timings = Timings(METRICS.enabled or breakdown)
+        # Planning, intersecting & filtering are CPU bound, and run on the default thread pool
+        with timings.stage("plan"):
+            query_tree = await asyncio.to_thread(self.generate_ngrams, regex, case_sensitive)
+
+        if query_tree is not None:
+            with timings.stage("optimize"):
+                frequencies, num_documents = await asyncio.gather(
+                    self.async_postings.frequencies(query_grams(query_tree)), self.async_postings.num_documents()
+                )
+                query_tree = self.optimize(query_tree, frequencies, num_documents)
+
+        blob_ids = line_starts = None
+        if query_tree is not None:
+            with timings.stage("fetch"):
+                postings, lines, tombstones = await asyncio.gather(
+                    self.async_postings.get(blob_grams(query_tree)),
+                    self.async_postings.get_lines(line_grams(query_tree)),
+                    self.async_postings.tombstones(),
+                )
+            blob_ids, line_starts = await asyncio.to_thread(
+                self._prune, query_tree, postings, lines, tombstones, regex, case_sensitive, timings
+            )
+
+        if self.documents is not None:
+            rows = await asyncio.to_thread(self._candidates, blob_ids, size_lt, size_gt, path_like, timings)
+        else:
+            with timings.stage("db"):
+                async with self.async_db.get_session() as session:
+                    rows = (await session.exec(self._candidates_query(blob_ids, size_lt, size_gt, path_like))).all()
+
+        return self._aiter_matches(
+            self._group_candidates(rows),
+            line_starts,
+            regex,
+            case_sensitive,
+            _MatchCounter(len(rows), skip, limit, count_mode),
+            context,
+            started_at,
+            timings,
+        )
+
+    @staticmethod
+    def _search_result(events: list[dict], skip: int, context: int | None, breakdown: bool) -> dict:
+        summary = events.pop()
+        field = "content" if context is None else "snippets"
+        result = {
+            "total": summary["total"],
+            "total_exact": summary["total_exact"],
             "skip": skip,
-            "limit": min(limit, len(filtered_matches)),
-            "matches": matched_content,
+            "limit": summary["limit"],
+            "matches": {event["file"]: event[field] for event in events},
         }
+        if breakdown:
+            result["breakdown"] = {key: summary[key] for key in ("candidates", "verified", "timings")}
+        return result
+
+    def _prune(
+        self,
+        query_tree: QueryNode,
+        postings: dict,
+        lines: dict,
+        tombstones: np.ndarray,
+        regex: str,
+        case_sensitive: bool,
+        timings: Timings,
+    ) -> tuple[list[int], dict[int, np.ndarray] | None]:
+        """Ids of the candidate blobs, and the lines to verify in them."""
+        blob_ids = self._intersect(query_tree, postings, lines, tombstones, timings)
+        return blob_ids, self._line_starts(query_tree, lines, regex, case_sensitive, timings)
+
+    @staticmethod
+    def _intersect(
+        query_tree: QueryNode, postings: dict, lines: dict, tombstones: np.ndarray, timings: Timings
+    ) -> list[int]:
+        with timings.stage("intersect"):
+            return list(search_postings(query_tree, lambda _: postings, tombstones, lambda _: lines))
+
+    def _line_starts(
+        self, query_tree: QueryNode, lines: dict, regex: str, case_sensitive: bool, timings: Timings
+    ) -> dict[int, np.ndarray] | None:
+        """Offsets of the lines of every candidate blob that the matches of a literal regex can be on."""
+        # Matches of other regexes may start on lines before those of their grams
+        if not self.planner.is_literal(regex, case_sensitive):
+            return None
+        with timings.stage("intersect"):
+            return line_offsets(query_tree, lines)
+
+    def _candidates(
+        self,
+        blob_ids: list[int] | None,
+        size_lt: int | None,
+        size_gt: int | None,
+        path_like: str | None,
+        timings: Timings,
+    ) -> list[tuple[str, int | None]]:
+        """Paths & blob ids of the candidate documents, latest modified first."""
+        if self.documents is not None:
+            with timings.stage("filter"):
+                return self.documents.candidates(blob_ids, size_lt, size_gt, path_like)
+        with timings.stage("db"), self.db.get_session() as session:
+            return session.exec(self._candidates_query(blob_ids, size_lt, size_gt, path_like)).all()
+
+    @staticmethod
+    def _candidates_query(
+        blob_ids: Iterable[int] | None, size_lt: int | None, size_gt: int | None, path_like: str | None
+    ) -> Select:
+        query = select(Document.path, Document.blob_id)
+
+        if size_gt is not None and size_gt > 0:
+            query = query.where(Document.size >= size_gt)
+
+        if size_lt is not None and size_lt > 0:
+            query = query.where(Document.size <= size_lt)
+
+        if path_like:
+            query = query.where(Document.path.regexp_match(path_like))
+
+        if blob_ids is not None:
+            query = query.where(Document.blob_id.in_(list(blob_ids)))
 
-    def get_git_url(self, path: str) -> str:
-        dirs = next(os.walk(self.config.REPO_DIR))[1]
-        for dir in dirs:
-            repo_path = os.path.join(self.config.REPO_DIR, dir)
-            try:
-                _ = Repo(repo_path).git_dir
-            except exc.InvalidGitRepositoryError:
+        return query.order_by(Document.last_modified.desc())
+
+    @staticmethod
+    def _group_candidates(rows: list[tuple[str, int | None]]) -> dict[int | str, list[str]]:
+        # Documents with identical content are verified once, through their latest modified path
+        possible_matches: dict[int | str, list[str]] = {}
+        for path, blob_id in rows:
+            possible_matches.setdefault(blob_id or path, []).append(path)
+        return possible_matches
+
+    @staticmethod
+    def _verify_args(
+        possible_matches: dict[int | str, list[str]], line_starts: dict[int, np.ndarray] | None
+    ) -> tuple[list[str], list[np.ndarray | None] | None]:
+        # Paths to verify, with the lines to search in each of them
+        first_paths = [paths[0] for paths in possible_matches.values()]
+        if line_starts is None:
+            return first_paths, None
+        return first_paths, [line_starts.get(key) for key in possible_matches]
+
+    def _match_events(
+        self, paths: list[str], snippets: list[dict], context: int | None, timings: Timings
+    ) -> list[dict]:
+        # Every copy of the content matches alike
+        events = []
+        for path in paths:
+            with timings.stage("url"):
+                url = self.get_git_url(path)
+            if not url:
                 continue
+            if context is not None:
+                events.append({"type": "match", "file": url, "path": path, "snippets": snippets})
+                continue
+            with timings.stage("read"):
+                content = _read_text(path)
+            events.append({"type": "match", "file": url, "path": path, "content": content})
+        return events
+
+    def _iter_matches(
+        self,
+        possible_matches: dict[int | str, list[str]],
+        line_starts: dict[int, np.ndarray] | None,
+        regex: str,
+        case_sensitive: bool,
+        counter: _MatchCounter,
+        context: int | None,
+        cancelled: threading.Event | None,
+        started_at: float,
+        timings: Timings,
+    ) -> Iterator[dict]:
+        verify_started_at = time.perf_counter()
+        first_paths, starts = self._verify_args(possible_matches, line_starts)
+        matches = self.verifier.iter_matches(first_paths, regex, case_sensitive, context, starts)
+        try:
+            for paths, (_, snippets) in zip(possible_matches.values(), matches):
+                if cancelled is not None and cancelled.is_set():
+                    return
+                yield from self._match_events(counter.add(paths, snippets is not None), snippets, context, timings)
+                if snippets is not None and counter.done:
+                    break
+        finally:
+            matches.close()
+
+        yield self._summary(counter, verify_started_at, started_at, timings)
+
+    async def _aiter_matches(
+        self,
+        possible_matches: dict[int | str, list[str]],
+        line_starts: dict[int, np.ndarray] | None,
+        regex: str,
+        case_sensitive: bool,
+        counter: _MatchCounter,
+        context: int | None,
+        started_at: float,
+        timings: Timings,
+    ) -> AsyncIterator[dict]:
+        verify_started_at = time.perf_counter()
+        first_paths, starts = self._verify_args(possible_matches, line_starts)
+        matches = self.verifier.aiter_matches(first_paths, regex, case_sensitive, context, starts)
+        try:
+            groups = iter(possible_matches.values())
+            async for _, snippets in matches:
+                page = counter.add(next(groups), snippets is not None)
+                if page:
+                    # Resolving URLs & reading files block, off the event loop
+                    for event in await asyncio.to_thread(self._match_events, page, snippets, context, timings):
+                        yield event
+                if snippets is not None and counter.done:
+                    break
+        finally:
+            await matches.aclose()
+
+        yield self._summary(counter, verify_started_at, started_at, timings)
+
+    @staticmethod
+    def _summary(counter: _MatchCounter, verify_started_at: float, started_at: float, timings: Timings) -> dict:
+        finished_at = time.perf_counter()
+        # Reading files & resolving URLs happen within the verification loop, but are told apart
+        timings.add("verify", finished_at - verify_started_at - timings.get("read") - timings.get("url"))
+        timings.add("total", finished_at - started_at)
+        timings.observe(QUERY_STAGE_SECONDS)
+        QUERY_CANDIDATES.observe(counter.num_candidates)
+        return counter.summary(timings)
+
+    async def aclose(self) -> None:
+        await self.async_postings.close()
+        await self.async_db.close()
+        self.verifier.close()
+
+    def refresh_repos(self) -> None:
+        self.repos.refresh()
 
-            repo = Repo(repo_path)
-            if path.startswith(repo_path):
-                relative_path = path[len(repo_path) :]
-                if relative_path.startswith("/.git"):
-                    return None
-                remote = repo.remotes.origin.url
-                remote = remote.replace("git@github.com:", "https://github.com/")
-                remote = remote.rstrip(".git")
-                return f"{remote}/blob/master{relative_path}"
-        return path
+    def get_git_url(self, path: str) -> str | None:
+        return self.repos.get_url(path)
 
 
 if __name__ == "__main__":
@@ -151,4 +467,4 @@ if __name__ == "__main__":
     # q = QueryEngine(config)
     # res = q.search("Arch", True)
     # print(res)
-    print(QueryEngine.generate_ngrams("(raz)|(taz)test"))
+    print(QueryPlanner(DocumentParser(3)).plan("(raz)|(taz)test"))
@@ -0,0 +1,173 @@
+import codecs
+import mimetypes
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Iterable, Iterator
+
+import magic
+from pathspec import GitIgnoreSpec
+
+# Bytes read from the start of a file to tell text from binary
+HEADER_SIZE = 8192
+# Skipped without reading them
+BINARY_EXTENSIONS = frozenset(
+    {
+        *(".png", ".jpg", ".jpeg", ".gif", ".bmp", ".ico", ".webp", ".tiff", ".psd"),
+        *(".zip", ".gz", ".tgz", ".bz2", ".xz", ".zst", ".7z", ".rar", ".tar", ".jar", ".whl"),
+        *(".so", ".dll", ".dylib", ".exe", ".o", ".a", ".lib", ".class", ".pyc", ".pyo", ".wasm"),
+        *(".pdf", ".mp3", ".mp4", ".mov", ".avi", ".wav", ".flac", ".ogg", ".ttf", ".otf", ".woff", ".woff2"),
+        *(".sqlite", ".db", ".npy", ".npz", ".pkl", ".bin", ".dat"),
+    }
+)
+TEXT_MIME_TYPE = "text/plain"
+BINARY_MIME_TYPE = "application/octet-stream"
+EMPTY_MIME_TYPE = "inode/x-empty"
+
+
+@dataclass(frozen=True)
+class ScannedFile:
+    path: str
+    size: int
+    last_modified: float
+
+
+class IgnoreRules:
+    """The .gitignore files in effect for a directory, from the scanned root down to it.
+
+    A path is ignored when any of the files matches it, negations only apply within their own file.
+    """
+
+    def __init__(self, rules: tuple[tuple[str, GitIgnoreSpec], ...] = ()):
+        self.rules = rules
+
+    def child(self, dir_path: str) -> "IgnoreRules":
+        try:
+            with open(os.path.join(dir_path, ".gitignore"), encoding="utf-8", errors="replace") as fp:
+                spec = GitIgnoreSpec.from_lines(fp)
+        except OSError:
+            return self
+        return IgnoreRules(self.rules + ((dir_path, spec),))
+
+    def is_ignored(self, path: str, is_dir: bool) -> bool:
+        for base_dir, spec in self.rules:
+            relative_path = path[len(base_dir) + 1 :]
+            if spec.match_file(relative_path + "/" if is_dir else relative_path):
+                return True
+        return False
+
+
+class FileScanner:
+    """Lists the files under a directory, scanning its sub directories across threads.
+
+    Excluded & git ignored directories are never descended into. Hidden files
+    and files larger than `max_file_size` are left out.
+    """
+
+    def __init__(self, excludes: Iterable[str], max_file_size: int, workers: int = 8):
+        self.excludes = frozenset(excludes)
+        self.max_file_size = max_file_size
+        self.workers = workers
+
+    def is_excluded(self, relative_path: str) -> bool:
+        *dirs, name = relative_path.split("/")
+        return name.startswith(".") or any(d in self.excludes for d in dirs)
+
+    def is_listed(self, path: str) -> bool:
+        """Whether scanning would list the file at `path`, leaving aside exclusions & ignore rules."""
+        try:
+            return os.path.isfile(path) and os.path.getsize(path) <= self.max_file_size
+        except OSError:
+            return False
+
+    def scan(self, root: str, skipped: Iterable[str] = ()) -> Iterator[ScannedFile]:
+        """Yields the files under `root`, without descending into the `skipped` directories."""
+        skipped = frozenset(skipped)
+        if root in skipped:
+            return
+
+        executor = ThreadPoolExecutor(self.workers)
+        try:
+            pending = {executor.submit(self._scan_dir, root, IgnoreRules(), skipped)}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    files, sub_dirs = future.result()
+                    yield from files
+                    pending.update(executor.submit(self._scan_dir, d, rules, skipped) for d, rules in sub_dirs)
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+    def _scan_dir(
+        self, dir_path: str, rules: IgnoreRules, skipped: frozenset[str]
+    ) -> tuple[list[ScannedFile], list[tuple[str, IgnoreRules]]]:
+        rules = rules.child(dir_path)
+        files, sub_dirs = [], []
+        try:
+            entries = list(os.scandir(dir_path))
+        except OSError:
+            return files, sub_dirs
+
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name in self.excludes or entry.path in skipped or rules.is_ignored(entry.path, True):
+                        continue
+                    sub_dirs.append((entry.path, rules))
+                elif entry.is_file() and not entry.name.startswith("."):
+                    if rules.is_ignored(entry.path, False):
+                        continue
+                    stat = entry.stat()
+                    if stat.st_size <= self.max_file_size:
+                        files.append(ScannedFile(entry.path, stat.st_size, stat.st_mtime))
+            except OSError:
+                # Removed while scanning
+                continue
+        return files, sub_dirs
+
+
+@lru_cache(maxsize=1024)
+def _extension_mime_type(extension: str) -> str | None:
+    return mimetypes.guess_type(f"file{extension}", strict=False)[0]
+
+
+def _classify_header(header: bytes) -> bool | None:
+    """Whether the header is text, or `None` when it cannot be told cheaply."""
+    if header.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return None
+    if b"\0" in header:
+        return False
+    try:
+        # Incremental, so that a character cut off by the header still decodes
+        codecs.getincrementaldecoder("utf-8")().decode(header, final=False)
+        return True
+    except UnicodeDecodeError:
+        return None
+
+
+class FileTypeDetector:
+    """Detects mime types from file extensions & a small header read, only asking libmagic when unsure."""
+
+    def __init__(self, header_size: int = HEADER_SIZE):
+        self.header_size = header_size
+
+    def mime_type(self, path: str) -> str:
+        extension = os.path.splitext(path)[1].lower()
+        extension_mime_type = _extension_mime_type(extension)
+        if extension in BINARY_EXTENSIONS:
+            return extension_mime_type or BINARY_MIME_TYPE
+
+        with open(path, "rb") as fp:
+            header = fp.read(self.header_size)
+        if not header:
+            return EMPTY_MIME_TYPE
+
+        is_text = _classify_header(header)
+        if is_text is None:
+            return magic.from_file(path, mime=True)
+
+        extension_is_text = extension_mime_type is not None and extension_mime_type.startswith("text")
+        if is_text:
+            return extension_mime_type if extension_is_text else TEXT_MIME_TYPE
+        return BINARY_MIME_TYPE if extension_is_text else extension_mime_type or BINARY_MIME_TYPE
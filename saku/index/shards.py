@@ -0,0 +1,287 @@
+import asyncio
+import heapq
+import itertools
+import multiprocessing
+import os
+import time
+import zlib
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import AsyncIterator, Iterator
+
+from sqlalchemy.engine import make_url
+from sqlmodel import select
+
+from saku.core.config import SakuConfig
+from saku.db.models import Document
+from saku.index.indexer import Indexer, StageStats, new_stage_stats
+from saku.index.parser import DocumentParser
+from saku.index.planner import QueryPlanner
+from saku.index.query import COUNT_MODES, QueryEngine
+
+
+def shard_of(repo_name: str, num_shards: int) -> int:
+    # Stable across processes & restarts, unlike hash()
+    return zlib.crc32(repo_name.encode()) % num_shards
+
+
+def shard_config(config: SakuConfig, shard: int) -> SakuConfig:
+    """The config of one shard, whose postings & documents are kept apart from the other shards.
+
+    Shards get their own segments directory, Redis database and SQLite file or Postgres database
+    (suffixed with the shard, which has to exist).
+    """
+    url = make_url(config.DATABASE_URI)
+    if url.get_backend_name() == "sqlite":
+        root, extension = os.path.splitext(url.database)
+        url = url.set(database=f"{root}-shard{shard}{extension}")
+    else:
+        url = url.set(database=f"{url.database}_shard{shard}")
+
+    verify_workers = max((config.VERIFY_WORKERS or os.cpu_count()) // config.SHARDS, 1)
+    return config.copy(
+        update={
+            "SEGMENTS_DIR": os.path.join(config.SEGMENTS_DIR, f"shard{shard}"),
+            "REDIS_DB": config.REDIS_DB + shard,
+            "DATABASE_URI": url.render_as_string(hide_password=False),
+            "VERIFY_WORKERS": verify_workers,
+        }
+    )
+
+
+class ShardedIndexer:
+    """Indexes every repository under `REPO_DIR` into the shard it belongs to.
+
+    Files lying right in `REPO_DIR`, outside of any repository, are not indexed.
+    """
+
+    def __init__(self, config: SakuConfig):
+        self.config = config
+        self.repo_dir = os.path.abspath(config.REPO_DIR)
+        self.indexers = [Indexer(shard_config(config, shard)) for shard in range(config.SHARDS)]
+
+    def indexer_for(self, repo_path: str) -> Indexer:
+        return self.indexers[shard_of(os.path.basename(repo_path), self.config.SHARDS)]
+
+    def index_directory(self, dir_path: str, stats: dict[str, StageStats] | None = None) -> None:
+        dir_path = os.path.abspath(dir_path)
+        stats = stats or new_stage_stats()
+        if dir_path == self.repo_dir:
+            for entry in os.scandir(dir_path):
+                if entry.is_dir():
+                    self.indexer_for(entry.path).index_directory(entry.path, stats)
+            return
+
+        relative_path = os.path.relpath(dir_path, self.repo_dir)
+        if relative_path.startswith(".."):
+            raise ValueError(f"{dir_path} is not within {self.repo_dir}")
+        repo_path = os.path.join(self.repo_dir, relative_path.split(os.sep)[0])
+        self.indexer_for(repo_path).index_directory(dir_path, stats)
+
+
+# Query engine of the current shard process
+_shard_engine: QueryEngine | None = None
+
+
+def _init_shard(config: SakuConfig) -> None:
+    global _shard_engine
+    _shard_engine = QueryEngine(config)
+
+
+def _search_shard(
+    regex: str,
+    case_sensitive: bool,
+    limit: int,
+    size_lt: int | None,
+    size_gt: int | None,
+    path_like: str | None,
+    count_mode: str,
+    context: int | None,
+) -> list[dict]:
+    """The first `limit` matches of the shard and its summary, matches carrying their modification time."""
+    events = list(
+        _shard_engine.iter_search(regex, case_sensitive, 0, limit, size_lt, size_gt, path_like, count_mode, context)
+    )
+    paths = [event["path"] for event in events[:-1]]
+    if _shard_engine.documents is not None:
+        last_modified = _shard_engine.documents.last_modified(paths)
+    else:
+        with _shard_engine.db.get_session() as session:
+            rows = session.exec(select(Document.path, Document.last_modified).where(Document.path.in_(paths))).all()
+        last_modified = {path: modified.timestamp() for path, modified in rows}
+    for event in events[:-1]:
+        event["last_modified"] = last_modified.get(event["path"], 0.0)
+    return events
+
+
+def _refresh_shard() -> None:
+    _shard_engine.refresh_repos()
+
+
+def _close_shard() -> None:
+    # Exiting pool workers wait on their own children, which would never be told to stop
+    _shard_engine.verifier.close()
+
+
+def merge_shard_results(shard_results: list[list[dict]], skip: int, limit: int) -> list[dict]:
+    """Merges the matches of every shard, latest modified first, and the page of them after their summary."""
+    summaries = [events[-1] for events in shard_results]
+    matches = heapq.merge(*(events[:-1] for events in shard_results), key=lambda event: -event["last_modified"])
+    page = []
+    for event in itertools.islice(matches, skip, skip + limit):
+        event = dict(event)
+        del event["last_modified"]
+        page.append(event)
+
+    timings = {}
+    for summary in summaries:
+        for stage, ms in summary["timings"].items():
+            # Shards run side by side, the slowest one sets the pace
+            timings[stage] = max(timings.get(stage, 0.0), ms)
+    summary = {
+        "type": "summary",
+        "total": sum(summary["total"] for summary in summaries),
+        "total_exact": all(summary["total_exact"] for summary in summaries),
+        "skip": skip,
+        "limit": len(page),
+        "candidates": sum(summary["candidates"] for summary in summaries),
+        "verified": sum(summary["verified"] for summary in summaries),
+        "timings": timings,
+    }
+    return page + [summary]
+
+
+class ShardedQueryEngine:
+    """Scatters every search over the shard processes, and gathers their matches into a single page.
+
+    Each shard returns its first `skip + limit` matches, so that the page is the same as the one
+    of a single index holding all of them. Matches are only streamed once every shard is done.
+    """
+
+    def __init__(self, config: SakuConfig):
+        self.config = config
+        self.planner = QueryPlanner(DocumentParser.from_config(config), config.QUERY_PLAN_CACHE_SIZE)
+        # Forking a process running threads, like the app's, may leave locks held in the child
+        context = multiprocessing.get_context("spawn")
+        self.shards = [
+            ProcessPoolExecutor(1, context, _init_shard, (shard_config(config, shard),))
+            for shard in range(config.SHARDS)
+        ]
+
+    def _scatter(
+        self,
+        regex: str,
+        case_sensitive: bool,
+        skip: int,
+        limit: int,
+        size_lt: int | None,
+        size_gt: int | None,
+        path_like: str | None,
+        count_mode: str,
+        context: int | None,
+    ) -> list[Future]:
+        if count_mode not in COUNT_MODES:
+            raise ValueError(f"Unknown count mode: {count_mode}")
+        # Fail early on invalid regexes, instead of in every shard
+        self.planner.plan(regex, case_sensitive)
+
+        args = (regex, case_sensitive, skip + limit, size_lt, size_gt, path_like, count_mode, context)
+        return [shard.submit(_search_shard, *args) for shard in self.shards]
+
+    @staticmethod
+    def _gather(shard_results: list[list[dict]], skip: int, limit: int, started_at: float) -> list[dict]:
+        events = merge_shard_results(shard_results, skip, limit)
+        events[-1]["timings"]["total"] = round((time.perf_counter() - started_at) * 1000, 3)
+        return events
+
+    def search(
+        self,
+        regex: str,
+        case_sensitive: bool,
+        skip: int = 0,
+        limit: int = 20,
+        size_lt: int | None = None,
+        size_gt: int | None = None,
+        path_like: str | None = None,
+        count_mode: str = "estimate",
+        context: int | None = None,
+        breakdown: bool = False,
+    ):
+        events = list(
+            self.iter_search(regex, case_sensitive, skip, limit, size_lt, size_gt, path_like, count_mode, context)
+        )
+        return QueryEngine._search_result(events, skip, context, breakdown)
+
+    def iter_search(
+        self,
+        regex: str,
+        case_sensitive: bool,
+        skip: int = 0,
+        limit: int = 20,
+        size_lt: int | None = None,
+        size_gt: int | None = None,
+        path_like: str | None = None,
+        count_mode: str = "estimate",
+        context: int | None = None,
+    ) -> Iterator[dict]:
+        started_at = time.perf_counter()
+        futures = self._scatter(regex, case_sensitive, skip, limit, size_lt, size_gt, path_like, count_mode, context)
+        return iter(self._gather([future.result() for future in futures], skip, limit, started_at))
+
+    async def asearch(
+        self,
+        regex: str,
+        case_sensitive: bool,
+        skip: int = 0,
+        limit: int = 20,
+        size_lt: int | None = None,
+        size_gt: int | None = None,
+        path_like: str | None = None,
+        count_mode: str = "estimate",
+        context: int | None = None,
+        breakdown: bool = False,
+    ):
+        events = await self.aiter_search(
+            regex, case_sensitive, skip, limit, size_lt, size_gt, path_like, count_mode, context
+        )
+        events = [event async for event in events]
+        return QueryEngine._search_result(events, skip, context, breakdown)
+
+    async def aiter_search(
+        self,
+        regex: str,
+        case_sensitive: bool,
+        skip: int = 0,
+        limit: int = 20,
+        size_lt: int | None = None,
+        size_gt: int | None = None,
+        path_like: str | None = None,
+        count_mode: str = "estimate",
+        context: int | None = None,
+    ) -> AsyncIterator[dict]:
+        started_at = time.perf_counter()
+        futures = self._scatter(regex, case_sensitive, skip, limit, size_lt, size_gt, path_like, count_mode, context)
+        try:
+            shard_results = await asyncio.gather(*map(asyncio.wrap_future, futures))
+        except asyncio.CancelledError:
+            for future in futures:
+                future.cancel()
+            raise
+
+        async def events() -> AsyncIterator[dict]:
+            for event in self._gather(shard_results, skip, limit, started_at):
+                yield event
+
+        return events()
+
+    def refresh_repos(self) -> None:
+        for future in [shard.submit(_refresh_shard) for shard in self.shards]:
+            future.result()
+
+    def close(self) -> None:
+        for future in [shard.submit(_close_shard) for shard in self.shards]:
+            future.result()
+        for shard in self.shards:
+            shard.shutdown(cancel_futures=True)
+
+    async def aclose(self) -> None:
+        self.close()
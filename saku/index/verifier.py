@@ -0,0 +1,237 @@
+import asyncio
+import itertools
+import mmap
+import multiprocessing
+import os
+import re
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from functools import lru_cache
+from typing import AsyncIterator, Iterator, Sequence
+
+from saku.index.postings import MAX_LINE_OFFSET
+
+VERIFY_CHUNK_SIZE = 16
+# Matches beyond this are not reported in snippets
+MAX_SNIPPET_MATCHES = 100
+
+
+@lru_cache(maxsize=128)
+def compile_pattern(regex: str, case_sensitive: bool) -> re.Pattern:
+    flags = re.MULTILINE if case_sensitive else re.MULTILINE | re.IGNORECASE
+    if regex.isascii():
+        # Match raw bytes straight out of the memory mapped file
+        return re.compile(regex.encode("ascii"), flags)
+    return re.compile(regex, flags)
+
+
+def _read_document(path: str) -> bytes:
+    with open(path, "rb") as fp:
+        return fp.read()
+
+
+def _lines_match(buffer: mmap.mmap, pattern: re.Pattern, line_starts: Sequence[int]) -> bool:
+    # Only the pages of the given lines are read, each searched along with its line break
+    for start in line_starts:
+        end = buffer.find(b"\n", start) + 1
+        if start == MAX_LINE_OFFSET or not end:
+            # Past the last offset that can be indexed, or on the last line
+            end = len(buffer)
+        if pattern.search(buffer, start, end) is not None:
+            return True
+    return False
+
+
+def document_matches(path: str, pattern: re.Pattern, line_starts: Sequence[int] | None = None) -> bool:
+    """Whether the document has a match, which can only be on the lines starting at `line_starts` when given."""
+    try:
+        with open(path, "rb") as fp:
+            if not os.fstat(fp.fileno()).st_size:
+                return pattern.search(b"" if isinstance(pattern.pattern, bytes) else "") is not None
+
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                if isinstance(pattern.pattern, bytes):
+                    if line_starts is not None:
+                        return _lines_match(buffer, pattern, line_starts)
+                    return pattern.search(buffer) is not None
+                # Decoded slices would lose what comes before them, so non ASCII patterns search the whole text
+                return pattern.search(buffer[:].decode("utf-8", "surrogateescape")) is not None
+    except (OSError, ValueError):
+        # Deleted or unreadable since indexing
+        return False
+
+
+def _match_spans(data: bytes, pattern: re.Pattern) -> Iterator[tuple[int, int]]:
+    # Byte offsets of every match
+    if isinstance(pattern.pattern, bytes):
+        for m in pattern.finditer(data):
+            yield m.span()
+        return
+
+    text = data.decode("utf-8", "surrogateescape")
+    char_pos = byte_pos = 0
+    for m in pattern.finditer(text):
+        byte_pos += len(text[char_pos : m.start()].encode("utf-8", "surrogateescape"))
+        byte_end = byte_pos + len(m.group().encode("utf-8", "surrogateescape"))
+        char_pos = m.start()
+        yield byte_pos, byte_end
+
+
+def find_snippets(data: bytes, pattern: re.Pattern, context: int) -> list[dict]:
+    """Group the matches in `data` into snippets of the matched lines with `context` lines around them.
+
+    Lines are 1-based and inclusive, offsets are in bytes from the start of the document.
+    """
+    snippets = []
+    line, line_pos = 1, 0
+
+    for start, end in itertools.islice(_match_spans(data, pattern), MAX_SNIPPET_MATCHES):
+        line += data.count(b"\n", line_pos, start)
+        line_pos = start
+        end_line = line + data.count(b"\n", start, max(start, end - 1))
+
+        if snippets and line - context <= snippets[-1]["end_line"] + context + 1:
+            snippet = snippets[-1]
+            snippet["end_line"] = max(snippet["end_line"], end_line)
+        else:
+            snippet = {"start_line": line, "end_line": end_line, "match_lines": set(), "spans": []}
+            snippets.append(snippet)
+        snippet["match_lines"].update(range(line, end_line + 1))
+        snippet["spans"].append((start, end))
+
+    # Widen every snippet by the context lines, and cut it out of the document
+    line_starts = [0] + [m.end() for m in re.finditer(b"\n", data)]
+    if len(line_starts) > 1 and line_starts[-1] == len(data):
+        # No line after the trailing newline
+        line_starts.pop()
+    for snippet in snippets:
+        snippet["end_line"] = min(snippet["end_line"] + context, len(line_starts))
+        snippet["start_line"] = min(max(snippet["start_line"] - context, 1), snippet["end_line"])
+        start_offset = line_starts[snippet["start_line"] - 1]
+        end_offset = line_starts[snippet["end_line"]] if snippet["end_line"] < len(line_starts) else len(data)
+        snippet["start_offset"], snippet["end_offset"] = start_offset, end_offset
+        snippet["content"] = data[start_offset:end_offset].decode("utf-8", "replace")
+        snippet["match_lines"] = sorted(snippet["match_lines"])
+    return snippets
+
+
+def document_snippets(path: str, pattern: re.Pattern, context: int) -> list[dict]:
+    try:
+        return find_snippets(_read_document(path), pattern, context)
+    except OSError:
+        return []
+
+
+def match_documents(
+    paths: list[str],
+    regex: str,
+    case_sensitive: bool,
+    context: int | None = None,
+    line_starts: list[Sequence[int] | None] | None = None,
+) -> list[list[dict] | None]:
+    """Returns the snippets of every matching path (empty without `context`) and `None` for the others.
+
+    The matches of a path may be narrowed down to some of its lines, by their offsets in `line_starts`.
+    """
+    pattern = compile_pattern(regex, case_sensitive)
+    results = []
+    for path, starts in zip(paths, line_starts or itertools.repeat(None)):
+        if not document_matches(path, pattern, starts):
+            results.append(None)
+        elif context is None:
+            results.append([])
+        else:
+            results.append(document_snippets(path, pattern, context))
+    return results
+
+
+class MatchVerifier:
+    """Verifies candidate documents against a regex across a process pool.
+
+    Candidates are verified in order and only a bounded window of chunks runs
+    ahead of the consumer, so that stopping early leaves no work behind.
+    """
+
+    def __init__(self, workers: int | None = None, chunk_size: int = VERIFY_CHUNK_SIZE):
+        self.workers = workers or os.cpu_count()
+        self.chunk_size = chunk_size
+        # Worker processes are only started on the first submission. Forking a process running
+        # threads, like the app's, may leave locks held in the child
+        self.executor = ProcessPoolExecutor(self.workers, multiprocessing.get_context("spawn"))
+
+    def _iter_chunks(
+        self,
+        paths: list[str],
+        regex: str,
+        case_sensitive: bool,
+        context: int | None,
+        line_starts: list[Sequence[int] | None] | None,
+    ) -> Iterator[tuple[list[str], Future]]:
+        """Yields the chunks of paths in order with their verification futures, submitting a new one per chunk taken."""
+        compile_pattern(regex, case_sensitive)  # Fail early on invalid regexes
+
+        chunks = (
+            (paths[i : i + self.chunk_size], line_starts and line_starts[i : i + self.chunk_size])
+            for i in range(0, len(paths), self.chunk_size)
+        )
+        pending: deque[tuple[list[str], Future]] = deque()
+
+        def submit_next() -> None:
+            paths_chunk, starts_chunk = next(chunks, (None, None))
+            if paths_chunk is not None:
+                future = self.executor.submit(
+                    match_documents, paths_chunk, regex, case_sensitive, context, starts_chunk
+                )
+                pending.append((paths_chunk, future))
+
+        try:
+            for _ in range(2 * self.workers):
+                submit_next()
+
+            while pending:
+                paths_chunk, future = pending.popleft()
+                submit_next()
+                yield paths_chunk, future
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+    def iter_matches(
+        self,
+        paths: list[str],
+        regex: str,
+        case_sensitive: bool,
+        context: int | None = None,
+        line_starts: list[Sequence[int] | None] | None = None,
+    ) -> Iterator[tuple[str, list[dict] | None]]:
+        """Yields every path in the given order, with its snippets if it matches or else `None`.
+
+        Snippets are only computed when `context` lines are requested. Paths with `line_starts`
+        are only searched on those lines.
+        """
+        chunks = self._iter_chunks(paths, regex, case_sensitive, context, line_starts)
+        try:
+            for paths_chunk, future in chunks:
+                yield from zip(paths_chunk, future.result())
+        finally:
+            chunks.close()
+
+    async def aiter_matches(
+        self,
+        paths: list[str],
+        regex: str,
+        case_sensitive: bool,
+        context: int | None = None,
+        line_starts: list[Sequence[int] | None] | None = None,
+    ) -> AsyncIterator[tuple[str, list[dict] | None]]:
+        """Like `iter_matches`, awaiting the workers instead of blocking on them."""
+        chunks = self._iter_chunks(paths, regex, case_sensitive, context, line_starts)
+        try:
+            for paths_chunk, future in chunks:
+                for match in zip(paths_chunk, await asyncio.wrap_future(future)):
+                    yield match
+        finally:
+            chunks.close()
+
+    def close(self) -> None:
+        self.executor.shutdown(cancel_futures=True)
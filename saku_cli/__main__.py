@@ -1,10 +1,13 @@
+import os
+import time
+
+import requests
 import typer
 from rich.console import Console
-from rich.progress import Progress
+from rich.progress import BarColumn, MofNCompleteColumn, Progress, TextColumn, TimeElapsedColumn
 from rich.syntax import Syntax
 
-from saku_cli.api import clone_request, index_request, search_request
-from saku_cli.utils import find_matching_lines
+from saku_cli.api import clone_request, error_detail, index_request, job_request, search_stream_request
 
 # COLORS
 BLACK = "#000000"
@@ -25,14 +28,73 @@ def clone(url: str):
 
 
 @app.command()
-def index():
-    console.print(f"Indexing...")
-    with Progress(transient=True) as progress:
-        progress.add_task("Index", start=False, total=None)
-        index_request()
+def index(name: str = typer.Argument(None, help="Repo to index, all of them if not given")):
+    try:
+        jobs = index_request(name)["jobs"]
+    except requests.HTTPError as e:
+        console.print(error_detail(e), style=BRIGHT_RED)
+        raise typer.Exit(1)
+    console.print(f"Indexing {len(jobs)} repos...")
+
+    columns = (
+        TextColumn("{task.description}"),
+        BarColumn(),
+        MofNCompleteColumn(),
+        TextColumn("{task.fields[rate]}"),
+        TextColumn("ETA {task.fields[eta]}"),
+        TimeElapsedColumn(),
+    )
+    failed = []
+    with Progress(*columns, console=console) as progress:
+        tasks = {
+            job["id"]: progress.add_task(os.path.basename(job["path"]), total=None, rate="", eta="-") for job in jobs
+        }
+        while tasks:
+            time.sleep(0.5)
+            for job_id, task in list(tasks.items()):
+                job = job_request(job_id)
+                rate = job["stages"]["metadata"]["docs_per_sec"]
+                eta = "-" if job["eta_sec"] is None else f"{job['eta_sec']:.0f}s"
+                progress.update(
+                    task,
+                    description=f"{os.path.basename(job['path'])} [{job['stage']}]",
+                    total=job["files_total"],
+                    completed=job["files_processed"],
+                    rate=f"{rate:.0f} files/s",
+                    eta=eta,
+                )
+                if job["status"] in ("completed", "failed"):
+                    progress.stop_task(task)
+                    del tasks[job_id]
+                    if job["status"] == "failed":
+                        failed.append(job)
+
+    for job in failed:
+        console.print(f"Indexing {job['path']} failed: {job['error']}", style=BRIGHT_RED)
     console.print(f"Indexing Complete!")
 
 
+def print_match(i: int, file: str, snippets: list[dict]):
+    header_line = f"\nFile: {i + 1} {file}"
+    header_line += " " * (console.width - len(header_line) + 1)
+    console.print(header_line, style=f"bold {BRIGHT_RED} on {BLACK}")
+
+    lexer = Syntax.guess_lexer(file, snippets[0]["content"] if snippets else "")
+    for j, snippet in enumerate(snippets):
+        if j:
+            console.print("." * console.width, style=f"on {MONOKAI_BG}")
+
+        syntax = Syntax(
+            snippet["content"].removesuffix("\n"),
+            lexer,
+            line_numbers=True,
+            start_line=snippet["start_line"],
+            highlight_lines=set(snippet["match_lines"]),
+            theme="monokai",
+        )
+        console.print(syntax)
+
+
 @app.command()
 def search(
     regex: str,
@@ -42,37 +104,25 @@ def search(
     size_lt: int = -1,
     size_gt: int = -1,
     path_like: str = "",
+    context: int = 4,
 ):
-    response = search_request(regex, skip, limit, case_sensitive, size_lt, size_gt, path_like)
-    matches = response["matches"]
-    console.print(f"Found {response['total']} matching files")
-    console.print(f"Skipping {response['skip']} files and limiting to {min(response['limit'], len(matches))} results")
-
-    for i, (file, content) in enumerate(matches.items()):
-        header_line = f"\nFile: {i + 1} {file}"
-        header_line += " " * (console.width - len(header_line) + 1)
-        console.print(header_line, style=f"bold {BRIGHT_RED} on {BLACK}")
-
-        printed_first_block = False
-        line_ranges = find_matching_lines(regex, content)
-        for start_line, end_line, matched_lines in line_ranges:
-            if printed_first_block:
-                console.print("." * console.width, style=f"on {MONOKAI_BG}")
-            else:
-                printed_first_block = True
-
-            actual_range = max(start_line - 4, 0), end_line + 4
-
-            lexer = Syntax.guess_lexer(file, content)
-            syntax = Syntax(
-                content,
-                lexer,
-                line_numbers=True,
-                highlight_lines=matched_lines,
-                line_range=actual_range,
-                theme="monokai",
-            )
-            console.print(syntax)
+    # Matches are printed as soon as the server verifies them
+    num_matches = 0
+    events = search_stream_request(regex, skip, limit, case_sensitive, size_lt, size_gt, path_like, context)
+    try:
+        for event in events:
+            if event["type"] == "match":
+                print_match(num_matches, event["file"], event["snippets"])
+                num_matches += 1
+                continue
+
+            total = event["total"] if event["total_exact"] else f"~{event['total']}"
+            console.print(f"\nFound {total} matching files in {event['timings']['total']:.0f} ms")
+            console.print(f"Skipped {event['skip']} files and limited to {event['limit']} results")
+    except requests.HTTPError as e:
+        # Such as an invalid regex
+        console.print(error_detail(e), style=BRIGHT_RED)
+        raise typer.Exit(1)
 
 
 if __name__ == "__main__":
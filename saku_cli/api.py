@@ -1,8 +1,19 @@
+import json
+from typing import Iterator
+
 import requests
 
 HOST = "http://localhost:8000"
 
 
+def error_detail(error: requests.HTTPError) -> str:
+    """The reason the server gave for rejecting a request."""
+    try:
+        return error.response.json()["detail"]
+    except (ValueError, KeyError, TypeError):
+        return str(error)
+
+
 def search_request(
     regex: str,
     skip: int = 0,
@@ -24,12 +35,49 @@ def search_request(
     return resp.json()
 
 
+def search_stream_request(
+    regex: str,
+    skip: int = 0,
+    limit: int = 20,
+    case_sensitive: bool = True,
+    size_lt: int | None = None,
+    size_gt: int | None = None,
+    path_like: str | None = None,
+    context: int | None = None,
+) -> Iterator[dict]:
+    params = {
+        "skip": skip,
+        "limit": limit,
+        "size_lt": size_lt,
+        "size_gt": size_gt,
+        "path_like": path_like,
+        "case_sensitive": case_sensitive,
+        "context": context,
+    }
+    # Closing the response (e.g. on Ctrl+C) stops the search on the server
+    with requests.post(f"{HOST}/search/stream", json={"regex": regex}, params=params, stream=True) as resp:
+        if not resp.ok:
+            # Read the error before the response gets closed, for its detail
+            resp.content
+        resp.raise_for_status()
+        for line in resp.iter_lines():
+            if line:
+                yield json.loads(line)
+
+
 def clone_request(url: str):
     params = {"url": url}
     resp = requests.post(f"{HOST}/repo", params=params)
     return resp.json()
 
 
-def index_request():
-    resp = requests.put(f"{HOST}/repo/index")
+def index_request(name: str | None = None):
+    resp = requests.put(f"{HOST}/repo/index", params={"name": name})
+    resp.raise_for_status()
+    return resp.json()
+
+
+def job_request(job_id: str):
+    resp = requests.get(f"{HOST}/jobs/{job_id}")
+    resp.raise_for_status()
     return resp.json()
@@ -0,0 +1,34 @@
+from unittest import TestCase
+
+from pydantic import ValidationError
+
+from saku.core.config import SakuConfig
+
+
+class TestSakuConfig(TestCase):
+    @staticmethod
+    def test_embedded_backend():
+        config = SakuConfig(_env_file=None, REPO_DIR="/repos", STORAGE_BACKEND="embedded", DATA_DIR="/data")
+        assert config.POSTING_STORE == "segments"
+        assert config.DATABASE_URI == "sqlite:////data/saku.db"
+        assert config.async_database_uri == "sqlite+aiosqlite:////data/saku.db"
+
+    def test_server_backend(self):
+        config = SakuConfig(
+            _env_file=None,
+            REPO_DIR="/repos",
+            REDIS_HOST="redis",
+            DATABASE_HOST="db",
+            DATABASE_USER="saku",
+            DATABASE_PASSWORD="pass",
+            DATABASE_NAME="saku",
+        )
+        assert config.POSTING_STORE == "redis"
+        assert config.DATABASE_URI == "postgresql://saku:pass@db/saku"
+        assert config.async_database_uri == "postgresql+asyncpg://saku:pass@db/saku"
+
+        # Servers have to be configured, unless postings & documents are kept locally
+        with self.assertRaises(ValidationError):
+            SakuConfig(_env_file=None, REPO_DIR="/repos")
+        config = SakuConfig(_env_file=None, REPO_DIR="/repos", POSTING_STORE="segments", DATABASE_URI="sqlite://")
+        assert config.REDIS_HOST is None
@@ -1,6 +1,15 @@
 from unittest import TestCase
 
-from saku.core.encoding import byte_align_decode, byte_align_encode
+import numpy as np
+
+from saku.core.encoding import (
+    byte_align_decode,
+    byte_align_encode,
+    decode_ngrams,
+    decode_postings,
+    encode_ngrams,
+    encode_postings,
+)
 
 
 class TestEncoding(TestCase):
@@ -12,3 +21,39 @@ class TestEncoding(TestCase):
         byte_str = b"".join(byte_align_encode(x) for x in range(100000))
         for i, n in enumerate(byte_align_decode(byte_str)):
             assert i == n
+
+
+class TestPostingsEncoding(TestCase):
+    @staticmethod
+    def test_round_trip():
+        rng = np.random.default_rng(42)
+        for size in (0, 1, 2, 127, 128, 10000):
+            doc_ids = np.unique(rng.integers(0, 1 << 40, size))
+            assert np.array_equal(doc_ids, decode_postings(encode_postings(doc_ids)))
+
+        doc_ids = [0, 1, 127, 128, 16383, 16384, (1 << 63) - 1]
+        assert decode_postings(encode_postings(doc_ids)).tolist() == doc_ids
+
+    @staticmethod
+    def test_gaps_are_byte_aligned():
+        doc_ids = list(range(0, 100000, 7))
+        gaps = [doc_ids[0]] + [b - a for a, b in zip(doc_ids, doc_ids[1:])]
+        assert list(byte_align_decode(encode_postings(doc_ids))) == gaps
+
+    def test_invalid_input(self):
+        with self.assertRaises(ValueError):
+            encode_postings([3, 2])
+        with self.assertRaises(ValueError):
+            encode_postings([-1])
+        with self.assertRaises(ValueError):
+            decode_postings(b"\x81")
+
+
+class TestNGramsEncoding(TestCase):
+    def test_round_trip(self):
+        ngrams = {b"abc", b"ab\x00d", b"\xff\xfe\n", b"x" * 255}
+        self.assertEqual(ngrams, decode_ngrams(encode_ngrams(ngrams)))
+        self.assertEqual(set(), decode_ngrams(encode_ngrams([])))
+
+        with self.assertRaises(ValueError):
+            encode_ngrams([b"x" * 256])
@@ -0,0 +1,55 @@
+from unittest import TestCase
+
+from saku.core.metrics import MetricsRegistry, Timings
+
+
+class TestMetrics(TestCase):
+    @staticmethod
+    def test_render():
+        registry = MetricsRegistry()
+        histogram = registry.histogram("stage_seconds", "Time per stage", buckets=(0.1, 1), label="stage")
+        counter = registry.counter("docs_total", "Docs")
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value, "plan")
+        counter.inc(2)
+        counter.inc()
+
+        lines = registry.render().splitlines()
+        assert lines[:2] == ["# HELP stage_seconds Time per stage", "# TYPE stage_seconds histogram"]
+        assert lines[2:7] == [
+            'stage_seconds_bucket{stage="plan",le="0.1"} 2',
+            'stage_seconds_bucket{stage="plan",le="1"} 3',
+            'stage_seconds_bucket{stage="plan",le="+Inf"} 4',
+            'stage_seconds_sum{stage="plan"} 3.65',
+            'stage_seconds_count{stage="plan"} 4',
+        ]
+        assert lines[-1] == "docs_total 3"
+
+        # Nothing is recorded while disabled
+        registry.enabled = False
+        histogram.observe(1, "fetch")
+        counter.inc()
+        registry.enabled = True
+        assert 'stage="fetch"' not in registry.render()
+        assert registry.render().splitlines()[-1] == "docs_total 3"
+
+    @staticmethod
+    def test_timings():
+        registry = MetricsRegistry()
+        histogram = registry.histogram("stage_seconds", "Time per stage", label="stage")
+        timings = Timings()
+        with timings.stage("read"):
+            pass
+        timings.add("read", 1.0)
+        timings.add("verify", 0.002)
+
+        assert timings.get("read") >= 1.0 and timings.get("missing") == 0.0
+        assert timings.to_ms()["verify"] == 2.0
+        timings.observe(histogram)
+        assert 'stage_seconds_count{stage="read"} 1' in registry.render()
+
+        # Stages are not timed while disabled
+        timings = Timings(enabled=False)
+        with timings.stage("read"):
+            pass
+        assert timings.to_ms() == {}
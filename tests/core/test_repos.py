@@ -0,0 +1,31 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from git import Repo
+
+from saku.core.repos import RepoRegistry
+
+
+class TestRepoRegistry(TestCase):
+    @staticmethod
+    def test_get_url():
+        with tempfile.TemporaryDirectory() as repo_dir:
+            repo = Repo.init(os.path.join(repo_dir, "saku"), initial_branch="main")
+            repo.create_remote("origin", "git@github.com:Sheerabth/Saku.git")
+            Repo.init(os.path.join(repo_dir, "local"))
+            os.mkdir(os.path.join(repo_dir, "plain"))
+
+            registry = RepoRegistry(repo_dir)
+            url = registry.get_url(f"{repo_dir}/saku/saku/app.py")
+            assert url == "https://github.com/Sheerabth/Saku/blob/main/saku/app.py"
+            assert registry.get_url(f"{repo_dir}/saku/.gitignore").endswith("/blob/main/.gitignore")
+            assert registry.get_url(f"{repo_dir}/saku/.git/HEAD") is None
+            assert registry.get_url(f"{repo_dir}/sakura/app.py") == f"{repo_dir}/sakura/app.py"
+            assert registry.get_url(f"{repo_dir}/local/app.py") == f"{repo_dir}/local/app.py"
+            assert registry.get_url(f"{repo_dir}/plain/app.py") == f"{repo_dir}/plain/app.py"
+
+            repo.git.checkout("-b", "dev")
+            assert registry.get_url(f"{repo_dir}/saku/app.py").endswith("/blob/main/app.py")
+            registry.refresh()
+            assert registry.get_url(f"{repo_dir}/saku/app.py").endswith("/blob/dev/app.py")
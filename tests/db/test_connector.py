@@ -0,0 +1,29 @@
+from datetime import datetime
+from unittest import TestCase
+
+from saku.db.connector import DbConnector
+from saku.db.models import create_db_and_tables
+
+
+class TestDbConnector(TestCase):
+    @staticmethod
+    def test_upsert_documents():
+        db = DbConnector("sqlite://")
+        create_db_and_tables(db.engine)
+        now = datetime.now()
+
+        rows = [
+            {"path": f"/repo/{i}.py", "size": i, "mime_type": "text/x-python", "last_modified": now} for i in range(5)
+        ]
+        docs = db.upsert_documents(rows)
+        assert sorted(d.path for d in docs) == sorted(r["path"] for r in rows)
+        ids = {d.path: d.id for d in docs}
+        assert len(set(ids.values())) == 5
+
+        # Tracked paths keep their ids, and get their metadata updated
+        rows = [{"path": "/repo/0.py", "size": 100, "mime_type": "text/plain", "last_modified": now}]
+        rows.append({"path": "/repo/5.py", "size": 5, "mime_type": "text/x-python", "last_modified": now})
+        docs = {d.path: d for d in db.upsert_documents(rows)}
+        assert docs["/repo/0.py"].id == ids["/repo/0.py"] and docs["/repo/0.py"].size == 100
+        assert docs["/repo/5.py"].id not in ids.values()
+        assert db.upsert_documents([]) == []
@@ -0,0 +1,78 @@
+import os
+import random
+import tempfile
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from sqlmodel import select
+
+from saku.db.connector import DbConnector
+from saku.db.documents import DocumentTable
+from saku.db.models import Document, create_db_and_tables
+from saku.index.query import QueryEngine
+
+FILTERS = [
+    (None, None, None),
+    (300, None, None),
+    (None, 200, None),
+    (None, None, r"/src/.*\.py$"),
+    (900, 100, "lib"),
+]
+
+
+class TestDocumentTable(TestCase):
+    def test_matches_database(self):
+        rng = random.Random(7)
+        started = datetime(2024, 1, 1)
+
+        with tempfile.TemporaryDirectory() as data_dir:
+            db = DbConnector(f"sqlite:///{os.path.join(data_dir, 'saku.db')}")
+            create_db_and_tables(db.engine)
+
+            def random_document(i: int) -> Document:
+                return Document(
+                    path=f"/repos/{rng.choice(['src', 'lib', 'docs'])}/{i}.{rng.choice(['py', 'md'])}",
+                    size=rng.randrange(1000),
+                    mime_type="text/plain",
+                    last_modified=started + timedelta(seconds=rng.randrange(100_000)),
+                    blob_id=rng.choice([None, *range(1, 40)]),
+                )
+
+            with db.get_session() as session:
+                session.add_all(random_document(i) for i in range(200))
+                session.commit()
+
+            table = DocumentTable(db, max_age=3600)
+            table.load()
+            for step in range(3):
+                with db.get_session() as session:
+                    last_modified = dict(session.exec(select(Document.path, Document.last_modified)).all())
+                for filters in FILTERS:
+                    # Matches cached by any version carry over to the next ones
+                    table.current().path_matches(filters[2] or ".")
+                    for blob_ids in (None, [], rng.sample(range(1, 40), 10)):
+                        with db.get_session() as session:
+                            expected = session.exec(QueryEngine._candidates_query(blob_ids, *filters)).all()
+                        actual = table.candidates(blob_ids, *filters)
+                        self.assertEqual(sorted(expected), sorted(actual))
+                        # Latest modified first
+                        modified = [last_modified[path] for path, _ in actual]
+                        self.assertEqual(sorted(modified, reverse=True), modified)
+
+                expected = {path: modified.timestamp() for path, modified in last_modified.items()}
+                self.assertEqual(expected, table.last_modified([*last_modified, "/repos/missing.py"]))
+
+                # Change, delete & add documents, syncing the table with them only
+                with db.get_session() as session:
+                    documents = session.query(Document).all()
+                    changed = rng.sample(documents, 30)
+                    for doc in changed[:10]:
+                        session.delete(doc)
+                    for doc in changed[10:]:
+                        doc.size = rng.randrange(1000)
+                        doc.blob_id = rng.choice([None, *range(1, 40)])
+                        doc.last_modified += timedelta(seconds=rng.randrange(100_000))
+                    added = [random_document(1000 * (step + 1) + i) for i in range(20)]
+                    session.add_all(added)
+                    session.commit()
+                    table.sync([doc.id for doc in changed + added])
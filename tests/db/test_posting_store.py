@@ -0,0 +1,44 @@
+from unittest import TestCase
+
+import fakeredis
+import numpy as np
+
+from saku.core.encoding import encode_postings
+from saku.db.postings import ADDED, REMOVED, RedisPostingStore, apply_chunks, drop_tombstoned
+
+
+class TestPostingChunks(TestCase):
+    @staticmethod
+    def test_apply_chunks():
+        chunks = [
+            ADDED + encode_postings([1, 3, 5]),
+            ADDED + encode_postings([2, 4]),
+            REMOVED + encode_postings([3, 4, 9]),
+            ADDED + encode_postings([3]),
+        ]
+        assert apply_chunks(chunks).tolist() == [1, 2, 3, 5]
+        assert apply_chunks([]).tolist() == []
+        assert apply_chunks([REMOVED + encode_postings([1])]).tolist() == []
+
+    @staticmethod
+    def test_drop_tombstoned():
+        tombstones = np.array([2, 5])
+        assert drop_tombstoned(np.array([1, 2, 3]), tombstones).tolist() == [1, 3]
+        # Line postings are dropped by the blob id in their high bits
+        lines = np.array([1 << 32 | 7, 2 << 32, 2 << 32 | 9, 3 << 32 | 2])
+        assert drop_tombstoned(lines, tombstones, lines=True).tolist() == [1 << 32 | 7, 3 << 32 | 2]
+
+
+class TestRedisPostingStore(TestCase):
+    @staticmethod
+    def test_stop_grams():
+        store = RedisPostingStore(fakeredis.FakeRedis())
+        store.add_lines({b"abc": [1 << 32 | 4], b"xyz": [1 << 32]})
+        store.update({b"abc": [1, 2], b"xyz": [1]}, {}, new_blobs=2)
+
+        store.add_stop_grams([b"abc"])
+        assert store.stop_grams() == {b"abc"}
+        assert store.get([b"abc"])[b"abc"].tolist() == []
+        assert store.get_lines([b"abc", b"xyz"])[b"abc"].tolist() == []
+        assert store.redis.keys(b"*abc") == []
+        assert store.get_lines([b"xyz"])[b"xyz"].tolist() == [1 << 32]
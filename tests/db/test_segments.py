@@ -0,0 +1,166 @@
+import os
+import random
+import tempfile
+import threading
+import time
+from unittest import TestCase, mock
+
+from saku.db.segments import SegmentPostingStore
+from saku.index.postings import EMPTY_POSTINGS
+
+
+class TestSegmentPostingStore(TestCase):
+    def test_updates_merges_and_compaction(self):
+        rng = random.Random(5)
+        ngrams = [b"abc", b"abcd", b"bcd", b"xyz", b"\x00\xff\n"]
+        expected: dict[bytes, set[int]] = {}
+
+        with tempfile.TemporaryDirectory() as segments_dir:
+            store = SegmentPostingStore(segments_dir, merge_factor=3)
+            for step in range(30):
+                added, removed = {}, {}
+                for ngram in rng.sample(ngrams, 3):
+                    doc_ids = rng.sample(range(40), 4)
+                    if rng.random() < 0.3:
+                        removed[ngram] = doc_ids
+                        expected.setdefault(ngram, set()).difference_update(doc_ids)
+                    else:
+                        added[ngram] = doc_ids
+                        expected.setdefault(ngram, set()).update(doc_ids)
+                store.update(added, removed)
+
+                if step % 4 == 0:
+                    store.merge_small_segments()
+                postings = store.get(ngrams + [b"missing"])
+                for ngram in ngrams:
+                    self.assertEqual(expected.get(ngram, set()), set(postings[ngram].tolist()))
+                self.assertEqual([], postings[b"missing"].tolist())
+
+            self.assertLess(len(store.segments()), 30)
+
+            store.delete_documents([1, 2, 3])
+            self.assertEqual([1, 2, 3], store.tombstones().tolist())
+            store.compact()
+
+            self.assertEqual(1, len(store.segments()))
+            self.assertEqual([], store.tombstones().tolist())
+            self.assertEqual(0, store.pending_compaction())
+            postings = store.get(ngrams)
+            for ngram in ngrams:
+                self.assertEqual(expected.get(ngram, set()) - {1, 2, 3}, set(postings[ngram].tolist()))
+
+            # Frequencies are exact once compacted
+            frequencies = store.frequencies(ngrams)
+            for ngram in ngrams:
+                self.assertEqual(len(postings[ngram]), frequencies[ngram])
+
+    def test_statistics_and_stop_grams(self):
+        with tempfile.TemporaryDirectory() as segments_dir:
+            store = SegmentPostingStore(segments_dir, merge_factor=3)
+            for step in range(10):
+                store.update({b"all": [step], b"even": [step] if step % 2 == 0 else []}, {}, new_blobs=1)
+            store.delete_documents([9])
+
+            self.assertEqual(9, store.num_documents())
+            self.assertEqual({b"all": 10, b"even": 5, b"none": 0}, store.frequencies([b"all", b"even", b"none"]))
+            self.assertEqual({b"all": 10}, store.frequent_grams(6))
+
+            store.add_stop_grams([b"all"])
+            self.assertEqual({b"all"}, store.stop_grams())
+            self.assertEqual({b"even": 5}, store.frequencies([b"all", b"even"]))
+            self.assertEqual([], store.get([b"all"])[b"all"].tolist())
+            self.assertEqual(9, store.num_documents())
+
+    def test_line_postings(self):
+        with tempfile.TemporaryDirectory() as segments_dir:
+            store = SegmentPostingStore(segments_dir, merge_factor=3)
+            # Raw grams may start with any byte, line postings of the same gram are kept apart
+            gram = b"\xfeab"
+            store.add_lines({gram: [1 << 32 | 5, 2 << 32, 3 << 32 | 7]})
+            store.update({gram: [1, 2, 3]}, {}, new_blobs=3)
+            self.assertEqual([1, 2, 3], store.get([gram])[gram].tolist())
+            self.assertEqual([1 << 32 | 5, 2 << 32, 3 << 32 | 7], store.get_lines([gram])[gram].tolist())
+
+            store.delete_documents([2])
+            store.compact()
+            self.assertEqual([1, 3], store.get([gram])[gram].tolist())
+            self.assertEqual([1 << 32 | 5, 3 << 32 | 7], store.get_lines([gram])[gram].tolist())
+            self.assertEqual({gram: 2}, store.frequencies([gram]))
+            self.assertEqual(2, store.num_documents())
+
+            # Stop grams lose their line postings along with their postings
+            store.add_lines({b"abc": [1 << 32 | 2]})
+            store.add_stop_grams([gram])
+            self.assertEqual([], store.get_lines([gram])[gram].tolist())
+            self.assertEqual([1 << 32 | 2], store.get_lines([b"abc"])[b"abc"].tolist())
+            self.assertEqual([[b"abc"]], [list(segment) for segment in store._lines.segments()])
+
+    def test_merged_frequencies(self):
+        with tempfile.TemporaryDirectory() as segments_dir:
+            store = SegmentPostingStore(segments_dir, merge_factor=3)
+            store.update({b"abc": [1], b"xyz": [1]}, {}, new_blobs=1)
+            store.update({b"abc": [2, 3], b"xyz": [2]}, {}, new_blobs=2)
+            store.update({}, {b"abc": [2], b"xyz": [1]})
+            store.update({b"abc": [4]}, {b"xyz": [2]}, new_blobs=1)
+            expected = {b"abc": 3, b"xyz": 0}
+            self.assertEqual(expected, store.frequencies(expected))
+
+            # Blob 2 is added & removed within a run, that does not start at the oldest segment
+            segments = store.segments()
+            store._merge(segments[1:], EMPTY_POSTINGS, is_base=False)
+            self.assertEqual(2, len(store.segments()))
+            self.assertEqual(expected, store.frequencies(expected))
+            self.assertEqual([1, 3, 4], store.get([b"abc"])[b"abc"].tolist())
+
+            store.delete_documents([3])
+            store.compact()
+            self.assertEqual({b"abc": 2, b"xyz": 0}, store.frequencies(expected))
+            self.assertEqual([1, 4], store.get([b"abc"])[b"abc"].tolist())
+
+    def test_concurrent_writers(self):
+        with tempfile.TemporaryDirectory() as segments_dir:
+            # Stores of separate processes only share the lock files
+            stores = [SegmentPostingStore(segments_dir, merge_factor=3, background_merge=True) for _ in range(3)]
+
+            def write(writer: int) -> None:
+                for step in range(20):
+                    stores[writer].add({b"abc": [writer * 100 + step]})
+
+            threads = [threading.Thread(target=write, args=(writer,)) for writer in range(3)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            for store in stores:
+                store.close()
+
+            expected = [writer * 100 + step for writer in range(3) for step in range(20)]
+            self.assertEqual(expected, stores[0].get([b"abc"])[b"abc"].tolist())
+            self.assertEqual({b"abc": 60}, stores[0].frequencies([b"abc"]))
+            self.assertFalse([name for name in os.listdir(segments_dir) if name.endswith(".tmp")])
+
+    def test_failed_merge(self):
+        with tempfile.TemporaryDirectory() as segments_dir:
+            store = SegmentPostingStore(segments_dir, merge_factor=3, background_merge=True)
+            self.addCleanup(store.close)
+            merge_small_segments = store.merge_small_segments
+            failed, merged = threading.Event(), threading.Event()
+
+            def merge():
+                if not failed.is_set():
+                    failed.set()
+                    raise OSError("disk full")
+                merge_small_segments()
+                if len(store.segments()) == 1:
+                    merged.set()
+
+            with mock.patch.object(store, "merge_small_segments", merge), mock.patch("saku.db.segments.LOG") as log:
+                store.add({b"abc": [0]})
+                self.assertTrue(failed.wait(10))
+                for step in range(1, 3):
+                    store.add({b"abc": [step]})
+                # The merger outlives a failed merge
+                self.assertTrue(merged.wait(10))
+            log.exception.assert_called_once()
+            self.assertTrue(store._merger.is_alive())
+            self.assertEqual([0, 1, 2], store.get([b"abc"])[b"abc"].tolist())
@@ -0,0 +1,249 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from git import Repo
+
+from saku.core.config import ONE_MB, SakuConfig
+from saku.db.documents import DocumentTable
+from saku.db.models import Document, IndexedRepo
+from saku.index.indexer import Indexer, new_stage_stats
+from saku.index.query import QueryEngine
+
+
+def _write(path: str, content: str) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as fp:
+        fp.write(content)
+
+
+def _commit(repo: Repo, message: str) -> str:
+    repo.git.add(A=True)
+    repo.git.commit(m=message)
+    return repo.head.commit.hexsha
+
+
+class TestIndexer(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.repo_dir = os.path.join(self.temp_dir.name, "repos")
+        os.makedirs(self.repo_dir)
+        data_dir = os.path.join(self.temp_dir.name, "data")
+        os.makedirs(data_dir)
+        self.config = SakuConfig(
+            _env_file=None,
+            REPO_DIR=self.repo_dir,
+            STORAGE_BACKEND="embedded",
+            DATA_DIR=data_dir,
+            SEGMENTS_DIR=os.path.join(data_dir, "index"),
+            INDEX_PARSE_WORKERS=2,
+            INDEX_QUEUE_SIZE=1,
+        )
+
+    def _init_repo(self) -> Repo:
+        repo = Repo.init(self.repo_dir)
+        with repo.config_writer() as config:
+            config.set_value("user", "name", "saku")
+            config.set_value("user", "email", "saku@example.com")
+        return repo
+
+    def _indexer(self, documents: DocumentTable | None = None) -> Indexer:
+        indexer = Indexer(self.config, documents)
+        self.addCleanup(indexer.postings.close)
+        return indexer
+
+    @staticmethod
+    def _documents(indexer: Indexer) -> dict[str, Document]:
+        with indexer.db.get_session() as session:
+            return {os.path.relpath(d.path, indexer.config.REPO_DIR): d for d in session.query(Document)}
+
+    @staticmethod
+    def _indexed_commit(indexer: Indexer, root: str) -> str | None:
+        with indexer.db.get_session() as session:
+            indexed = session.get(IndexedRepo, root)
+            return indexed and indexed.commit
+
+    def test_index_directory(self):
+        contents = {f"src/module_{i}.py": f"def handler_{i}():\n    return {i}\n" for i in range(120)}
+        contents["README.md"] = "Saku indexes source code\n"
+        for path, content in contents.items():
+            _write(os.path.join(self.repo_dir, path), content)
+
+        indexer = self._indexer()
+        stats = new_stage_stats()
+        indexer.index_directory(self.repo_dir, stats)
+
+        # More than a chunk of blobs, parsed across the pool & written by the single writer
+        assert stats["scan"].docs == stats["metadata"].docs == len(contents)
+        assert stats["parse"].docs == stats["parse"].total == len(contents)
+        assert stats["write"].docs == stats["write"].total == len(contents)
+        assert stats["parse"].num_bytes == sum(len(content) for content in contents.values())
+
+        documents = self._documents(indexer)
+        assert set(documents) == set(contents)
+        assert all(doc.last_indexed is not None for doc in documents.values())
+        assert indexer.postings.num_documents() == len(contents)
+        for path in ("README.md", "src/module_7.py"):
+            grams = indexer.parser.parse_document(documents[path].path)
+            postings = indexer.postings.get(grams)
+            assert all(documents[path].blob_id in postings[grm] for grm in grams)
+
+    def test_stop_grams(self):
+        _write(os.path.join(self.repo_dir, "a.txt"), "stop\n")
+        self.config.INDEX_LINE_POSITIONS = True
+        indexer = self._indexer()
+        _, lines = indexer.parser.parse_document_lines(os.path.join(self.repo_dir, "a.txt"))
+        grams = set(lines)
+        stop_gram = min(grams)
+        indexer.postings.add_stop_grams([stop_gram])
+
+        indexer.index_directory(self.repo_dir)
+        # Neither posted for blobs nor lines
+        kept = grams - {stop_gram}
+        assert not len(indexer.postings.get([stop_gram])[stop_gram])
+        assert not len(indexer.postings.get_lines([stop_gram])[stop_gram])
+        assert all(len(postings) for postings in indexer.postings.get_lines(kept).values())
+
+    def test_write_failure(self):
+        for i in range(250):
+            _write(os.path.join(self.repo_dir, f"{i}.txt"), f"line {i}\n")
+
+        indexer = self._indexer()
+
+        def write_batch(batch):
+            raise RuntimeError("disk full")
+
+        indexer.write_batch = write_batch
+        stats = new_stage_stats()
+        # Parsed batches keep being drained through the bounded queue, and the error reaches the caller
+        with self.assertRaisesRegex(RuntimeError, "disk full"):
+            indexer.index_directory(self.repo_dir, stats)
+        assert stats["parse"].docs == 250
+        assert stats["write"].docs == 0
+
+    def test_git_diff(self):
+        repo = self._init_repo()
+        for name in ("a", "b", "c"):
+            _write(os.path.join(self.repo_dir, f"{name}.txt"), f"{name} content\n")
+        first = _commit(repo, "initial")
+
+        # Never indexed, so scanned in full
+        indexer = self._indexer()
+        assert indexer._diff_repository(self.repo_dir, None, first) is None
+        stats = new_stage_stats()
+        indexer.index_directory(self.repo_dir, stats)
+        assert stats["scan"].docs == stats["parse"].docs == 3
+        assert self._indexed_commit(indexer, self.repo_dir) == first
+        indexed = self._documents(indexer)
+
+        _write(os.path.join(self.repo_dir, "a.txt"), "a content, edited\n")
+        os.remove(os.path.join(self.repo_dir, "b.txt"))
+        _write(os.path.join(self.repo_dir, "d.txt"), "d content\n")
+        second = _commit(repo, "changes")
+        assert indexer._diff_repository(self.repo_dir, second, second) == ([], [])
+        present, deleted = indexer._diff_repository(self.repo_dir, first, second)
+        assert sorted(os.path.basename(path) for path in present) == ["a.txt", "d.txt"]
+        assert [os.path.basename(path) for path in deleted] == ["b.txt"]
+
+        # Only the changed paths are looked at, the added & modified ones get parsed
+        stats = new_stage_stats()
+        indexer.index_directory(self.repo_dir, stats)
+        assert stats["scan"].docs == 3
+        assert stats["parse"].docs == 2
+        assert self._indexed_commit(indexer, self.repo_dir) == second
+        documents = self._documents(indexer)
+        assert set(documents) == {"a.txt", "c.txt", "d.txt"}
+        assert documents["a.txt"].blob_id != indexed["a.txt"].blob_id
+        assert documents["c.txt"].blob_id == indexed["c.txt"].blob_id
+        # Blobs of the modified & deleted files are left without documents
+        assert indexer.postings.tombstones().tolist() == sorted([indexed["a.txt"].blob_id, indexed["b.txt"].blob_id])
+
+        # Rewriting history drops the last indexed commit, so the repository is scanned in full again
+        repo.git.commit(amend=True, m="changes, reworded")
+        rewritten = repo.head.commit.hexsha
+        repo.git.reflog("expire", "--expire=now", "--all")
+        repo.git.gc("--prune=now", "--quiet")
+        assert indexer._diff_repository(self.repo_dir, second, rewritten) is None
+
+        stats = new_stage_stats()
+        indexer.index_directory(self.repo_dir, stats)
+        assert stats["scan"].docs == 3
+        assert stats["parse"].docs == 0
+        assert self._indexed_commit(indexer, self.repo_dir) == rewritten
+        assert set(self._documents(indexer)) == {"a.txt", "c.txt", "d.txt"}
+
+        # Renames are diffed as a deletion & an addition
+        repo.git.mv("c.txt", "e.txt")
+        third = _commit(repo, "rename")
+        present, deleted = indexer._diff_repository(self.repo_dir, rewritten, third)
+        assert [os.path.basename(path) for path in present] == ["e.txt"]
+        assert [os.path.basename(path) for path in deleted] == ["c.txt"]
+
+    def test_git_diff_file_size(self):
+        self.config.MAX_FILE_SIZE_TO_INDEX = 1
+        repo = self._init_repo()
+        for name in ("a", "b"):
+            _write(os.path.join(self.repo_dir, f"{name}.txt"), f"{name} content\n")
+        _commit(repo, "initial")
+        indexer = self._indexer()
+        indexer.index_directory(self.repo_dir)
+        indexed = self._documents(indexer)
+
+        # Grown past the limit, the file is dropped just like a scan leaves it out
+        _write(os.path.join(self.repo_dir, "a.txt"), "a" * (ONE_MB + 1))
+        _commit(repo, "grown")
+        stats = new_stage_stats()
+        indexer.index_directory(self.repo_dir, stats)
+        assert stats["scan"].docs == 1
+        assert stats["parse"].docs == 0
+        assert set(self._documents(indexer)) == {"b.txt"}
+        assert indexer.postings.tombstones().tolist() == [indexed["a.txt"].blob_id]
+        assert {f.path for f in indexer.scanner.scan(self.repo_dir)} == {os.path.join(self.repo_dir, "b.txt")}
+
+        # And indexed again once it shrinks back
+        _write(os.path.join(self.repo_dir, "a.txt"), "a content\n")
+        _commit(repo, "shrunk")
+        stats = new_stage_stats()
+        indexer.index_directory(self.repo_dir, stats)
+        assert stats["parse"].docs == 1
+        assert set(self._documents(indexer)) == {"a.txt", "b.txt"}
+
+    def test_dedup(self):
+        shared = "def shared_handler():\n    pass\n"
+        for path, content in (("a/dup.py", shared), ("b/dup.py", shared), ("c/other.py", "def other():\n    pass\n")):
+            _write(os.path.join(self.repo_dir, path), content)
+
+        engine = QueryEngine(self.config)
+        self.addCleanup(engine.verifier.close)
+        indexer = self._indexer(engine.documents)
+
+        def search(regex: str) -> list[str]:
+            matches = engine.search(regex, True)["matches"]
+            return sorted(os.path.relpath(path, self.repo_dir) for path in matches)
+
+        # Identical files share a blob, parsed once
+        stats = new_stage_stats()
+        indexer.index_directory(self.repo_dir, stats)
+        assert stats["parse"].docs == 2
+        indexed = self._documents(indexer)
+        assert indexed["a/dup.py"].blob_id == indexed["b/dup.py"].blob_id != indexed["c/other.py"].blob_id
+        assert search("shared_handler") == ["a/dup.py", "b/dup.py"]
+
+        # Editing a copy moves it to a blob of its own, the other copy keeps the shared one
+        _write(os.path.join(self.repo_dir, "b/dup.py"), "def shared_handler():\n    return 1\n")
+        stats = new_stage_stats()
+        indexer.index_directory(self.repo_dir, stats)
+        assert stats["parse"].docs == 1
+        documents = self._documents(indexer)
+        assert documents["a/dup.py"].blob_id == indexed["a/dup.py"].blob_id
+        assert documents["b/dup.py"].blob_id not in (indexed["b/dup.py"].blob_id, indexed["c/other.py"].blob_id)
+        assert indexer.postings.tombstones().tolist() == []
+        assert search("shared_handler") == ["a/dup.py", "b/dup.py"]
+        assert search("return 1") == ["b/dup.py"]
+
+        # Once its last document is gone, the blob is tombstoned
+        os.remove(os.path.join(self.repo_dir, "a/dup.py"))
+        indexer.index_directory(self.repo_dir)
+        assert indexer.postings.tombstones().tolist() == [indexed["a/dup.py"].blob_id]
+        assert search("shared_handler") == ["b/dup.py"]
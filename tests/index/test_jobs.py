@@ -0,0 +1,34 @@
+import threading
+from unittest import TestCase
+
+from saku.index.jobs import COMPLETED, FAILED, JobManager
+
+
+class FakeIndexer:
+    def __init__(self):
+        self.release = threading.Event()
+        self.indexed = []
+
+    def index_directory(self, dir_path, stats=None):
+        self.release.wait(5)
+        if dir_path == "/broken":
+            raise OSError("broken")
+        self.indexed.append(dir_path)
+
+
+class TestJobManager(TestCase):
+    @staticmethod
+    def test_submit():
+        indexer = FakeIndexer()
+        jobs = JobManager(indexer, max_concurrent_jobs=1)
+
+        job = jobs.submit("/repo")
+        assert jobs.submit("/repo") is job
+        broken = jobs.submit("/broken")
+        assert broken.to_dict()["status"] == "queued"
+
+        indexer.release.set()
+        jobs.executor.shutdown(wait=True)
+        assert jobs.get(job.id).status == COMPLETED
+        assert jobs.get(broken.id).status == FAILED and broken.error == "broken"
+        assert jobs.get("missing") is None
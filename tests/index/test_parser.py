@@ -0,0 +1,78 @@
+import random
+from unittest import TestCase
+
+import numpy as np
+
+from saku.index.parser import (
+    ESCAPED_GRAM_PREFIX,
+    FOLDED_GRAM_PREFIX,
+    DocumentParser,
+    fold_case,
+    frequency_bigram_weights,
+)
+
+
+def reference_index_grams(token: bytes, max_sparse_gram_length: int) -> set[bytes]:
+    # Position by position sparse gram generation, the vectorized one must match it
+    weights = [a + b for a, b in zip(token, token[1:])]
+    grams = set()
+    for start, start_wt in enumerate(weights[:-1]):
+        max_wt = -1
+        for end in range(start + 1, min(start + max_sparse_gram_length, len(weights))):
+            current_wt = weights[end]
+            if max_wt < current_wt:
+                grams.add(token[start : end + 2])
+                if start_wt == current_wt:
+                    continue
+                max_wt = current_wt
+                if start_wt < max_wt:
+                    break
+    # Raw grams never take the keys of reserved ones
+    return {ESCAPED_GRAM_PREFIX + grm if grm[0] >= 0xFD else grm for grm in grams}
+
+
+class TestDocumentParser(TestCase):
+    @staticmethod
+    def test_index_grams():
+        rng = random.Random(3)
+        for max_length in (3, 4, 9):
+            parser = DocumentParser(max_length)
+            for _ in range(200):
+                token = bytes(rng.choice(b"aab c\n{}xyzZ\xff") for _ in range(rng.randint(0, 40)))
+                assert set(parser.generate_index_grams(token)) == reference_index_grams(token, max_length)
+
+    @staticmethod
+    def test_line_grams():
+        rng = random.Random(5)
+        parser = DocumentParser(4)
+        for _ in range(200):
+            token = bytes(rng.choice(b"aab c\n\n{}xyz") for _ in range(rng.randint(0, 60)))
+            # Grams of every line on its own, with the offset of the line
+            expected, offset = {}, 0
+            for line in token.split(b"\n"):
+                for grm in parser.generate_index_grams(line):
+                    expected.setdefault(grm, []).append(offset)
+                offset += len(line) + 1
+            assert {grm: offsets.tolist() for grm, offsets in parser.generate_line_grams(token)} == expected
+
+    @staticmethod
+    def test_reserved_grams():
+        parser = DocumentParser(4)
+        # Latin-1 text, whose raw grams may start with the prefix of folded grams
+        token = "\xffxyz \xfdab".encode("latin-1")
+        raw = set(parser.generate_index_grams(token))
+        folded = set(parser.generate_folded_grams(token))
+        assert raw and folded and not raw & folded
+        assert all(grm.startswith(FOLDED_GRAM_PREFIX) for grm in folded)
+        assert not any(grm.startswith(FOLDED_GRAM_PREFIX) for grm in raw)
+
+    @staticmethod
+    def test_frequency_weights():
+        counts = np.zeros(256 * 256, dtype=np.int64)
+        counts[[1, 2, 3]] = [100, 5, 100]
+        weights = frequency_bigram_weights(counts)
+        assert weights[0] > weights[2] > weights[1] == weights[3]
+
+    @staticmethod
+    def test_fold_case():
+        assert fold_case("ſtream_READER Kelvin ıd Été".encode()) == "stream_reader kelvin id Été".encode()
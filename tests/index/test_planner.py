@@ -0,0 +1,120 @@
+import re
+from unittest import TestCase
+
+from saku.index.parser import FOLDED_GRAM_PREFIX, DocumentParser
+from saku.index.planner import QueryPlanner, optimize_plan
+from saku.index.postings import And, Gram, Line, Or
+
+DOCUMENTS = [
+    "def parse_document(self, file_path: str) -> set[str]:",
+    "class QueryEngine:\n    def search(self, regex):\n        return None",
+    "colour = COLOR = Colour",
+    "SELECT * FROM document WHERE size > 10",
+    "xxxxabcabcabcyyyy",
+    "ſubmit KEY kelvin",
+]
+
+REGEXES = [
+    "parse_document",
+    r"def \w+\(self",
+    "colou?r",
+    "(Query|Search)Engine",
+    "(?i)select .* from",
+    "(abc){3}",
+    "[a-c]bcab",
+    r"^class\s",
+    "ret(urn)+ None",
+    "submit",
+    "key",
+    "(?i)COLOUR",
+    "(?i)key (?-i:kelvin)",
+]
+
+
+def matches_plan(node, grams: set[bytes], lines: list[set[bytes]]) -> bool:
+    if node is None:
+        return True
+    if isinstance(node, Gram):
+        return node.gram in grams
+    if isinstance(node, Line):
+        return any(all(child.gram in line for child in node.children) for line in lines)
+    if isinstance(node, And):
+        return all(matches_plan(child, grams, lines) for child in node.children)
+    return any(matches_plan(child, grams, lines) for child in node.children)
+
+
+class TestQueryPlanner(TestCase):
+    def test_no_false_negatives(self):
+        for case_folded, line_positions in ((False, False), (True, False), (True, True)):
+            parser = DocumentParser(3, case_folded=case_folded, line_positions=line_positions)
+            planner = QueryPlanner(parser)
+            for doc in DOCUMENTS:
+                grams = set(parser.generate_index_grams(doc.encode()))
+                if case_folded:
+                    grams.update(parser.generate_folded_grams(doc.encode()))
+                lines = [set(parser.generate_index_grams(line.encode())) for line in doc.split("\n")]
+                for regex in REGEXES:
+                    for case_sensitive in (True, False):
+                        flags = 0 if case_sensitive else re.IGNORECASE
+                        if re.search(regex, doc, flags):
+                            plan = planner.plan(regex, case_sensitive)
+                            self.assertTrue(matches_plan(plan, grams, lines), (regex, case_sensitive, case_folded, doc))
+
+    def test_plans(self):
+        parser = DocumentParser(3)
+        planner = QueryPlanner(parser)
+
+        self.assertEqual(planner.plan("parse"), And(tuple(Gram(g) for g in parser.generate_index_grams(b"parse"))))
+        self.assertIsInstance(planner.plan("(Query|Search)Engine"), Or)
+        self.assertIsNone(planner.plan("a.*b"))
+        self.assertIsNone(planner.plan(r"\w+"))
+        self.assertIs(planner.plan("colou?r"), planner.plan("colou?r"))
+
+        with self.assertRaises(re.error):
+            planner.plan("(unbalanced")
+
+    def test_case_folded_plans(self):
+        parser = DocumentParser(3, case_folded=True)
+        planner = QueryPlanner(parser)
+
+        folded = And(tuple(Gram(g) for g in parser.generate_folded_grams(b"stream_reader")))
+        self.assertTrue(all(g.gram.startswith(FOLDED_GRAM_PREFIX) for g in folded.children))
+        self.assertEqual(planner.plan("Stream_Reader", case_sensitive=False), folded)
+        self.assertEqual(planner.plan("(?i)STREAM_READER"), folded)
+        # Case sensitive queries keep to the exact grams
+        self.assertEqual(planner.plan("parse"), QueryPlanner(DocumentParser(3)).plan("parse"))
+
+    def test_line_plans(self):
+        parser = DocumentParser(3, line_positions=True)
+        planner = QueryPlanner(parser)
+
+        self.assertEqual(planner.plan("parse"), Line(tuple(Gram(g) for g in parser.generate_index_grams(b"parse"))))
+        self.assertIsInstance(planner.plan("parse\nfile"), And)
+        self.assertTrue(all(isinstance(child, Line) for child in planner.plan("(Query|Search)Engine").children))
+        # Literals only, none of them spanning lines
+        self.assertTrue(planner.is_literal("(Query|Search)Engine"))
+        self.assertTrue(planner.is_literal("^class Query$"))
+        self.assertFalse(planner.is_literal(r"Query\w+Engine"))
+        self.assertFalse(planner.is_literal("Query\nEngine"))
+
+    def test_optimize(self):
+        rare, common, frequent, universal, stop = (Gram(g) for g in (b"rare", b"common", b"frequent", b"all", b"stop"))
+        frequencies = {b"rare": 100, b"common": 40_000, b"frequent": 400_000, b"all": 990_000}
+
+        # Most selective first, while ruling out candidates is worth fetching the postings
+        plan = And((universal, frequent, common))
+        self.assertEqual(And((common, frequent)), optimize_plan(plan, frequencies, 1_000_000, 0.5))
+        plan = And((frequent, common, rare))
+        self.assertEqual(And((rare, common)), optimize_plan(plan, frequencies, 1_000_000, 0.5))
+        # Stop grams can not prune any alternative
+        self.assertEqual(rare, optimize_plan(And((Or((common, stop)), rare)), frequencies, 1_000_000, 0.5))
+        # Not selective enough to use the index at all
+        self.assertIsNone(optimize_plan(Or((frequent, frequent)), frequencies, 1_000_000, 0.5))
+        self.assertIsNone(optimize_plan(Or((frequent, rare)), frequencies, 1_000_000, 0.4))
+        # Lines are kept to the grams worth fetching, a single one is only looked up by blob
+        self.assertEqual(
+            Line((rare, common)), optimize_plan(Line((frequent, common, rare)), frequencies, 1_000_000, 0.5)
+        )
+        self.assertEqual(rare, optimize_plan(Line((universal, rare)), frequencies, 1_000_000, 0.5))
+        # Without statistics plans are kept as is
+        self.assertEqual(And((common, rare)), optimize_plan(And((common, rare)), {}, 0, 0.5))
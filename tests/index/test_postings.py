@@ -0,0 +1,73 @@
+from unittest import TestCase
+
+import numpy as np
+
+from saku.index.postings import And, Gram, Line, Or, intersect, iter_intersection, line_offsets, search_postings, union
+
+
+class TestPostings(TestCase):
+    @staticmethod
+    def test_intersection():
+        rng = np.random.default_rng(7)
+        lists = [np.unique(rng.integers(0, 100000, size)) for size in (50000, 3000, 20000, 70000)]
+        expected = set(lists[0].tolist()).intersection(*(lst.tolist() for lst in lists[1:]))
+
+        assert intersect(lists).tolist() == sorted(expected)
+        assert np.concatenate(list(iter_intersection(lists, block_size=7))).tolist() == sorted(expected)
+        assert intersect([lists[0], np.array([], dtype=np.int64)]).tolist() == []
+        assert union(lists[:2]).tolist() == sorted(set(lists[0].tolist()) | set(lists[1].tolist()))
+
+    @staticmethod
+    def test_search_postings():
+        postings = {
+            b"abc": np.array([1, 2, 3, 5, 8]),
+            b"bcd": np.array([2, 3, 5, 9]),
+            b"xyz": np.array([3, 9]),
+            b"uvw": np.array([5]),
+        }
+
+        def fetch(grams):
+            return {gram: postings.get(gram, np.array([], dtype=np.int64)) for gram in grams}
+
+        tree = And((Gram(b"abc"), Gram(b"bcd"), Or((Gram(b"xyz"), Gram(b"uvw")))))
+        assert list(search_postings(tree, fetch)) == [3, 5]
+
+        assert list(search_postings(Or((Gram(b"xyz"), Gram(b"uvw"))), fetch)) == [3, 5, 9]
+        assert list(search_postings(Or((Gram(b"xyz"), Gram(b"uvw"))), fetch, np.array([5, 7]))) == [3, 9]
+        assert list(search_postings(And((Gram(b"abc"), Gram(b"missing"))), fetch)) == []
+
+        # Match all branches can not prune
+        assert search_postings(None, fetch) is None
+        assert search_postings(Or((Gram(b"abc"), And(()))), fetch) is None
+        assert list(search_postings(And((Gram(b"xyz"), And(()))), fetch)) == [3, 9]
+
+    @staticmethod
+    def test_line_postings():
+        def lines(*pairs):
+            return np.array([blob_id << 32 | offset for blob_id, offset in pairs])
+
+        postings = {
+            b"abc": lines((1, 0), (1, 40), (2, 0), (3, 7)),
+            b"bcd": lines((1, 12), (1, 40), (2, 0), (2, 9), (3, 9)),
+            b"xyz": lines((3, 9), (4, 0)),
+        }
+
+        def fetch_lines(grams):
+            return {gram: postings.get(gram, np.array([], dtype=np.int64)) for gram in grams}
+
+        def fetch(grams):
+            # Blob postings are fetched apart from line postings
+            return {gram: np.array([1, 3, 5]) for gram in grams}
+
+        # Blob 3 has both grams, but on different lines
+        tree = Line((Gram(b"abc"), Gram(b"bcd")))
+        assert list(search_postings(tree, fetch, fetch_lines=fetch_lines)) == [1, 2]
+        assert list(search_postings(tree, fetch, np.array([2]), fetch_lines)) == [1]
+
+        tree = Or((tree, Line((Gram(b"bcd"), Gram(b"xyz")))))
+        assert list(search_postings(tree, fetch, fetch_lines=fetch_lines)) == [1, 2, 3]
+        assert list(search_postings(And((tree, Gram(b"abc"))), fetch, fetch_lines=fetch_lines)) == [1, 3]
+        offsets = line_offsets(tree, fetch_lines(set(postings)))
+        assert {blob_id: starts.tolist() for blob_id, starts in offsets.items()} == {1: [40], 2: [0], 3: [9]}
+        # Blob level grams can not tell the lines apart
+        assert line_offsets(And((tree, Gram(b"abc"))), fetch_lines(set(postings))) is None
@@ -0,0 +1,66 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from saku.index.scanner import FileScanner, FileTypeDetector
+
+
+class TestScanner(TestCase):
+    @staticmethod
+    def test_scan():
+        with tempfile.TemporaryDirectory() as root:
+            files = {
+                "main.py": b"print('hi')\n",
+                ".env": b"SECRET=1\n",
+                ".gitignore": b"*.log\nbuild/\n!keep.log\n",
+                "debug.log": b"log\n",
+                "keep.log": b"kept\n",
+                "build/out.txt": b"built\n",
+                "src/build.py": b"pass\n",
+                "src/.gitignore": b"generated.py\n",
+                "src/generated.py": b"pass\n",
+                "lib/generated.py": b"pass\n",
+                "node_modules/dep/index.js": b"module.exports = 1\n",
+                ".git/HEAD": b"ref: refs/heads/main\n",
+                "big.txt": b"x" * 2048,
+                "skipped/file.txt": b"skipped\n",
+            }
+            for name, content in files.items():
+                path = os.path.join(root, name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, "wb") as fp:
+                    fp.write(content)
+
+            scanner = FileScanner([".git", "node_modules"], max_file_size=1024, workers=2)
+            scanned = {os.path.relpath(f.path, root) for f in scanner.scan(root, [os.path.join(root, "skipped")])}
+            assert scanned == {"main.py", "keep.log", "src/build.py", "lib/generated.py"}
+
+            assert scanner.is_excluded("node_modules/dep/index.js")
+            assert scanner.is_excluded("src/.env")
+            assert not scanner.is_excluded("src/main.py")
+
+    @staticmethod
+    def test_mime_type():
+        with tempfile.TemporaryDirectory() as root:
+            files = {
+                "main.py": b"def main():\n    pass\n",
+                "data.json": '{"name": "café"}'.encode(),
+                "README": "ünïcode\n".encode() * 5000,
+                "image.png": b"not even read",
+                "blob.txt": b"\x00\x01\x02\x03",
+                "empty.py": b"",
+            }
+            detector = FileTypeDetector()
+            mime_types = {}
+            for name, content in files.items():
+                path = os.path.join(root, name)
+                with open(path, "wb") as fp:
+                    fp.write(content)
+                mime_types[name] = detector.mime_type(path)
+
+            assert mime_types["main.py"] == "text/x-python"
+            assert mime_types["data.json"] == "text/plain"
+            assert mime_types["README"] == "text/plain"
+            assert mime_types["image.png"] == "image/png"
+            assert not mime_types["blob.txt"].startswith("text")
+            assert not mime_types["empty.py"].startswith("text")
@@ -0,0 +1,48 @@
+from unittest import TestCase
+
+from saku.core.config import SakuConfig
+from saku.index.shards import merge_shard_results, shard_config, shard_of
+
+
+def _match(path: str, last_modified: float) -> dict:
+    return {"type": "match", "file": path, "path": path, "content": "", "last_modified": last_modified}
+
+
+def _summary(total: int, candidates: int, fetch_ms: float) -> dict:
+    return {
+        "type": "summary",
+        "total": total,
+        "total_exact": True,
+        "skip": 0,
+        "limit": 0,
+        "candidates": candidates,
+        "verified": candidates,
+        "timings": {"fetch": fetch_ms},
+    }
+
+
+class TestShards(TestCase):
+    @staticmethod
+    def test_shard_config():
+        config = SakuConfig(_env_file=None, REPO_DIR="/repos", STORAGE_BACKEND="embedded", DATA_DIR="/data", SHARDS=4)
+        shard = shard_config(config, 2)
+        assert shard.DATABASE_URI == "sqlite:////data/saku-shard2.db"
+        assert shard.async_database_uri == "sqlite+aiosqlite:////data/saku-shard2.db"
+        assert shard.REDIS_DB == 2
+        assert shard.SEGMENTS_DIR.endswith("shard2")
+        # Repos stay on the same shard across processes
+        assert shard_of("saku", 4) == shard_of("saku", 4) == 2
+
+    @staticmethod
+    def test_merge():
+        shard_results = [
+            [_match("a", 9), _match("c", 5), _summary(2, 3, 1.0)],
+            [_match("b", 7), _match("d", 1), _summary(2, 2, 2.5)],
+        ]
+        events = merge_shard_results(shard_results, 1, 2)
+        assert [event["path"] for event in events[:-1]] == ["b", "c"]
+        assert "last_modified" not in events[0]
+
+        summary = events[-1]
+        assert (summary["total"], summary["candidates"], summary["limit"]) == (4, 5, 2)
+        assert summary["timings"] == {"fetch": 2.5}
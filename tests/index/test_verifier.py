@@ -0,0 +1,79 @@
+import asyncio
+import os
+import tempfile
+from unittest import TestCase
+
+from saku.index.verifier import MatchVerifier, compile_pattern, find_snippets
+
+
+class TestMatchVerifier(TestCase):
+    def test_iter_matches(self):
+        contents = [b"def main():\n", b"", "naïve café\n".encode(), b"\xff\xfe binary\n", b"return Main\n"] * 10
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = []
+            for i, content in enumerate(contents):
+                paths.append(os.path.join(tmp, str(i)))
+                with open(paths[-1], "wb") as fp:
+                    fp.write(content)
+            paths.append(os.path.join(tmp, "missing"))
+
+            verifier = MatchVerifier(workers=2, chunk_size=3)
+            try:
+                matches = list(verifier.iter_matches(paths, r"^def \w+", True))
+                assert [path for path, _ in matches] == paths
+                assert [s is not None for _, s in matches] == [c.startswith(b"def") for c in contents] + [False]
+
+                matches = [path for path, s in verifier.iter_matches(paths, "main", False) if s is not None]
+                assert matches == [p for p, c in zip(paths, contents) if b"ain" in c]
+
+                matches = [s for _, s in verifier.iter_matches(paths, "CAFÉ", False, context=0) if s is not None]
+                assert len(matches) == 10
+                assert matches[0][0]["spans"] == [(7, 12)]
+
+                # Stopping early leaves nothing running
+                iterator = verifier.iter_matches(paths, "binary", True)
+                assert next(iterator)[0] == paths[0]
+                iterator.close()
+
+                async def collect():
+                    return [item async for item in verifier.aiter_matches(paths, r"^def \w+", True)]
+
+                assert asyncio.run(collect()) == list(verifier.iter_matches(paths, r"^def \w+", True))
+            finally:
+                verifier.close()
+
+    @staticmethod
+    def test_line_starts():
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "doc")
+            with open(path, "wb") as fp:
+                fp.write(b"def main():\n    return main\nmain")
+
+            verifier = MatchVerifier(workers=1)
+            try:
+
+                def matches(regex: str, line_starts: list[int] | None) -> bool:
+                    return next(verifier.iter_matches([path], regex, True, None, [line_starts]))[1] is not None
+
+                assert matches("^def", None) and matches("^def", [0]) and not matches("^def", [12])
+                assert matches("^    return main$", [12]) and not matches("^    return main$", [0, 28])
+                assert matches(r"^main\Z", [28]) and not matches(r"main\Z", [0, 12])
+            finally:
+                verifier.close()
+
+    @staticmethod
+    def test_find_snippets():
+        data = "".join(f"line {i}\n" for i in range(1, 21)).encode() + "ünïcode x\n".encode()
+
+        snippets = find_snippets(data, compile_pattern(r"line (3|5)\b", True), 1)
+        assert len(snippets) == 1
+        snippet = snippets[0]
+        assert (snippet["start_line"], snippet["end_line"], snippet["match_lines"]) == (2, 6, [3, 5])
+        assert snippet["content"] == data[snippet["start_offset"] : snippet["end_offset"]].decode()
+        assert snippet["content"] == "line 2\nline 3\nline 4\nline 5\nline 6\n"
+        assert [data[start:end] for start, end in snippet["spans"]] == [b"line 3", b"line 5"]
+
+        snippets = find_snippets(data, compile_pattern(r"line 1\n|line 10|ïcode x", True), 2)
+        assert [(s["start_line"], s["end_line"]) for s in snippets] == [(1, 3), (8, 12), (19, 21)]
+        assert snippets[-1]["content"] == "line 19\nline 20\nünïcode x\n"
+        assert [data[start:end].decode() for start, end in snippets[-1]["spans"]] == ["ïcode x"]
@@ -0,0 +1,135 @@
+import asyncio
+import json
+import os
+import tempfile
+from unittest import TestCase, mock
+
+TEMP_DIR = tempfile.TemporaryDirectory()
+REPO_DIR = os.path.join(TEMP_DIR.name, "repos")
+ENV = {
+    "REPO_DIR": REPO_DIR,
+    "STORAGE_BACKEND": "embedded",
+    "DATA_DIR": TEMP_DIR.name,
+    "SEGMENTS_DIR": os.path.join(TEMP_DIR.name, "index"),
+    "INDEX_PARSE_WORKERS": "1",
+    "VERIFY_WORKERS": "1",
+}
+
+# The app is configured from the environment on import
+with mock.patch.dict(os.environ, ENV):
+    from saku import app as saku_app
+
+
+def tearDownModule():
+    asyncio.run(saku_app.query_engine.aclose())
+    saku_app.indexer.postings.close()
+    TEMP_DIR.cleanup()
+
+
+async def _post(
+    path: str, query: str, body: dict, disconnect_after: int | None = None
+) -> tuple[int, dict, list[bytes]]:
+    """Drives the app over ASGI, returning the status, headers & body chunks of the response.
+
+    The client disconnects once `disconnect_after` body chunks got sent.
+    """
+    request = [{"type": "http.request", "body": json.dumps(body).encode(), "more_body": False}]
+    disconnected = asyncio.Event()
+    started, chunks = {}, []
+
+    async def receive():
+        if request:
+            return request.pop()
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            started.update(message)
+        elif message["body"]:
+            chunks.append(message["body"])
+            if len(chunks) == disconnect_after:
+                disconnected.set()
+
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": query.encode(),
+        "root_path": "",
+        "headers": [(b"content-type", b"application/json")],
+        "client": ("testclient", 50000),
+        "server": ("testserver", 80),
+    }
+    await asyncio.wait_for(saku_app.app(scope, receive, send), 60)
+    return started["status"], dict(started["headers"]), chunks
+
+
+class TestSearchStream(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        for i in range(3):
+            os.makedirs(os.path.join(REPO_DIR, "src"), exist_ok=True)
+            with open(os.path.join(REPO_DIR, "src", f"handler_{i}.py"), "w") as fp:
+                fp.write(f"def stream_handler_{i}():\n    return {i}\n")
+        saku_app.indexer.index_directory(REPO_DIR)
+
+    def test_ndjson(self):
+        status, headers, chunks = asyncio.run(_post("/search/stream", "context=0", {"regex": r"stream_handler_\d"}))
+        assert status == 200
+        assert headers[b"content-type"] == b"application/x-ndjson"
+        # A line per match as soon as it is verified, then the summary
+        lines = b"".join(chunks).decode().splitlines()
+        assert len(chunks) == len(lines) == 4
+        events = [json.loads(line) for line in lines]
+        assert [event["type"] for event in events] == ["match"] * 3 + ["summary"]
+        assert sorted(os.path.basename(event["path"]) for event in events[:-1]) == [f"handler_{i}.py" for i in range(3)]
+        assert events[0]["snippets"][0]["match_lines"] == [1]
+        assert (events[-1]["total"], events[-1]["total_exact"]) == (3, True)
+
+    def test_sse(self):
+        status, headers, chunks = asyncio.run(
+            _post("/search/stream", "format=sse&limit=2", {"regex": "stream_handler_1"})
+        )
+        assert status == 200
+        assert headers[b"content-type"].startswith(b"text/event-stream")
+        records = b"".join(chunks).decode().split("\n\n")
+        assert records.pop() == ""
+        events = []
+        for record in records:
+            kind, data = record.split("\n")
+            assert kind.startswith("event: ") and data.startswith("data: ")
+            events.append((kind.removeprefix("event: "), json.loads(data.removeprefix("data: "))))
+        assert [kind for kind, _ in events] == ["match", "summary"]
+        assert events[0][1]["content"] == "def stream_handler_1():\n    return 1\n"
+        assert events[1][1]["total"] == 1
+
+    def test_invalid_regex(self):
+        status, _, chunks = asyncio.run(_post("/search/stream", "", {"regex": "("}))
+        assert status == 400
+        assert json.loads(b"".join(chunks))["detail"].startswith("Invalid regex")
+
+    def test_disconnect(self):
+        closed = asyncio.Event()
+
+        async def events():
+            try:
+                yield {"type": "match", "file": "a.py", "path": "a.py", "content": ""}
+                # Verifying what comes next takes forever
+                await asyncio.Event().wait()
+            finally:
+                closed.set()
+
+        async def aiter_search(*args):
+            return events()
+
+        with mock.patch.object(saku_app.query_engine, "aiter_search", aiter_search):
+            status, _, chunks = asyncio.run(_post("/search/stream", "", {"regex": "a"}, disconnect_after=1))
+        assert status == 200
+        assert len(chunks) == 1
+        # The search is stopped once the client goes away
+        assert closed.is_set()